@@ -0,0 +1,286 @@
+""" Benchmarks of piwaterflow: startup, loop ticks, event store, user log and schedule calculation.
+    Runs offline: dry run waterflow, fake GPIO and the mock influx connection (see config-benchmark.yml).
+
+    python benchmarks/bench_waterflow.py                                 # Run all, print the results
+    python benchmarks/bench_waterflow.py --quick --filter events         # Smaller sizes, only some benchmarks
+    python benchmarks/bench_waterflow.py --output new.json               # Save the results as json
+    python benchmarks/bench_waterflow.py --compare old.json              # Run, and compare with previous results
+    python benchmarks/bench_waterflow.py --compare old.json new.json     # Only compare two saved results
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+from datetime import datetime, timedelta
+
+from fake_rpigpio.RPi import GPIO as FakeGPIO
+
+from piwaterflow import Waterflow
+from piwaterflow.flow_meter import FlowMeter
+
+CONFIG_PATH = os.path.join(Path(__file__).parent.resolve(), 'config-benchmark.yml')
+
+_BENCHMARKS = []
+
+
+def benchmark(function):
+    """ Registers a benchmark. It yields (name, stats) for each of its variants
+    """
+    _BENCHMARKS.append(function)
+    return function
+
+
+def measure(function, number: int = 1, repeat: int = 5, setup=None) -> dict:
+    """ Times a function
+    Args:
+        function (callable): Function to be timed
+        number (int, optional): Calls per measurement. Defaults to 1.
+        repeat (int, optional): Number of measurements. Defaults to 5.
+        setup (callable, optional): Called before each measurement, not timed. Defaults to None.
+    Returns:
+        dict: Seconds per call (min and median of the measurements), number and repeat
+    """
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        times.append((time.perf_counter() - start) / number)
+    return {'min': min(times), 'median': statistics.median(times), 'number': number, 'repeat': repeat}
+
+
+def _new_waterflow() -> Waterflow:
+    waterflow = Waterflow(template_config_path=CONFIG_PATH, dry_run=True)
+    waterflow.gpio = FakeGPIO  # Never drive real relays, even in a Raspberry Pi
+    return waterflow
+
+
+def _fill_events(waterflow: Waterflow, count: int):
+    """ Writes "count" events directly in the journal, as if appended one by one
+    """
+    journal = waterflow.event_journal
+    journal.close()
+    event_time = datetime(2020, 1, 1)
+    with open(journal.path, 'w', encoding="utf-8") as journal_file:
+        for index in range(count):
+            event = (Waterflow.time_to_str(event_time + timedelta(minutes=index)),
+                     'ValveON' if index % 2 else 'ValveOFF', 'main')
+            journal_file.write(journal._encode(event)) # pylint: disable=protected-access
+    waterflow.events = waterflow._read_events() # pylint: disable=protected-access
+
+
+def _programs(count: int) -> list:
+    return [{'name': f'program{index}', 'enabled': True,
+             'start_time': f'{index * 1440 // count // 60:02d}:{index * 1440 // count % 60:02d}',
+             'valves': [{'name': 'main', 'time': 5}, {'name': 'grass', 'time': 5}]} for index in range(count)]
+
+
+@benchmark
+def bench_startup(quick: bool):
+    """ Cold start of a new process, and creation of the Waterflow instance
+    """
+    template = json.dumps(CONFIG_PATH)
+    code = f'from piwaterflow import Waterflow; Waterflow(template_config_path={template}, dry_run=True)'
+    yield 'startup.process_init', measure(lambda: subprocess.run([sys.executable, '-c', code], check=True),
+                                          repeat=3 if quick else 5)
+    yield 'startup.cli_help', measure(lambda: subprocess.run([sys.executable, '-m', 'piwaterflow', '--help'],
+                                                             check=True, stdout=subprocess.DEVNULL),
+                                      repeat=3 if quick else 5)
+
+    def init():
+        _new_waterflow().close()
+    yield 'startup.init', measure(init, repeat=5 if quick else 10)
+
+
+@benchmark
+def bench_loop(quick: bool):
+    """ Loop with nothing to do, and loop executing a program (valve sleeps are skipped by the dry run)
+    """
+    waterflow = _new_waterflow()
+    waterflow._write_last_program_time(Waterflow.str_to_time('2023-05-27 08:00:00')) # pylint: disable=protected-access
+    idle_time = Waterflow.str_to_time('2023-05-27 08:30:00')
+    yield 'loop.idle', measure(lambda: waterflow.loop(idle_time), number=10, repeat=5 if quick else 10)
+
+    program_time = Waterflow.str_to_time('2023-05-27 09:52:00')
+    last_time = Waterflow.str_to_time('2023-05-26 23:59:00')
+    yield 'loop.program', measure(lambda: waterflow.loop(program_time), repeat=10 if quick else 30,
+                                  setup=lambda: waterflow._write_last_program_time(last_time)) # pylint: disable=protected-access
+    waterflow.close()
+
+
+@benchmark
+def bench_events(quick: bool):
+    """ Event store and user log, with a current segment of different sizes
+    """
+    for count in (1000, 10000) if quick else (1000, 100000, 1000000):
+        waterflow = _new_waterflow()
+        _fill_events(waterflow, count)
+        repeat = 3 if count >= 100000 else 5
+        yield f'events.add_event[{count}]', measure(lambda: waterflow._add_event('ValveON', 'main'), # pylint: disable=protected-access
+                                                    number=100, repeat=repeat)
+        yield f'events.read_events[{count}]', measure(waterflow._read_events, repeat=repeat) # pylint: disable=protected-access
+        yield f'events.get_log[{count}]', measure(waterflow.get_log, repeat=repeat)
+        yield f'events.iter_log_last_100[{count}]', measure(lambda: list(waterflow.iter_log(limit=100)),
+                                                            number=10, repeat=repeat)
+        waterflow.close()
+
+
+@benchmark
+def bench_schedule(quick: bool):
+    """ Schedule compilation, and next program calculation as the loop does it (increasing times)
+    """
+    waterflow = _new_waterflow()
+    for count in (2, 100) if quick else (2, 100, 1000):
+        waterflow.config.get_dict()['programs'] = _programs(count)
+        yield f'schedule.compile[{count}]', measure(waterflow.config._compile_schedule, # pylint: disable=protected-access
+                                                    number=10, repeat=5)
+
+        last_times = [Waterflow.str_to_time('2023-05-27 00:00:00') + timedelta(minutes=minute)
+                      for minute in range(0, 1440, 5)]
+        waterflow.curr_time = last_times[0]
+
+        def recalc():
+            for last_time in last_times:
+                waterflow._recalc_next_program(last_time) # pylint: disable=protected-access
+        stats = measure(recalc, repeat=5)
+        for key in ('min', 'median'):
+            stats[key] /= len(last_times)
+        stats['number'] = len(last_times)
+        yield f'schedule.recalc_next_program[{count}]', stats
+    waterflow.close()
+
+
+@benchmark
+def bench_instrumentation(quick: bool):
+    """ Cost of a span around a phase, with the instrumentation disabled (default) and enabled
+    """
+    waterflow = _new_waterflow()
+    instrumentation = waterflow.instrumentation
+
+    def spans():
+        for _ in range(1000):
+            with instrumentation.span('phase'):
+                pass
+    for enabled in (False, True):
+        instrumentation.enabled = enabled
+        stats = measure(spans, repeat=5 if quick else 10)
+        for key in ('min', 'median'):
+            stats[key] /= 1000
+        stats['number'] = 1000
+        yield f'instrumentation.span[{"enabled" if enabled else "disabled"}]', stats
+    instrumentation.enabled = False
+    waterflow.close()
+
+
+@benchmark
+def bench_flow_meter(quick: bool):
+    """ Cost of a pulse in the edge callback of the flow meter (bounds the pulse rate it keeps up with)
+    """
+    meter = FlowMeter(FakeGPIO, 12)
+
+    def pulses():
+        for _ in range(10000):
+            meter.on_pulse(12)
+    stats = measure(pulses, repeat=5 if quick else 10)
+    for key in ('min', 'median'):
+        stats[key] /= 10000
+    stats['number'] = 10000
+    yield 'flow_meter.pulse', stats
+
+
+def run(quick: bool = False, name_filter: str = None) -> dict:
+    """ Runs the benchmarks
+    Args:
+        quick (bool, optional): Smaller sizes and less repetitions. Defaults to False.
+        name_filter (str, optional): Only the benchmarks with this text in their name. Defaults to None.
+    Returns:
+        dict: Results, with the stats of each benchmark in "benchmarks"
+    """
+    results = {'version': Waterflow.get_version(),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'date': datetime.now().isoformat(timespec='seconds'),
+               'quick': quick,
+               'benchmarks': {}}
+    for function in _BENCHMARKS:
+        if name_filter and name_filter not in function.__name__:
+            continue
+        for name, stats in function(quick):
+            results['benchmarks'][name] = stats
+            print(f'{name:45} {_format_time(stats["median"]):>12} (min {_format_time(stats["min"])})', flush=True)
+    return results
+
+
+def _format_time(seconds: float) -> str:
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f'{seconds / scale:.2f} {unit}'
+    return f'{seconds / 1e-9:.0f} ns'
+
+
+def compare(baseline: dict, current: dict, threshold: float = 0.2) -> list:
+    """ Compares the medians of two results
+    Args:
+        baseline (dict): Previous results
+        current (dict): New results
+        threshold (float, optional): Relative slowdown considered a regression. Defaults to 0.2 (20%).
+    Returns:
+        list: Names of the regressed benchmarks
+    """
+    print(f'\n{"benchmark":45} {baseline["version"]:>12} {current["version"]:>12} {"ratio":>8}')
+    regressions = []
+    for name, stats in current['benchmarks'].items():
+        base_stats = baseline['benchmarks'].get(name)
+        if base_stats is None:
+            print(f'{name:45} {"-":>12} {_format_time(stats["median"]):>12}')
+            continue
+        ratio = stats['median'] / base_stats['median']
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 / (1 + threshold):
+            flag = '  improved'
+        print(f'{name:45} {_format_time(base_stats["median"]):>12} {_format_time(stats["median"]):>12} '
+              f'{ratio:>7.2f}x{flag}')
+    return regressions
+
+
+def main():
+    """ Command line entry point
+    """
+    parser = argparse.ArgumentParser(description='piwaterflow benchmarks')
+    parser.add_argument('--quick', action='store_true', help='Smaller sizes and less repetitions')
+    parser.add_argument('--filter', help='Only the benchmarks with this text in their name (i.e. events)')
+    parser.add_argument('--output', help='Save the results in this json file')
+    parser.add_argument('--compare', nargs='+', metavar='RESULTS',
+                        help='Baseline results to compare with. If a second file is given, nothing is run')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Slowdown considered a regression (0.2=20%%)')
+    args = parser.parse_args()
+
+    if args.compare and len(args.compare) > 1:
+        with open(args.compare[1], 'r', encoding="utf-8") as results_file:
+            results = json.load(results_file)
+    else:
+        results = run(quick=args.quick, name_filter=args.filter)
+
+    if args.output:
+        with open(args.output, 'w', encoding="utf-8") as results_file:
+            json.dump(results, results_file, indent=2)
+
+    if args.compare:
+        with open(args.compare[0], 'r', encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare(baseline, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,3 +3,5 @@ __version__ = "1.0.0"
 
 from .config_waterflow import WaterflowConfig
 from .waterflow import Waterflow
+from .simulation import SimulatedWaterflow
+from .control_client import WaterflowClient, ControlError
@@ -1,8 +1,66 @@
-""" _main_ To be properly executed from crontab --> python -m piwaterflow """
+""" _main_ To be properly executed from crontab --> python -m piwaterflow
+    or as a long running service --> python -m piwaterflow --daemon
+    or to preview the schedule of a config --> python -m piwaterflow --simulate 2023-05-01 2023-10-31 --config new.yml
+    or to see where the time of the runs goes --> python -m piwaterflow --timings
+    or to see how long each valve watered --> python -m piwaterflow --usage month
+"""
+import json
+import argparse
+from datetime import datetime
+
 from log_mgr import Logger
 from .waterflow import Waterflow
+from .simulation import SimulatedWaterflow
+
+parser = argparse.ArgumentParser(prog='piwaterflow', description='Raspberry Pi Waterflow resilient system')
+parser.add_argument('--daemon', action='store_true',
+                    help='Keep running, waking up only for the next program, control requests or the heartbeat')
+parser.add_argument('--simulate', nargs=2, metavar=('SINCE', 'UNTIL'),
+                    help='Print the log of a simulation between two dates (YYYY-MM-DD), without watering')
+parser.add_argument('--config', help='Config to simulate. Defaults to the deployed one')
+parser.add_argument('--export-state', metavar='FOLDER',
+                    help='Write the token and lastprogram.yml files of older versions in a folder')
+parser.add_argument('--usage', nargs='?', const='month', metavar='GRANULARITY',
+                    help='Print how long each valve watered (or would water, with --simulate), by day, week, '
+                         'month (default), year or total')
+parser.add_argument('--rebuild-usage', action='store_true',
+                    help='Rebuild the water usage rollups from the whole events history')
+parser.add_argument('--timings', action='store_true',
+                    help='Print the histograms of the durations of the phases (needs instrumentation enabled)')
+args = parser.parse_args()
+
+
+def print_usage(waterflow: Waterflow, granularity: str):
+    """ Prints how long each valve watered
+    """
+    for row in waterflow.usage(granularity=granularity):
+        print(f"{row['period']} {row['valve']}: {row['minutes']:.1f} min ({row['runs']} runs)")
+
 
-logger = Logger('piwaterflow', log_file_name='piwaterflow')
+if args.simulate:
+    simulation = SimulatedWaterflow(config_path=args.config)
+    simulation.run(since=datetime.strptime(args.simulate[0], '%Y-%m-%d'),
+                   until=datetime.strptime(args.simulate[1], '%Y-%m-%d'))
+    if args.usage:
+        print_usage(simulation, args.usage)
+    else:
+        print(simulation.get_log(), end='')
+elif args.usage:
+    print_usage(Waterflow(), args.usage)
+elif args.rebuild_usage:
+    print(f'{Waterflow().rebuild_usage()} valve events rolled up.')
+elif args.export_state:
+    Waterflow().export_state(args.export_state)
+elif args.timings:
+    print(json.dumps(Waterflow().get_timings(), indent=2))
+else:
+    logger = Logger('piwaterflow', log_file_name='piwaterflow')
 
-waterflow_instance = Waterflow()
-waterflow_instance.loop()
+    waterflow_instance = Waterflow()
+    try:
+        if args.daemon:
+            waterflow_instance.run_daemon()
+        else:
+            waterflow_instance.loop()
+    finally:
+        waterflow_instance.close()
@@ -0,0 +1,109 @@
+""" Circuit breaker persisted in a file, so that consecutive short-lived processes (cron) share it.
+    After some consecutive failures the circuit opens, and the backend is skipped without even trying it until the
+    reset time passes. Then a single trial is allowed (half-open): success closes it again, failure reopens it.
+"""
+import os
+import json
+import time
+import logging
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """ Specific exception for when a call is rejected because the circuit is open
+    """
+    def __init__(self, message):
+        # Call the base class constructor with the parameters it needs
+        super().__init__(message)
+
+
+class CircuitBreaker():
+    """ Circuit breaker with its state persisted in a json file
+    """
+    def __init__(self, state_path: str, failure_threshold: int = 2, reset_timeout: float = 600):
+        """__init__ of the class
+        Args:
+            state_path (str): File where the state is persisted
+            failure_threshold (int, optional): Consecutive failures that open the circuit. Defaults to 2.
+            reset_timeout (float, optional): Seconds the circuit stays open before a trial. Defaults to 600.
+        """
+        self.state_path = state_path
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.logger = logging.getLogger()
+
+    def _read(self) -> dict:
+        try:
+            with open(self.state_path, 'r', encoding="utf-8") as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            return {'state': CLOSED, 'failures': 0, 'opened_at': 0}
+
+    def _write(self, state: dict):
+        tmp_path = f'{self.state_path}.tmp'
+        with open(tmp_path, 'w', encoding="utf-8") as state_file:
+            json.dump(state, state_file)
+        os.replace(tmp_path, self.state_path)
+
+    @property
+    def state(self) -> str:
+        """ Current state of the circuit
+        Returns:
+            str: "closed", "open" or "half_open"
+        """
+        return self._read()['state']
+
+    def allow(self) -> bool:
+        """ Returns if a call to the backend should be tried
+        Returns:
+            bool: False if the circuit is open
+        """
+        state = self._read()
+        if state['state'] == OPEN:
+            if time.time() - state['opened_at'] < self.reset_timeout:
+                return False
+            state['state'] = HALF_OPEN
+            self._write(state)
+            self.logger.info('Circuit %s half-open: trying the backend again.', self.state_path)
+        return True
+
+    def record_success(self):
+        """ Registers a successful call: closes the circuit
+        """
+        state = self._read()
+        if state['state'] != CLOSED or state['failures']:
+            self._write({'state': CLOSED, 'failures': 0, 'opened_at': 0})
+
+    def record_failure(self):
+        """ Registers a failed call: opens the circuit after too many consecutive failures, or if it was a trial
+        """
+        state = self._read()
+        state['failures'] += 1
+        if state['state'] == HALF_OPEN or state['failures'] >= self.failure_threshold:
+            if state['state'] != OPEN:
+                self.logger.warning('Circuit %s open for %s seconds.', self.state_path, self.reset_timeout)
+            state['state'] = OPEN
+            state['opened_at'] = time.time()
+        self._write(state)
+
+    def call(self, function, *args, **kwargs):
+        """ Calls a function through the breaker
+        Args:
+            function (callable): Function that uses the backend
+        Raises:
+            CircuitOpenError: If the circuit is open
+        Returns:
+            Result of the function
+        """
+        if not self.allow():
+            raise CircuitOpenError(f'Circuit {self.state_path} is open')
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
@@ -0,0 +1,114 @@
+""" Durable queue of control commands (stop, forced valve, forced program), kept in the state store (see state_store).
+    Each command is written in a transaction of the store, so that requests coming in a burst from other processes
+    (web frontend, control socket) are never lost, as it happened with the single "force" file, and the commands
+    served by a loop tick are committed with the rest of its state.
+    Pending commands are served by priority (stop > forced valve > forced program), and then in arrival order.
+    Identical pending commands are only queued once: the check and the write are in the same transaction. Finished
+    commands are kept for a while, so their status can be queried.
+    Once a command is committed, a signal file is touched, so that the watchers (see ControlWatcher) wake up.
+"""
+import os
+import time
+import threading
+from itertools import count
+
+STOP = 'stop'
+VALVE = 'valve'
+PROGRAM = 'program'
+PRIORITIES = {STOP: 0, VALVE: 1, PROGRAM: 2}
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+CANCELLED = 'cancelled'
+
+
+class CommandQueue():
+    """ Queue of commands, kept in the state store
+    """
+    def __init__(self, store, history: int = 50, signal_path: str = None):
+        """__init__ of the class
+        Args:
+            store (FileStateStore or SqliteStateStore): Store where the commands are kept
+            history (int, optional): Finished commands kept to be queried. Defaults to 50.
+            signal_path (str, optional): File touched when a command is queued. Defaults to None (no signal).
+        """
+        self.store = store
+        self.history = history
+        self.signal_path = signal_path
+        self._lock = threading.Lock()
+        self._sequence = count()
+
+    def _signal(self):
+        if self.signal_path:
+            with open(self.signal_path, 'a', encoding="utf-8"):
+                pass
+            os.utime(self.signal_path)
+
+    def get(self, command_id: str):
+        """ Returns a command
+        Args:
+            command_id (str): Id returned by push()
+        Returns:
+            dict: Command (id, type, value, priority, status, created, updated), or None if unknown
+        """
+        return self.store.read_command(command_id)
+
+    def commands(self, statuses: tuple = None) -> list:
+        """ Returns the commands, in arrival order
+        Args:
+            statuses (tuple, optional): Only commands with these statuses. Defaults to None (all).
+        Returns:
+            list: Commands
+        """
+        return self.store.read_commands(statuses)
+
+    def pending(self) -> list:
+        """ Returns the queued commands, in the order they must be served
+        Returns:
+            list: Commands, by priority and arrival
+        """
+        return sorted(self.commands((QUEUED,)), key=lambda command: (command['priority'], command['id']))
+
+    def push(self, type_command: str, value: str = None) -> str:
+        """ Queues a command, unless an identical one is already queued
+        Args:
+            type_command (str): Can be "stop", "valve" or "program"
+            value (str, optional): Name of the valve or program. Defaults to None.
+        Returns:
+            str: Id of the command (of the identical one if already queued)
+        """
+        with self.store.transaction():
+            for command in self.commands((QUEUED,)):
+                if command['type'] == type_command and command['value'] == value:
+                    return command['id']
+            now = time.time()
+            with self._lock:
+                # Sortable by arrival, and unique among processes
+                command_id = f'{int(now * 1e9):020d}-{os.getpid()}-{next(self._sequence)}'
+            self.store.write_command({'id': command_id, 'type': type_command, 'value': value,
+                                      'priority': PRIORITIES[type_command], 'status': QUEUED,
+                                      'created': now, 'updated': now})
+        self._signal()
+        return command_id
+
+    def set_status(self, command_id: str, status: str):
+        """ Changes the status of a command. Old finished commands are deleted
+        Args:
+            command_id (str): Id of the command
+            status (str): New status
+        """
+        with self.store.transaction():
+            command = self.get(command_id)
+            if command is None:
+                return
+            command['status'] = status
+            command['updated'] = time.time()
+            self.store.write_command(command)
+            if status in (DONE, CANCELLED):
+                self._prune()
+
+    def _prune(self):
+        finished = self.commands((DONE, CANCELLED))
+        for command in finished[:max(0, len(finished) - self.history)]:
+            self.store.delete_command(command['id'])
@@ -1,27 +1,204 @@
 """ Config override for piwaterflow """
-from datetime import datetime
+import os
+import pickle
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from types import MappingProxyType
 import pytz
+import yaml
 
 from config_yml import Config
+from . import __version__
+from .recurrence import ScheduleEngine
+
+# Increase when the post-processing of the config changes, so that older snapshots are not used
+_SNAPSHOT_FORMAT = 1
 
 def _set_timezone_utc(date: datetime):
     return pytz.timezone('UTC').localize(date)
 
 
+def _parse_start_time(start_time):
+    if isinstance(start_time, str):
+        start_time = _set_timezone_utc(datetime.strptime(start_time, '%H:%M'))
+    return start_time
+
+
+class CompiledSchedule():
+    """ Immutable lookup structures built once from the programs and valves of the config
+    """
+    __slots__ = ('engine', 'programs', 'valves')
+
+    def __init__(self, programs: list, valves: dict):
+        self.engine = ScheduleEngine([program for program in programs if program['enabled'] is True])
+        self.programs = MappingProxyType({program['name']: program for program in programs})
+        self.valves = MappingProxyType(dict(valves or {}))
+
+    def next_program(self, current_time: datetime, last_program_time: datetime):
+        """ Next program occurrence after the last one executed. Occurrences of days before "today" are never
+            returned (missed programs are not recovered)
+        Args:
+            current_time (datetime): Time used to get "today" (local aware)
+            last_program_time (datetime): Time in which previous program was executed (local aware)
+        Returns:
+            tuple: time of next program (local aware), and program name. (None, None) if no program will run
+        """
+        today = current_time.astimezone().replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+        after = max(last_program_time.astimezone().replace(tzinfo=None), today - timedelta(microseconds=1))
+        next_time, program_name = self.engine.next_after(after)
+        if next_time is None:
+            return None, None
+        return next_time.astimezone(), program_name
+
+
 class WaterflowConfig(Config):
-    """Config override for piwaterflow
+    """Config override for piwaterflow.
+        The parsed and post-processed config is cached in a snapshot next to the yaml, so that the loops of cron do
+        not parse the yaml while it does not change
     """
+    _schedule = None
+
+    def _snapshot_path(self) -> str:
+        return f'{self.get_config_path()}.snapshot'
+
+    def _snapshot_key(self):
+        """ Identifies the contents the config was read from: size, modification time and hash of both the template
+            and the config, and the version that post-processed them
+        Returns:
+            list: Key, or None if there is no config file yet
+        """
+        key = [_SNAPSHOT_FORMAT, __version__]
+        for path in (self._template_path, self.get_config_path()):
+            try:
+                with open(path, 'rb') as config_file:
+                    content = config_file.read()
+                    stat = os.fstat(config_file.fileno())
+            except OSError:
+                if path != self._template_path:
+                    return None
+                key.append((path, None))  # No template
+                continue
+            key.append((os.path.abspath(path), stat.st_size, stat.st_mtime_ns, hashlib.sha256(content).hexdigest()))
+        return key
+
+    def _read_snapshot(self):
+        """ Returns the config of the snapshot, if it was taken from the current template and config files
+        Returns:
+            dict: Config, or None if there is no fresh snapshot
+        """
+        key = self._snapshot_key()
+        if key is None:
+            return None
+        try:
+            with open(self._snapshot_path(), 'rb') as snapshot_file:
+                snapshot = pickle.load(snapshot_file)
+        except Exception:  # pylint: disable=broad-except
+            return None  # Missing or corrupt: the yaml is parsed
+        if not isinstance(snapshot, dict) or snapshot.get('key') != key:
+            return None
+        return snapshot['config']
+
+    def _write_snapshot(self):
+        key = self._snapshot_key()
+        if key is None:
+            return
+        snapshot_path = self._snapshot_path()
+        tmp_path = f'{snapshot_path}.tmp'
+        try:
+            with open(tmp_path, 'wb') as snapshot_file:
+                pickle.dump({'key': key, 'config': self.config}, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, snapshot_path)
+        except (OSError, pickle.PicklingError) as ex:
+            logging.getLogger().warning('Config snapshot could not be written: %s', str(ex))
+
+    def read_config(self):
+        """ Reads the config from the snapshot if it is fresh. Otherwise parses the template and config yaml files,
+            and takes a new snapshot
+        """
+        config = self._read_snapshot()
+        if config is not None:
+            self.config = config
+            self._compile_schedule()
+            return
+        super().read_config()
+        self._write_snapshot()
+
     def _after_reading(self):
         """ Adapt the data after reading the config yaml
         """
         # Customize values
         for program in self.config['programs']:
-            progtime = datetime.strptime(program['start_time'], '%H:%M')
-            progtime = _set_timezone_utc(progtime)
-            program['start_time'] = progtime
+            program['start_time'] = _parse_start_time(program['start_time'])
+        self._compile_schedule()
 
-        # Sort the programs by time
-        # self.config['programs'].sort(key=lambda prog: prog['start_time'])
+    def _compile_schedule(self):
+        self._schedule = CompiledSchedule(self.config.get('programs') or [], self.config.get('valves'))
+
+    @property
+    def schedule(self) -> CompiledSchedule:
+        """ Compiled schedule. Only rebuilt when programs or valves are updated
+        Returns:
+            CompiledSchedule: Schedule
+        """
+        if self._schedule is None:
+            self._compile_schedule()
+        return self._schedule
+
+    @staticmethod
+    def _merge_config(source_config: dict, dest_config: dict):
+        """ Merges as the base class, but the lists of the programs (weekdays, start_times, valves...) are replaced:
+            the merge only adds elements to them, so they could never shrink
+        Args:
+            source_config (dict): Source dictionary to merge
+            dest_config (dict): Destination dictionary to be modified with the source one
+        """
+        if isinstance(source_config, dict) and isinstance(dest_config, dict):
+            programs = {program.get('name'): program for program in dest_config.get('programs') or []}
+            for program in source_config.get('programs') or []:
+                current = programs.get(program.get('name'))
+                if current is not None:
+                    for key, value in program.items():
+                        if isinstance(value, list):
+                            current[key] = []  # Filled again by the merge
+        Config._merge_config(source_config, dest_config)
+
+    def update(self, config_update):
+        """ Update the config with new data. Programs start_time can be given as datetime or as 'HH:MM' string.
+            The new config is built on a copy, and replaces the current one at once: readers in other threads (i.e.
+            the executor) never see it half updated
+        Args:
+            config_update (dict): Values to modify
+        """
+        if 'programs' in config_update:
+            # Merged as strings (datetimes are not replaced by the merge), and parsed back afterwards
+            config_update = dict(config_update)
+            config_update['programs'] = [dict(program) for program in config_update['programs']]
+            for program in config_update['programs']:
+                if isinstance(program.get('start_time'), datetime):
+                    program['start_time'] = program['start_time'].strftime('%H:%M')
+        config = self.get_dict_copy()
+        self._merge_config(config_update, config)
+        for program in config.get('programs') or []:
+            program['start_time'] = _parse_start_time(program['start_time'])
+        if 'programs' in config_update or 'valves' in config_update:
+            self._schedule = CompiledSchedule(config.get('programs') or [], config.get('valves'))
+        self.config = config
+
+    def write(self):
+        """ Writes the config file (atomically: readers never see it half written), and refreshes the snapshot
+        """
+        prepared_config = self._before_writting()
+        config_yml_path = self.get_config_path()
+        tmp_path = f'{config_yml_path}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding="utf-8") as config_file:
+                yaml.dump(prepared_config, config_file)
+            os.replace(tmp_path, config_yml_path)
+        except OSError as ex:
+            logging.getLogger().error('Config could not be written: %s', str(ex))
+            return
+        self._write_snapshot()
 
     def _before_writting(self):
         """ Transforms the data before being written to the config file
@@ -0,0 +1,186 @@
+""" Lightweight client for the control API of a running waterflow daemon (see control_server).
+    Intended for frontends like piwwwaterflow, that would otherwise need a whole Waterflow instance per request.
+"""
+import os
+import json
+import socket
+from datetime import datetime
+from pathlib import Path
+
+
+class ControlError(Exception):
+    """ Specific exception for when the daemon could not serve a request
+    """
+    def __init__(self, message):
+        # Call the base class constructor with the parameters it needs
+        super().__init__(message)
+
+
+class WaterflowClient():
+    """ Client of the waterflow control socket. Keeps a single connection open between requests
+    """
+    def __init__(self, socket_path: str = None, timeout: float = 5):
+        """__init__ of the class
+        Args:
+            socket_path (str, optional): Path of the control socket. Defaults to the one of the waterflow homevar.
+            timeout (float, optional): Timeout in seconds for each request. Defaults to 5.
+        """
+        if not socket_path:
+            socket_path = os.path.join(str(Path.home()), 'var', 'waterflow', 'control.sock')
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._socket = None
+        self._reader = None
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """ Closes the connection with the daemon
+        """
+        if self._reader:
+            self._reader.close()
+            self._reader = None
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+
+    def _connect(self):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(self.timeout)
+        try:
+            self._socket.connect(self.socket_path)
+        except OSError:
+            self.close()
+            raise
+        self._reader = self._socket.makefile('rb')
+
+    def request(self, operation: str, **args):
+        """ Sends a request to the daemon and waits for the response
+        Args:
+            operation (str): Name of the operation
+            args: Arguments of the operation
+        Raises:
+            ControlError: If the daemon could not serve the request
+            OSError: If the daemon is not reachable
+        Returns:
+            Result of the operation
+        """
+        data = (json.dumps({'op': operation, 'args': args}) + '\n').encode()
+        for retry in (True, False):
+            if self._socket is None:
+                self._connect()
+            try:
+                self._socket.sendall(data)
+                line = self._reader.readline()
+                if not line:
+                    raise ConnectionResetError('Connection closed by the daemon')
+                break
+            except OSError:
+                self.close()
+                if not retry:
+                    raise  # A kept-alive connection may be gone (daemon restarted): retry once on a new one
+
+        response = json.loads(line)
+        if not response.get('ok'):
+            raise ControlError(response.get('error'))
+        return response.get('result')
+
+    def force(self, type_force: str, value: str) -> bool:
+        """ Forces a program or valve (see Waterflow.force)
+        Args:
+            type_force (str): Can be "program" or "valve"
+            value (str): Name of the item to be forced
+        Returns:
+            bool: If forced correctly
+        """
+        return self.request('force', type_force=type_force, value=value)
+
+    def stop(self) -> bool:
+        """ Stops the forced valve or program execution (see Waterflow.stop)
+        Returns:
+            bool: If stop was requested
+        """
+        return self.request('stop')
+
+    def get_forced_info(self):
+        """ Returns the forced info of the waterflow
+        Returns:
+            dict: Forced info
+        """
+        return self.request('get_forced_info')
+
+    def enqueue(self, type_command: str, value: str = None) -> str:
+        """ Queues a command (see Waterflow.enqueue)
+        Args:
+            type_command (str): Can be "stop", "valve" or "program"
+            value (str, optional): Name of the valve or program. Defaults to None.
+        Returns:
+            str: Id of the command, or None if the valve or program is unknown
+        """
+        return self.request('enqueue', type_command=type_command, value=value)
+
+    def get_command(self, command_id: str) -> dict:
+        """ Returns a queued command with its status (see Waterflow.get_command)
+        Args:
+            command_id (str): Id returned by enqueue
+        Returns:
+            dict: Command, or None if unknown
+        """
+        return self.request('get_command', command_id=command_id)
+
+    def status(self) -> dict:
+        """ Returns the status of the waterflow (see Waterflow.get_status)
+        Returns:
+            dict: Status
+        """
+        return self.request('status')
+
+    def get_log(self) -> str:
+        """ Get the whole user log
+        Returns:
+            str: The whole user logs
+        """
+        return self.request('get_log')
+
+    def iter_log(self, since: datetime = None, until: datetime = None, limit: int = None,
+                 reverse: bool = True) -> list:
+        """ Get the user log lines in a time range (see Waterflow.iter_log)
+        Returns:
+            list: Log lines
+        """
+        return self.request('iter_log',
+                            since=since.strftime('%Y-%m-%d %H:%M:%S') if since else None,
+                            until=until.strftime('%Y-%m-%d %H:%M:%S') if until else None,
+                            limit=limit, reverse=reverse)
+
+    def update_config(self, programs: list) -> bool:
+        """ Updates the programs of the config. start_time can be given as 'HH:MM' string or datetime
+        Args:
+            programs (list): New programs to be modified
+        Returns:
+            bool: True if updated
+        """
+        programs = [dict(program) for program in programs]
+        for program in programs:
+            if isinstance(program.get('start_time'), datetime):
+                program['start_time'] = program['start_time'].strftime('%H:%M')
+        return self.request('update_config', programs=programs)
+
+    def timings(self) -> dict:
+        """ Returns the histograms of the durations of the phases (see Waterflow.get_timings)
+        Returns:
+            dict: Histogram per phase
+        """
+        return self.request('timings')
+
+    def usage(self, valve: str = None, since: datetime = None, until: datetime = None, granularity: str = 'day',
+              by_program: bool = False) -> list:
+        """ Returns how long the valves watered (see Waterflow.usage)
+        Returns:
+            list: Rows with period, valve, program (if by_program), minutes and runs
+        """
+        return self.request('usage', valve=valve,
+                            since=since.strftime('%Y-%m-%d') if since else None,
+                            until=until.strftime('%Y-%m-%d') if until else None,
+                            granularity=granularity, by_program=by_program)
@@ -0,0 +1,163 @@
+""" Local control API for a running waterflow daemon, through a Unix domain socket.
+    Protocol: one JSON object per line in both directions.
+        Request:  {"op": "force", "args": {"type_force": "valve", "value": "main"}}
+        Response: {"ok": true, "result": true}  or  {"ok": false, "error": "..."}
+    Requests larger than MAX_REQUEST_SIZE are rejected with an error response, and the rest of their line discarded.
+"""
+import os
+import json
+import socket
+import logging
+import threading
+import socketserver
+from datetime import datetime
+
+MAX_REQUEST_SIZE = 1024 * 1024
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    """ Serves the requests of a single client connection
+    """
+    def handle(self):
+        while True:
+            line = self.rfile.readline(MAX_REQUEST_SIZE + 1)
+            if not line:
+                break
+            if len(line) > MAX_REQUEST_SIZE:
+                while line and not line.endswith(b'\n'):
+                    line = self.rfile.readline(MAX_REQUEST_SIZE)
+                self.wfile.write(self.server.control.reject(f'Request larger than {MAX_REQUEST_SIZE} bytes'))
+            else:
+                self.wfile.write(self.server.control.dispatch(line))
+            self.wfile.flush()
+
+
+class ControlServer():
+    """ Unix socket server exposing force/stop/status/log/update_config/timings/usage of a waterflow instance
+    """
+    def __init__(self, waterflow, socket_path: str):
+        """__init__ of the class
+        Args:
+            waterflow (Waterflow): Waterflow instance that serves the requests
+            socket_path (str): Path of the Unix socket
+        """
+        self.waterflow = waterflow
+        self.socket_path = socket_path
+        self.logger = logging.getLogger()
+        self._server = None
+        self._thread = None
+        self._ops = {'force': self._op_force,
+                     'stop': self._op_stop,
+                     'get_forced_info': self._op_get_forced_info,
+                     'enqueue': self._op_enqueue,
+                     'get_command': self._op_get_command,
+                     'status': self._op_status,
+                     'get_log': self._op_get_log,
+                     'iter_log': self._op_iter_log,
+                     'update_config': self._op_update_config,
+                     'timings': self._op_timings,
+                     'usage': self._op_usage}
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.socket_path):
+            return
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(self.socket_path)
+            except OSError:
+                os.remove(self.socket_path)  # Nobody listening: left by a crashed daemon
+                return
+        raise RuntimeError(f'Control socket {self.socket_path} already in use by another process.')
+
+    def start(self):
+        """ Starts serving requests in a background thread
+        """
+        self._remove_stale_socket()
+        self._server = socketserver.ThreadingUnixStreamServer(self.socket_path, _ControlHandler)
+        self._server.daemon_threads = True
+        self._server.control = self
+        os.chmod(self.socket_path, 0o660)
+        self._thread = threading.Thread(target=self._server.serve_forever, name='waterflow-control', daemon=True)
+        self._thread.start()
+        self.logger.info('Control server listening on %s.', self.socket_path)
+
+    def stop(self):
+        """ Stops serving requests and removes the socket
+        """
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def dispatch(self, raw_request: bytes) -> bytes:
+        """ Executes a single request
+        Args:
+            raw_request (bytes): JSON encoded request
+        Returns:
+            bytes: JSON encoded response (newline terminated)
+        """
+        try:
+            request = json.loads(raw_request)
+            operation = self._ops.get(request.get('op'))
+            if operation is None:
+                raise ValueError(f'Unknown operation: {request.get("op")}')
+            response = {'ok': True, 'result': operation(**request.get('args', {}))}
+        except Exception as ex:  # pylint: disable=broad-except
+            return self.reject(str(ex))
+        return (json.dumps(response) + '\n').encode()
+
+    def reject(self, error: str) -> bytes:
+        """ Response of a request that failed or cannot be served
+        Args:
+            error (str): Reason
+        Returns:
+            bytes: JSON encoded response (newline terminated)
+        """
+        self.logger.error('Control request failed: %s', error)
+        return (json.dumps({'ok': False, 'error': error}) + '\n').encode()
+
+    @staticmethod
+    def _parse_time(time_str: str):
+        return datetime.strptime(time_str, '%Y-%m-%d %H:%M:%S') if time_str else None
+
+    def _op_force(self, type_force: str, value: str):
+        return self.waterflow.force(type_force, value)
+
+    def _op_stop(self):
+        return self.waterflow.stop()
+
+    def _op_get_forced_info(self):
+        return self.waterflow.get_forced_info()
+
+    def _op_enqueue(self, type_command: str, value: str = None):
+        return self.waterflow.enqueue(type_command, value)
+
+    def _op_get_command(self, command_id: str):
+        return self.waterflow.get_command(command_id)
+
+    def _op_status(self):
+        return self.waterflow.get_status()
+
+    def _op_get_log(self):
+        return self.waterflow.get_log()
+
+    def _op_iter_log(self, since: str = None, until: str = None, limit: int = None, reverse: bool = True):
+        return list(self.waterflow.iter_log(since=self._parse_time(since), until=self._parse_time(until),
+                                            limit=limit, reverse=reverse))
+
+    def _op_update_config(self, programs: list):
+        self.waterflow.update_config(programs)
+        return True
+
+    def _op_timings(self):
+        return self.waterflow.get_timings()
+
+    def _op_usage(self, valve: str = None, since: str = None, until: str = None, granularity: str = 'day',
+                  by_program: bool = False):
+        return self.waterflow.usage(valve=valve,
+                                    since=datetime.strptime(since, '%Y-%m-%d') if since else None,
+                                    until=datetime.strptime(until, '%Y-%m-%d') if until else None,
+                                    granularity=granularity, by_program=by_program)
@@ -0,0 +1,137 @@
+""" Event driven wait for control requests (stop/force files in the homevar folder).
+    Uses inotify when available (Linux), so that a request wakes up the waiter in milliseconds without polling.
+    Otherwise it falls back to polling with a fixed interval.
+"""
+import os
+import errno
+import select
+import struct
+import logging
+import ctypes
+import ctypes.util
+
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_WATCH_MASK = _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class ControlWatcher():
+    """ Waits until one of the watched files of a folder is created/modified, a timeout expires, or notify() is called
+    """
+    def __init__(self, path: str, names: tuple, poll_interval: float = 1, use_inotify: bool = True):
+        """__init__ of the class
+        Args:
+            path (str): Folder to be watched
+            names (tuple): Names of the files (inside the folder) that will wake up the waiter. None for any file
+            poll_interval (float, optional): Seconds between checks when inotify is not available. Defaults to 1.
+            use_inotify (bool, optional): Use inotify if available. Defaults to True.
+        """
+        self.path = path
+        self.names = None if names is None else {os.fsencode(name) for name in names}
+        self.poll_interval = poll_interval
+        self.logger = logging.getLogger()
+        self._inotify_fd = None
+        self._pipe_r, self._pipe_w = os.pipe()
+        os.set_blocking(self._pipe_r, False)
+        os.set_blocking(self._pipe_w, False)
+        if use_inotify:
+            self._init_inotify()
+
+    def __del__(self):
+        self.close()
+
+    def _init_inotify(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            inotify_fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+            if inotify_fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+            if libc.inotify_add_watch(inotify_fd, os.fsencode(self.path), _WATCH_MASK) < 0:
+                error = ctypes.get_errno()
+                os.close(inotify_fd)
+                raise OSError(error, f'inotify_add_watch failed for {self.path}')
+            self._inotify_fd = inotify_fd
+        except (OSError, AttributeError) as ex:
+            self.logger.info('inotify not available (%s). Polling every %s seconds.', str(ex), self.poll_interval)
+
+    @property
+    def uses_inotify(self) -> bool:
+        """ Returns if the watcher is event driven (inotify) instead of polling
+        Returns:
+            bool: True if using inotify
+        """
+        return self._inotify_fd is not None
+
+    def _drain_inotify(self) -> bool:
+        watched = False
+        while True:
+            try:
+                data = os.read(self._inotify_fd, 4096)
+            except OSError as ex:
+                if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            offset = 0
+            while offset < len(data):
+                _, _, _, name_len = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = data[offset:offset + name_len].rstrip(b'\0')
+                offset += name_len
+                watched = watched or self.names is None or name in self.names
+        return watched
+
+    def _drain_pipe(self):
+        try:
+            while os.read(self._pipe_r, 512):
+                pass
+        except BlockingIOError:
+            pass
+
+    def wait(self, timeout: float) -> bool:
+        """ Blocks until a watched file changes, notify() is called, or the timeout expires.
+            Without inotify it returns after at most poll_interval seconds, so the caller must check its conditions
+        Args:
+            timeout (float): Maximum seconds to wait
+        Returns:
+            bool: True if woken up by a watched file or by notify()
+        """
+        if self._pipe_r is None:
+            return False
+        fds = [self._pipe_r]
+        if self._inotify_fd is not None:
+            fds.append(self._inotify_fd)
+        else:
+            timeout = min(timeout, self.poll_interval)
+
+        ready, _, _ = select.select(fds, [], [], max(0, timeout))
+        woken = False
+        if self._pipe_r in ready:
+            self._drain_pipe()
+            woken = True
+        if self._inotify_fd is not None and self._inotify_fd in ready:
+            woken = self._drain_inotify() or woken
+        return woken
+
+    def notify(self):
+        """ Wakes up the waiter (from another thread or a signal handler)
+        """
+        if self._pipe_w is not None:
+            try:
+                os.write(self._pipe_w, b'\0')
+            except BlockingIOError:
+                pass  # Already notified
+
+    def close(self):
+        """ Releases the file descriptors
+        """
+        for attr in ('_inotify_fd', '_pipe_r', '_pipe_w'):
+            descriptor = getattr(self, attr, None)
+            if descriptor is not None:
+                os.close(descriptor)
+                setattr(self, attr, None)
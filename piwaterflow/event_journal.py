@@ -0,0 +1,448 @@
+""" Append-only journal for the waterflow user events.
+    Every event is stored as a single JSON line, so adding an event costs the same no matter how long the history is.
+    The journal is split in segments: only the current one is appended to (and read on startup). Full segments are
+    rotated into the segments folder, and compacted later (compressed, and eventually deleted) by the retention policy.
+    Time range queries use a two level timestamp index that costs nothing to maintain: a segment is skipped by its
+    first and last records, and inside a segment the records start with a fixed width timestamp, so they can be
+    bisected by byte offset. Timestamps are local time, so they go back when the clock does (end of DST, NTP): the
+    segment is rotated before an event older than its last one, so that every segment stays in order. Rotated
+    segments are named after their first event, but never before the previous segment, so that they sort in arrival
+    order. Compressed segments are filtered as a whole.
+"""
+import os
+import re
+import gzip
+import json
+import time
+import shutil
+import logging
+from datetime import datetime, timedelta
+
+FSYNC_ALWAYS = 'always'
+FSYNC_INTERVAL = 'interval'
+FSYNC_NEVER = 'never'
+
+_SEGMENT_RE = re.compile(r'^events-(\d{14})(?:-(\d+))?\.jsonl(\.gz)?$')
+
+
+class EventJournal():
+    """ Durable append-only journal of events (one JSON record per line)
+    """
+    def __init__(self, path: str, fsync: str = FSYNC_ALWAYS, fsync_interval: float = 5,
+                 segment_max_kb: int = 0, segment_max_days: int = 0):
+        """__init__ of the class
+        Args:
+            path (str): Path of the journal file (current segment)
+            fsync (str, optional): When to fsync after appending: "always", "interval" or "never".
+            fsync_interval (float, optional): Seconds between fsyncs when fsync is "interval". Defaults to 5.
+            segment_max_kb (int, optional): Rotate the current segment when it reaches this size. 0 disables it.
+            segment_max_days (int, optional): Rotate the current segment when its first event is older than this.
+                                              0 disables it.
+        """
+        self._file = None
+        if fsync not in (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER):
+            raise ValueError(f'Unknown fsync policy: {fsync}')
+        self.path = path
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.segment_max_bytes = segment_max_kb * 1024
+        self.segment_max_days = segment_max_days
+        self.segments_path = f'{path}.d'
+        self.logger = logging.getLogger()
+        self._last_fsync = 0
+        self._size = 0
+        self._first_time = None
+        self._last_stamp = None
+
+    def __del__(self):
+        self.close()
+
+    @staticmethod
+    def _encode(event) -> str:
+        return json.dumps(list(event), separators=(',', ':')) + '\n'
+
+    def migrate(self, legacy_path: str) -> bool:
+        """ One-shot migration from the legacy events file (a single JSON array rewritten on every event)
+        Args:
+            legacy_path (str): Path of the legacy events file
+        Returns:
+            bool: True if a legacy file was found and migrated
+        """
+        if not os.path.exists(legacy_path):
+            return False
+
+        with open(legacy_path, 'r', encoding="utf-8") as legacy_file:
+            try:
+                events = json.load(legacy_file)
+            except ValueError:
+                self.logger.warning('Legacy events file %s is corrupted. Discarding it.', legacy_path)
+                events = []
+
+        # Legacy events go first, followed by anything already journaled. All of them end up in rotated segments
+        # (split where the clock went back, see append), so the current segment, read on startup, starts empty
+        events = [self._encode(event) for event in events + self.read()]
+        self.close()
+        start = 0
+        for index in range(1, len(events) + 1):
+            if index < len(events) and events[index][2:21] >= events[index - 1][2:21]:
+                continue
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w', encoding="utf-8") as tmp_file:
+                tmp_file.writelines(events[start:index])
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.replace(tmp_path, self.path)
+            self.rotate()
+            start = index
+        os.remove(legacy_path)
+        return True
+
+    def _read_lines(self, lines, path: str):
+        for line in lines:
+            if not line.endswith(b'\n'):
+                continue  # Torn last record
+            try:
+                yield json.loads(line)
+            except ValueError:
+                self.logger.warning('Skipping corrupted event record in %s.', path)
+
+    def read(self) -> list:
+        """ Reads the events of the current segment. A torn last line (interrupted write) is ignored
+        Returns:
+            list: List of events
+        """
+        events = []
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as journal_file:
+                events = list(self._read_lines(journal_file, self.path))
+        return events
+
+    def segments(self, archived: bool = False) -> list:
+        """ Rotated segments, oldest first
+        Args:
+            archived (bool, optional): Include compressed (archived) segments too. Defaults to False.
+        Returns:
+            list: Paths of the segments
+        """
+        if not os.path.isdir(self.segments_path):
+            return []
+        found = []
+        for name in os.listdir(self.segments_path):
+            match = _SEGMENT_RE.match(name)
+            if match and (archived or not match.group(3)):
+                found.append((match.group(1), int(match.group(2) or 0), name))
+        return [os.path.join(self.segments_path, name) for _, _, name in sorted(found)]
+
+    def iter_events(self, archived: bool = False):
+        """ Iterates over the events of all the segments (oldest first), ending with the current one
+        Args:
+            archived (bool, optional): Include compressed (archived) segments too. Defaults to False.
+        """
+        return self.iter_range(archived=archived)
+
+    @staticmethod
+    def _record_end(journal_file, end: int) -> int:
+        """ Position right after the last complete (newline terminated) record before "end"
+        """
+        if end == 0:
+            return 0
+        journal_file.seek(end - 1)
+        if journal_file.read(1) == b'\n':
+            return end
+        position = end
+        while position > 0:
+            chunk_start = max(0, position - 4096)
+            journal_file.seek(chunk_start)
+            chunk = journal_file.read(position - chunk_start)
+            newline = chunk.rfind(b'\n')
+            if newline >= 0:
+                return chunk_start + newline + 1
+            position = chunk_start
+        return 0
+
+    @staticmethod
+    def _line_start(journal_file, position: int) -> int:
+        """ Start of the first record at or after "position". Leaves the file positioned there
+        """
+        journal_file.seek(max(0, position - 1))
+        if position:
+            journal_file.readline()
+        return journal_file.tell()
+
+    def _bisect(self, journal_file, size: int, stamp: bytes) -> int:
+        """ Start of the first record whose timestamp is not older than "stamp" (size if there is none)
+        """
+        low, high = 0, size
+        while low < high:
+            middle = (low + high) // 2
+            self._line_start(journal_file, middle)
+            line = journal_file.readline()
+            if not line.endswith(b'\n') or line[2:21] >= stamp:
+                high = middle
+            else:
+                low = middle + 1
+        return min(self._line_start(journal_file, low), size)
+
+    @staticmethod
+    def _reverse_lines(journal_file, start: int, end: int, block_size: int = 8192):
+        """ Yields the records between "start" and "end" (which must be a record boundary) newest first
+        """
+        position = end
+        buffer = b''
+        stop = 0
+        while True:
+            newline = buffer.rfind(b'\n', 0, stop - 1) if stop > 1 else -1
+            if newline >= 0:
+                yield buffer[newline + 1:stop]
+                stop = newline + 1
+            elif position > start:
+                block_start = max(start, position - block_size)
+                journal_file.seek(block_start)
+                buffer = journal_file.read(position - block_start) + buffer[:stop]
+                stop = len(buffer)
+                position = block_start
+            else:
+                if stop:
+                    yield buffer[:stop]
+                break
+
+    @staticmethod
+    def _forward_lines(journal_file, start: int, end: int):
+        journal_file.seek(start)
+        position = start
+        while position < end:
+            line = journal_file.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line
+
+    def _last_record_stamp(self, journal_file):
+        """ Timestamp of the last complete record of the file (None if there is none)
+        """
+        size = self._record_end(journal_file, journal_file.seek(0, os.SEEK_END))
+        for line in self._reverse_lines(journal_file, 0, size):
+            return line[2:21]
+        return None
+
+    def _segment_bounds(self, archived: bool) -> list:
+        """ Segments (oldest first, ending with the current one) with the timestamps of their first and last events.
+            Not known (None) for compressed segments
+        """
+        bounds = []
+        for segment_path in self.segments(archived) + ([self.path] if os.path.exists(self.path) else []):
+            first = last = None
+            if not segment_path.endswith('.gz'):
+                with open(segment_path, 'rb') as segment_file:
+                    first_line = segment_file.readline()
+                    if first_line.endswith(b'\n'):
+                        first = first_line[2:21]
+                    last = self._last_record_stamp(segment_file)
+            bounds.append((segment_path, first, last))
+        return bounds
+
+    def _iter_segment(self, segment_path: str, since: bytes, until: bytes, reverse: bool):
+        if segment_path.endswith('.gz'):
+            # Archived segments cannot be bisected: decompress and filter
+            with gzip.open(segment_path, 'rb') as segment_file:
+                events = [event for event in self._read_lines(segment_file, segment_path)
+                          if (since is None or event[0].encode() >= since) and
+                             (until is None or event[0].encode() < until)]
+            yield from reversed(events) if reverse else events
+            return
+
+        with open(segment_path, 'rb') as segment_file:
+            size = self._record_end(segment_file, segment_file.seek(0, os.SEEK_END))
+            start = self._bisect(segment_file, size, since) if since else 0
+            end = self._bisect(segment_file, size, until) if until else size
+            if start >= end:
+                return
+            if reverse:
+                lines = self._reverse_lines(segment_file, start, end)
+            else:
+                lines = self._forward_lines(segment_file, start, end)
+            yield from self._read_lines(lines, segment_path)
+
+    def iter_range(self, since: str = None, until: str = None, reverse: bool = False, archived: bool = False):
+        """ Iterates over the events in a time range. Only the segments overlapping the range are opened, and
+            inside them the start of the range is bisected, so the cost depends on the events returned.
+        Args:
+            since (str, optional): Only events at or after this time ('%Y-%m-%d %H:%M:%S'). Defaults to None.
+            until (str, optional): Only events before this time ('%Y-%m-%d %H:%M:%S'). Defaults to None.
+            reverse (bool, optional): Newest events first. Defaults to False.
+            archived (bool, optional): Include compressed (archived) segments too. Defaults to False.
+        """
+        since = since.encode() if since else None
+        until = until.encode() if until else None
+
+        selected = []
+        for segment_path, first, last in self._segment_bounds(archived):
+            if until is not None and first is not None and first >= until:
+                continue
+            if since is not None and last is not None and last < since:
+                continue
+            selected.append(segment_path)
+
+        if reverse:
+            selected.reverse()
+        for segment_path in selected:
+            yield from self._iter_segment(segment_path, since, until, reverse)
+
+    def _recover(self):
+        """ Truncates a torn last record left by an interrupted write, so that new records start on a clean line
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as journal_file:
+            size = journal_file.seek(0, os.SEEK_END)
+            record_end = self._record_end(journal_file, size)
+            if record_end != size:
+                journal_file.truncate(record_end)
+                self.logger.warning('Truncated torn record at the end of %s.', self.path)
+
+    def _sync(self):
+        if self.fsync == FSYNC_ALWAYS:
+            os.fsync(self._file.fileno())
+        elif self.fsync == FSYNC_INTERVAL:
+            now = time.monotonic()
+            if now - self._last_fsync >= self.fsync_interval:
+                os.fsync(self._file.fileno())
+                self._last_fsync = now
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)  # The folder may be gone (i.e. cleaned up)
+        self._recover()
+        self._file = open(self.path, 'a', encoding="utf-8")  # pylint: disable=consider-using-with
+        self._size = self._file.tell()
+        self._first_time = None
+        self._last_stamp = None
+        if self._size:
+            with open(self.path, 'rb') as journal_file:
+                first_line = journal_file.readline()
+                self._last_stamp = self._last_record_stamp(journal_file)
+            try:
+                self._first_time = datetime.strptime(json.loads(first_line)[0], '%Y-%m-%d %H:%M:%S')
+            except (ValueError, IndexError, TypeError):
+                self._first_time = None
+
+    def _moved(self) -> bool:
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def _should_rotate(self, event_time: datetime) -> bool:
+        if self._size == 0:
+            return False
+        if self.segment_max_bytes and self._size >= self.segment_max_bytes:
+            return True
+        return bool(self.segment_max_days and self._first_time and
+                    event_time - self._first_time >= timedelta(days=self.segment_max_days))
+
+    def rotate(self):
+        """ Moves the current segment into the segments folder. Next event will start a new current segment
+        """
+        self.close()
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return
+        with open(self.path, 'rb') as journal_file:
+            first_line = journal_file.readline()
+        try:
+            stamp = datetime.strptime(json.loads(first_line)[0], '%Y-%m-%d %H:%M:%S').strftime('%Y%m%d%H%M%S')
+        except (ValueError, IndexError, TypeError):
+            stamp = datetime.now().strftime('%Y%m%d%H%M%S')
+
+        os.makedirs(self.segments_path, exist_ok=True)
+        counter = 0
+        segments = self.segments(archived=True)
+        if segments:
+            match = _SEGMENT_RE.match(os.path.basename(segments[-1]))
+            if stamp <= match.group(1):  # Clock gone back (or same second): sorted after the previous segment
+                stamp, counter = match.group(1), int(match.group(2) or 0) + 1
+        name = f'events-{stamp}-{counter}.jsonl' if counter else f'events-{stamp}.jsonl'
+        while os.path.exists(os.path.join(self.segments_path, name)) or \
+              os.path.exists(os.path.join(self.segments_path, f'{name}.gz')):
+            counter += 1
+            name = f'events-{stamp}-{counter}.jsonl'
+        os.replace(self.path, os.path.join(self.segments_path, name))
+
+    def append(self, event) -> bool:
+        """ Appends a single event to the journal, rotating the current segment first if needed
+        Args:
+            event (tuple): Event to be stored
+        Returns:
+            bool: True if the current segment was rotated before appending the event
+        """
+        if self._file is not None and self._moved():  # Rotated or removed by another process (i.e. the CLI)
+            self.close()
+        if self._file is None:
+            self._open()
+        else:
+            size = os.fstat(self._file.fileno()).st_size
+            if size != self._size:  # Appended by another process: its last event is the one to compare with
+                self._size = size
+                with open(self.path, 'rb') as journal_file:
+                    self._last_stamp = self._last_record_stamp(journal_file)
+
+        record = self._encode(event)
+        stamp = record[2:21].encode()
+        rotated = False
+        # Clock gone back: a new segment, so that the records of every segment stay in order (see _bisect)
+        backwards = self._last_stamp is not None and stamp < self._last_stamp
+        if backwards or self.segment_max_bytes or self.segment_max_days:
+            try:
+                event_time = datetime.strptime(event[0], '%Y-%m-%d %H:%M:%S')
+            except (ValueError, TypeError):
+                event_time = datetime.now()
+            if backwards or self._should_rotate(event_time):
+                self.rotate()
+                self._open()
+                rotated = True
+            if self._first_time is None:
+                self._first_time = event_time
+
+        self._file.write(record)
+        self._file.flush()
+        self._last_stamp = stamp
+        self._size += len(record.encode("utf-8"))
+        self._sync()
+        return rotated
+
+    def compact(self, hot_days: int, archive_days: int = 0, now: datetime = None) -> int:
+        """ Applies the retention policy to the rotated segments: segments not modified in the last "hot_days" days
+            are compressed, and compressed segments older than "archive_days" are deleted.
+            Intended to run outside of the watering critical path.
+        Args:
+            hot_days (int): Days a rotated segment is kept uncompressed. 0 disables compression.
+            archive_days (int, optional): Days a compressed segment is kept. 0 keeps them forever.
+            now (datetime, optional): Reference time. Defaults to now.
+        Returns:
+            int: Number of segments compressed or deleted
+        """
+        now = (now or datetime.now()).timestamp()
+        changes = 0
+        for segment_path in self.segments(archived=True):
+            age_days = (now - os.path.getmtime(segment_path)) / 86400
+            if segment_path.endswith('.gz'):
+                if archive_days and age_days > archive_days:
+                    os.remove(segment_path)
+                    changes += 1
+            elif hot_days and age_days > hot_days:
+                archive_path = f'{segment_path}.gz'
+                tmp_path = f'{archive_path}.tmp'
+                with open(segment_path, 'rb') as segment_file, gzip.open(tmp_path, 'wb') as archive_file:
+                    shutil.copyfileobj(segment_file, archive_file)
+                shutil.copystat(segment_path, tmp_path)  # Keep the age of the segment
+                os.replace(tmp_path, archive_path)
+                os.remove(segment_path)
+                changes += 1
+        return changes
+
+    def close(self):
+        """ Flushes and closes the journal file
+        """
+        if self._file is not None:
+            if self.fsync != FSYNC_NEVER:
+                os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
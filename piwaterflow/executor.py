@@ -0,0 +1,214 @@
+""" Executor of the watering (programs and forced valves) in a worker thread, so that the loop is not blocked while the
+    valves are open: it keeps recalculating the next program, touching the token and registering stop requests.
+    The state machine is persisted in the state store (see state_store), so that other processes (cron loops,
+    frontends) can see it, and it is committed with the loop tick that changed it:
+        idle -> running_program / running_valve -> (stopping) -> idle
+    The worker updates a heartbeat while running. The supervisor (the loop) considers the execution stuck when the
+    heartbeat gets too old, or when the process that owns it died, and takes it over.
+"""
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+IDLE = 'idle'
+RUNNING_PROGRAM = 'running_program'
+RUNNING_VALVE = 'running_valve'
+STOPPING = 'stopping'
+
+
+def _pid_alive(pid: int) -> bool:
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class ProgramExecutor():
+    """ Runs one program or valve at a time in a worker thread, with its state persisted in the state store
+    """
+    def __init__(self, store, stuck_timeout: float = 300, on_finish=None):
+        """__init__ of the class
+        Args:
+            store (FileStateStore or SqliteStateStore): Store where the state is persisted
+            stuck_timeout (float, optional): Seconds without heartbeat to consider the execution stuck.
+                                             Defaults to 300.
+            on_finish (callable, optional): Called by the worker once the execution finished. Defaults to None.
+        """
+        self.store = store
+        self.stuck_timeout = stuck_timeout
+        self.on_finish = on_finish
+        self.logger = logging.getLogger()
+        self.error = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._run_id = None
+
+    def _read(self) -> dict:
+        return self.store.read_execution() or {'state': IDLE}
+
+    def _write(self, state: dict):
+        self.store.write_execution(state)
+
+    @contextmanager
+    def _locked(self):
+        """ Serializes the changes of the state, in a transaction of the store. Always the store first: a loop tick
+            holds its transaction while starting or stopping the execution
+        """
+        with self.store.transaction(), self._lock:
+            yield
+
+    def get_state(self) -> dict:
+        """ Returns the state of the execution, as seen by any process
+        Returns:
+            dict: state, and while running: type, name, pid, started, heartbeat and open valves
+        """
+        return self._read()
+
+    @property
+    def busy(self) -> bool:
+        """ Returns if some execution (of this or another process) is in progress
+        Returns:
+            bool: True if not idle
+        """
+        return self._read()['state'] != IDLE
+
+    def start(self, type_exec: str, name: str, job) -> bool:
+        """ Starts an execution in the worker thread
+        Args:
+            type_exec (str): Can be "program" or "valve"
+            name (str): Name of the program or valve
+            job (callable): Function that executes it
+        Returns:
+            bool: False if there is already an execution in progress
+        """
+        with self._locked():
+            if self.busy:
+                return False
+            now = time.time()
+            self._run_id = f'{os.getpid()}-{now}'
+            self.error = None
+            self._write({'state': RUNNING_PROGRAM if type_exec == 'program' else RUNNING_VALVE,
+                         'type': type_exec, 'name': name, 'pid': os.getpid(), 'run_id': self._run_id,
+                         'started': now, 'heartbeat': now, 'valves': []})
+            self._thread = threading.Thread(target=self._run, args=(self._run_id, job), name='waterflow-executor',
+                                            daemon=True)
+            self._thread.start()
+        return True
+
+    def _run(self, run_id: str, job):
+        try:
+            job()
+        except Exception as ex:  # pylint: disable=broad-except
+            self.logger.error('Exception executing: %s', str(ex), exc_info=True)
+            self.error = ex
+        finally:
+            with self._locked():
+                if self._read().get('run_id') == run_id:
+                    self._write({'state': IDLE})
+            if self.on_finish:
+                self.on_finish()
+
+    def heartbeat(self, **info) -> bool:
+        """ Called by the worker while running, to show it is making progress
+        Args:
+            info: Extra state to be published (i.e. valves=["main"])
+        Returns:
+            bool: False if the execution must end (stop requested, or taken over by the supervisor)
+        """
+        if self._run_id is None:
+            return True  # Not running in the worker
+        with self._locked():
+            state = self._read()
+            if state.get('run_id') != self._run_id:
+                return False
+            state['heartbeat'] = time.time()
+            state.update(info)
+            self._write(state)
+            return state['state'] != STOPPING
+
+    def advance(self, type_exec: str, name: str) -> bool:
+        """ Moves the execution to its next item, when several forced commands are executed in a row
+        Args:
+            type_exec (str): Can be "program" or "valve"
+            name (str): Name of the program or valve
+        Returns:
+            bool: False if the execution must end (stop requested, or taken over by the supervisor)
+        """
+        if self._run_id is None:
+            return True  # Not running in the worker
+        with self._locked():
+            state = self._read()
+            if state.get('run_id') != self._run_id or state['state'] == STOPPING:
+                return False
+            state.update({'state': RUNNING_PROGRAM if type_exec == 'program' else RUNNING_VALVE,
+                          'type': type_exec, 'name': name, 'heartbeat': time.time()})
+            self._write(state)
+            return True
+
+    def stopping(self) -> bool:
+        """ Returns if the execution of the worker must end
+        Returns:
+            bool: True if a stop was requested, or the execution was taken over by the supervisor
+        """
+        if self._run_id is None:
+            return False
+        state = self._read()
+        return state.get('run_id') != self._run_id or state['state'] == STOPPING
+
+    def request_stop(self) -> bool:
+        """ Moves a running execution to the stopping state
+        Returns:
+            bool: True if there was an execution running
+        """
+        with self._locked():
+            state = self._read()
+            if state['state'] not in (RUNNING_PROGRAM, RUNNING_VALVE):
+                return False
+            state['state'] = STOPPING
+            self._write(state)
+            return True
+
+    def is_stuck(self) -> bool:
+        """ Returns if the execution in progress stopped making progress: heartbeat too old, or its process or worker
+            thread is gone
+        Returns:
+            bool: True if stuck
+        """
+        state = self._read()
+        if state['state'] == IDLE:
+            return False
+        if time.time() - state.get('heartbeat', 0) > self.stuck_timeout:
+            return True
+        if state.get('pid') == os.getpid():
+            return state.get('run_id') != self._run_id or not (self._thread and self._thread.is_alive())
+        return not _pid_alive(state.get('pid'))
+
+    def reset(self) -> dict:
+        """ Takes over the execution in progress (supervisor), leaving the executor idle
+        Returns:
+            dict: State of the execution taken over
+        """
+        with self._locked():
+            state = self._read()
+            self._write({'state': IDLE})
+        return state
+
+    def wait(self, timeout: float = None) -> bool:
+        """ Waits for the execution of this process to finish
+        Args:
+            timeout (float, optional): Max seconds to wait. Defaults to None (forever).
+        Returns:
+            bool: True if finished
+        """
+        thread = self._thread
+        if thread:
+            thread.join(timeout)
+            return not thread.is_alive()
+        return True
@@ -0,0 +1,194 @@
+""" Timing instrumentation of the phases of the waterflow (config load, events load, lock, gpio setup...).
+    Durations are aggregated into fixed-bucket histograms, persisted in a json file, so that the timings of many short
+    lived processes (cron) add up. The read-modify-write of the file is serialized among the processes with a kernel
+    lock next to it. When disabled, spans are a shared no-op context manager.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+try:
+    from contextlib import nullcontext
+except ImportError:  # Python < 3.7
+    class nullcontext():  # pylint: disable=invalid-name
+        """ Context manager that does nothing (contextlib.nullcontext of Python 3.7)
+        """
+        def __init__(self, enter_result=None):
+            self.enter_result = enter_result
+
+        def __enter__(self):
+            return self.enter_result
+
+        def __exit__(self, *exc_info):
+            return False
+
+from .process_lock import ProcessLock
+
+# Upper bounds (in milliseconds) of the histogram buckets. Durations above the last one go to an overflow bucket
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+_NULL_SPAN = nullcontext()
+
+_LOCK_TIMEOUT = 5  # Max seconds to wait for another process flushing
+
+
+class _Span():
+    """ Measures the duration of a "with" block, and records it in its phase
+    """
+    __slots__ = ('_instrumentation', '_phase', '_start')
+
+    def __init__(self, instrumentation, phase: str):
+        self._instrumentation = instrumentation
+        self._phase = phase
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self._instrumentation.record(self._phase, time.perf_counter() - self._start)
+        return False
+
+
+class Instrumentation():
+    """ Histograms of phase durations, kept in memory and merged into a json file on flush
+    """
+    def __init__(self, path: str, enabled: bool = True, on_flush=None):
+        """__init__ of the class
+        Args:
+            path (str): File where the histograms are persisted
+            enabled (bool, optional): If false, nothing is measured nor written. Defaults to True.
+            on_flush (callable, optional): Called on flush with the list of (phase, seconds) recorded since the
+                                           previous one (i.e. to emit them as metrics). Defaults to None.
+        """
+        self.path = path
+        self.enabled = enabled
+        self.on_flush = on_flush
+        self.logger = logging.getLogger()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._samples = []
+        self._file_lock = threading.Lock()
+        self._process_lock = ProcessLock(f'{path}.lock') if path else None
+
+    def span(self, phase: str):
+        """ Context manager that measures the duration of its block
+        Args:
+            phase (str): Name of the phase
+        Returns:
+            context manager: Span (or a no-op one, if disabled)
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, phase)
+
+    @staticmethod
+    def _new_histogram() -> dict:
+        return {'count': 0, 'sum_ms': 0.0, 'max_ms': 0.0, 'buckets': [0] * (len(BUCKETS_MS) + 1)}
+
+    def record(self, phase: str, seconds: float):
+        """ Adds a duration to the histogram of a phase
+        Args:
+            phase (str): Name of the phase
+            seconds (float): Duration
+        """
+        if not self.enabled:
+            return
+        duration_ms = seconds * 1000
+        with self._lock:  # Spans come from the loop and from the executor thread
+            histogram = self._pending.get(phase)
+            if histogram is None:
+                histogram = self._pending[phase] = self._new_histogram()
+            histogram['count'] += 1
+            histogram['sum_ms'] += duration_ms
+            histogram['max_ms'] = max(histogram['max_ms'], duration_ms)
+            histogram['buckets'][bisect_left(BUCKETS_MS, duration_ms)] += 1
+            self._samples.append((phase, seconds))
+
+    @contextmanager
+    def _file_locked(self):
+        """ Serializes the changes of the file among the threads and the processes. Runs anyway if the lock could not
+            be taken in time
+        """
+        with self._file_lock:
+            taken = self._process_lock.acquire(timeout=_LOCK_TIMEOUT)
+            try:
+                yield
+            finally:
+                if taken:
+                    self._process_lock.release()
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path, 'r', encoding="utf-8") as timings_file:
+                data = json.load(timings_file)
+        except (OSError, ValueError):
+            return {}
+        if data.get('buckets_ms') != list(BUCKETS_MS):
+            return {}  # Written with other buckets: cannot be merged
+        return data.get('phases', {})
+
+    @staticmethod
+    def _merge(phases: dict, pending: dict) -> dict:
+        merged = {phase: dict(histogram, buckets=list(histogram['buckets'])) for phase, histogram in phases.items()}
+        for phase, histogram in pending.items():
+            total = merged.setdefault(phase, Instrumentation._new_histogram())
+            total['count'] += histogram['count']
+            total['sum_ms'] += histogram['sum_ms']
+            total['max_ms'] = max(total['max_ms'], histogram['max_ms'])
+            total['buckets'] = [count + new for count, new in zip(total['buckets'], histogram['buckets'])]
+        return merged
+
+    def flush(self):
+        """ Merges the durations recorded since the previous flush into the persisted histograms
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            samples, self._samples = self._samples, []
+        if not pending:
+            return
+        try:
+            with self._file_locked():
+                phases = self._merge(self._read(), pending)
+                tmp_path = f'{self.path}.tmp'
+                with open(tmp_path, 'w', encoding="utf-8") as timings_file:
+                    json.dump({'buckets_ms': list(BUCKETS_MS), 'phases': phases}, timings_file)
+                os.replace(tmp_path, self.path)
+        except OSError as ex:
+            self.logger.warning('Timings could not be persisted: %s', str(ex))
+        if self.on_flush:
+            self.on_flush(samples)
+
+    def histograms(self) -> dict:
+        """ Returns the persisted histograms, plus the durations not flushed yet
+        Returns:
+            dict: Per phase: count, sum_ms, max_ms, mean_ms, and buckets as a list of (upper bound ms, count).
+                  The upper bound of the last bucket is None (overflow)
+        """
+        with self._lock:
+            phases = self._merge(self._read() if self.enabled else {}, self._pending)
+        result = {}
+        for phase, histogram in sorted(phases.items()):
+            result[phase] = {'count': histogram['count'],
+                             'sum_ms': histogram['sum_ms'],
+                             'max_ms': histogram['max_ms'],
+                             'mean_ms': histogram['sum_ms'] / histogram['count'] if histogram['count'] else 0,
+                             'buckets': list(zip(list(BUCKETS_MS) + [None], histogram['buckets']))}
+        return result
+
+    def reset(self):
+        """ Discards all the histograms
+        """
+        with self._lock:
+            self._pending = {}
+            self._samples = []
+        if self.path:
+            with self._file_locked():
+                if os.path.exists(self.path):
+                    os.remove(self.path)
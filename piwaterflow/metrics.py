@@ -0,0 +1,221 @@
+""" Asynchronous metrics pipeline.
+    Points are queued without blocking the caller, and a background thread inserts them in batches. When the backend is
+    not available the points are spilled to a local spool file, and replayed once it recovers (also by later
+    processes), so valve timing never depends on the database latency and points are not lost between cron runs.
+    The spool is shared by the processes: appends and moves of the spool file are serialized with a lock file, and a
+    single process replays it at a time.
+"""
+import os
+import json
+import queue
+import atexit
+import shutil
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from .circuit_breaker import CircuitBreaker
+from .process_lock import ProcessLock
+
+_STOP = object()
+_LOCK_TIMEOUT = 5  # Max seconds to wait for another process appending to the spool or moving it
+
+
+class MetricsEmitter():
+    """ Bounded in-memory queue of points, flushed in batches by a background thread, with an on-disk spool
+    """
+    def __init__(self, connect, spool_path: str, queue_size: int = 1000, batch_size: int = 100,
+                 flush_interval: float = 2, breaker: CircuitBreaker = None):
+        """__init__ of the class
+        Args:
+            connect (callable): Returns the connection used to insert the points (DBConn)
+            spool_path (str): File where the points are kept while the backend is not available. Its lock files are
+                              "<spool_path>.lock" and "<spool_path>.replay.lock"
+            queue_size (int, optional): Max points waiting in memory. Extra points go to the spool. Defaults to 1000.
+            batch_size (int, optional): Max points inserted at once. Defaults to 100.
+            flush_interval (float, optional): Max seconds a point waits in memory. Defaults to 2.
+            breaker (CircuitBreaker, optional): Skips the backend while it is known to be down. Defaults to None.
+        """
+        self._connect = connect
+        self.breaker = breaker
+        self.spool_path = spool_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.logger = logging.getLogger()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._spool_lock = threading.Lock()
+        self._spool_process_lock = ProcessLock(f'{spool_path}.lock')
+        self._replay_lock = ProcessLock(f'{spool_path}.replay.lock')  # Held for the whole replay
+        self._in_flight = []
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def emit(self, table: str, point: dict):
+        """ Queues a point. Never blocks
+        Args:
+            table (str): Table (measurement) of the point
+            point (dict): Point with "tags" and "fields". Time is set now if not given
+        """
+        point = dict(point)
+        if not point.get('time'):
+            point['time'] = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        self._start()
+        try:
+            self._queue.put_nowait((table, point))
+        except queue.Full:
+            self._spool([(table, point)])
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='waterflow-metrics', daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def _run(self):
+        self._replay_spool()
+        running = True
+        while running:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = []
+            while item is not None:
+                if item is _STOP:
+                    running = False
+                else:
+                    batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    item = None
+            if batch:
+                self._flush(batch)
+
+    def _insert_batch(self, batch: list):
+        conn = self._connect()
+        tables = {}
+        for table, point in batch:
+            tables.setdefault(table, []).append(point)
+        for table, points in tables.items():
+            conn.insert(table, points)
+
+    def _insert(self, batch: list):
+        if self.breaker:
+            self.breaker.call(self._insert_batch, batch)
+        else:
+            self._insert_batch(batch)
+
+    def _flush(self, batch: list) -> bool:
+        self._in_flight = batch
+        try:
+            self._insert(batch)
+        except Exception as ex:  # pylint: disable=broad-except
+            self.logger.warning('Metrics backend not available (%s). Spooling %s points.', str(ex), len(batch))
+            self._spool(batch)
+            return False
+        finally:
+            self._in_flight = []
+        self._replay_spool()
+        return True
+
+    @contextmanager
+    def _spool_locked(self):
+        """ Serializes the appends and moves of the spool file among the threads and the processes. Runs anyway if
+            the lock could not be taken in time
+        """
+        with self._spool_lock:
+            taken = self._spool_process_lock.acquire(timeout=_LOCK_TIMEOUT)
+            try:
+                yield
+            finally:
+                if taken:
+                    self._spool_process_lock.release()
+
+    def _spool(self, items: list):
+        try:
+            with self._spool_locked():
+                with open(self.spool_path, 'a', encoding="utf-8") as spool_file:
+                    for table, point in items:
+                        spool_file.write(json.dumps({'table': table, 'point': point}) + '\n')
+        except OSError as ex:
+            self.logger.error('Could not spool %s metric points (%s).', len(items), str(ex))
+
+    def _replay_spool(self):
+        """ Inserts the spooled points. Points are timestamped, so a replayed point that was already inserted is
+            just overwritten by the backend. Skipped while the circuit is open, or another process replays them
+        """
+        try:
+            if self.breaker and not self.breaker.allow():
+                return  # Backend known to be down: the spool is not even read
+            if not self._replay_lock.acquire():
+                return  # Another process is replaying them
+            try:
+                self._replay()
+            finally:
+                self._replay_lock.release()
+        except OSError as ex:  # Never kills the flusher thread: the points stay in the spool
+            self.logger.warning('Could not replay the spooled metric points (%s).', str(ex))
+
+    def _replay(self):
+        replay_path = f'{self.spool_path}.replay'
+        with self._spool_locked():
+            if os.path.exists(self.spool_path):
+                if os.path.exists(replay_path):
+                    # Left by a process that died while replaying
+                    with open(self.spool_path, 'rb') as spool_file, open(replay_path, 'ab') as replay_file:
+                        shutil.copyfileobj(spool_file, replay_file)
+                    os.remove(self.spool_path)
+                else:
+                    os.replace(self.spool_path, replay_path)
+            elif not os.path.exists(replay_path):
+                return
+
+        items = []
+        with open(replay_path, 'r', encoding="utf-8") as replay_file:
+            for line in replay_file:
+                try:
+                    record = json.loads(line)
+                    items.append((record['table'], record['point']))
+                except (ValueError, KeyError):
+                    continue  # Torn record
+        sent = 0
+        try:
+            while sent < len(items):
+                self._insert(items[sent:sent + self.batch_size])
+                sent += self.batch_size
+            self.logger.info('Replayed %s spooled metric points.', len(items))
+        except Exception as ex:  # pylint: disable=broad-except
+            self.logger.warning('Metrics backend not available (%s). Keeping spooled points.', str(ex))
+            self._spool(items[sent:])
+        os.remove(replay_path)
+
+    def close(self, timeout: float = 5):
+        """ Flushes the queued points, waiting up to "timeout" seconds. Points not sent by then are spooled
+        Args:
+            timeout (float, optional): Max seconds to wait for the backend. Defaults to 5.
+        """
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            # Backend hung: keep everything not confirmed yet for the next process
+            pending = list(self._in_flight)
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not _STOP:
+                    pending.append(item)
+            self._spool(pending)
+        self._thread = None
+        atexit.unregister(self.close)
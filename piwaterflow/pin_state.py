@@ -0,0 +1,143 @@
+""" Shadow register of the relays: keeps the desired and the applied state of every relay channel, so that the
+    hardware is only touched for actual changes.
+    Pins are declared without touching the hardware, and set up lazily when the first change is applied (an idle loop
+    tick never sets up nor cleans up the relays). Changes made inside batch() are sent at once to the relay driver
+    (see relay_drivers), that writes them in a single call or bus transaction. The applied state is cheap to read,
+    for status queries.
+"""
+import threading
+from contextlib import contextmanager
+
+try:
+    from RPi import GPIO
+except (ModuleNotFoundError, ImportError, RuntimeError):
+    from fake_rpigpio.RPi import GPIO
+
+
+class PinState():
+    """ Desired and applied state of the output pins, applied to the relay driver as diffs
+    """
+    def __init__(self, driver):
+        """__init__ of the class
+        Args:
+            driver (GPIODriver, MCP23017Driver, ShiftRegisterDriver or SimulatedRelayDriver): Relay driver
+        """
+        self.driver = driver
+        self._lock = threading.RLock()  # Pins are driven by the loop and by the executor thread
+        self._outputs = set()
+        self._inputs = set()
+        self._desired = {}
+        self._applied = {}
+        self._dirty = set()  # Pins whose desired state may differ from the applied one
+        self._ready = False
+        self._batch_depth = 0
+
+    def declare(self, outputs, inputs=()):
+        """ Declares the pins, without touching the hardware. Outputs start LOW
+        Args:
+            outputs (iterable): Output pins (relays)
+            inputs (iterable, optional): Input pins. Defaults to ().
+        """
+        with self._lock:
+            for pin in outputs:
+                if pin not in self._outputs:
+                    self._outputs.add(pin)
+                    self._desired.setdefault(pin, GPIO.LOW)
+            self._inputs.update(inputs)
+
+    @property
+    def ready(self) -> bool:
+        """ Returns if the hardware is set up
+        Returns:
+            bool: True after prepare, until release
+        """
+        return self._ready
+
+    def prepare(self):
+        """ Sets up the hardware (numbering mode, and every declared pin in its desired state). Done once, until
+            release: later changes only apply diffs
+        """
+        with self._lock:
+            if self._ready:
+                return
+            initial = {pin: self._desired[pin] for pin in self._outputs}
+            self.driver.setup(sorted(self._outputs), initial, sorted(self._inputs))
+            self._applied.update(initial)
+            self._ready = True
+
+    def set(self, pin: int, level: int):
+        """ Changes the desired state of an output pin. Applied right away, or at the end of the batch
+        Args:
+            pin (int): Output pin
+            level (int): GPIO.HIGH or GPIO.LOW
+        """
+        with self._lock:
+            if pin not in self._outputs:
+                self.declare((pin,))
+            self._desired[pin] = level
+            self._dirty.add(pin)
+            if not self._batch_depth:
+                self.apply()
+
+    @contextmanager
+    def batch(self):
+        """ Groups the changes of the block, applied together when it ends
+        """
+        with self._lock:
+            self._batch_depth += 1
+            try:
+                yield self
+            finally:
+                self._batch_depth -= 1
+                if not self._batch_depth:
+                    self.apply()
+
+    def apply(self) -> int:
+        """ Applies the pins whose desired state differs from the applied one
+        Returns:
+            int: Pins changed
+        """
+        with self._lock:
+            if not self._ready:
+                self.prepare()
+            desired = self._desired
+            changes = [(pin, desired[pin]) for pin in sorted(self._dirty) if self._applied.get(pin) != desired[pin]]
+            self._dirty.clear()
+            if changes:
+                self.driver.write(dict(changes))
+            self._applied.update(changes)
+            return len(changes)
+
+    def reset(self):
+        """ Drives every output LOW, whatever the applied state is believed to be (i.e. after another thread or
+            process crashed with relays on)
+        """
+        with self._lock:
+            self._applied.clear()
+            self._ready = False
+            for pin in self._outputs:
+                self._desired[pin] = GPIO.LOW
+            self._dirty.update(self._outputs)
+            self.apply()
+
+    def release(self):
+        """ Drives every output LOW, and frees the pins (i.e. GPIO cleanup). Nothing is done if they were never set up
+        """
+        with self._lock:
+            if not self._ready:
+                return
+            with self.batch():
+                for pin in self._outputs:
+                    self.set(pin, GPIO.LOW)
+            self.driver.release()
+            self._applied.clear()
+            self._ready = False
+
+    def state(self, pin: int):
+        """ Returns the applied state of a pin, without touching the hardware
+        Args:
+            pin (int): Output pin
+        Returns:
+            int: GPIO.HIGH or GPIO.LOW. None if it is not set up
+        """
+        return self._applied.get(pin)
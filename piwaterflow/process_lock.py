@@ -0,0 +1,145 @@
+""" Advisory lock between processes, with fcntl.flock: the kernel releases it when the owner process dies, so a crashed
+    loop never blocks the following ones until some expiry time.
+    The exclusive owner writes its metadata (pid, acquired time and heartbeat) in the lock file, and clears it when it
+    releases the lock. Metadata found by the next owner means that the previous one died holding it (stale lock).
+    Readers (status, log) take it in shared mode: they only wait for a loop deciding, never for a watering run (it
+    happens outside of the lock, see executor).
+"""
+import os
+import json
+import time
+import fcntl
+import threading
+from contextlib import contextmanager
+
+_POLL_INTERVAL = 0.05  # Seconds between attempts while waiting for the lock
+
+
+class ProcessLock():
+    """ Exclusive/shared lock on a file, released by the kernel when the owner dies
+    """
+    def __init__(self, path: str):
+        """__init__ of the class
+        Args:
+            path (str): Lock file. Created if it does not exist
+        """
+        self.path = path
+        self.stale_owner = None
+        self._fd = None
+        self._thread_lock = threading.Lock()
+
+    def __del__(self):
+        if self._fd is not None:
+            os.close(self._fd)
+
+    def _open(self) -> int:
+        return os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    @staticmethod
+    def _flock(fd: int, operation: int, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(fd, operation | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    return False
+                time.sleep(_POLL_INTERVAL)
+
+    @staticmethod
+    def _read_owner(fd: int):
+        content = os.pread(fd, 4096, 0)
+        if not content:
+            return None
+        try:
+            return json.loads(content)
+        except ValueError:
+            return {}  # Owner died while writing it
+
+    def _write_owner(self, owner: dict):
+        data = json.dumps(owner).encode()
+        os.ftruncate(self._fd, 0)
+        os.pwrite(self._fd, data, 0)
+
+    @property
+    def locked(self) -> bool:
+        """ Returns if this instance holds the exclusive lock
+        Returns:
+            bool: True if held
+        """
+        return self._fd is not None
+
+    def acquire(self, timeout: float = 0) -> bool:
+        """ Takes the lock in exclusive mode. If the previous owner died holding it, its metadata is left in
+            stale_owner
+        Args:
+            timeout (float, optional): Max seconds to wait for it. Defaults to 0 (do not wait).
+        Returns:
+            bool: If taken. False if held by another process, or already by this instance
+        """
+        with self._thread_lock:
+            if self._fd is not None:
+                return False
+            fd = self._open()
+            if not self._flock(fd, fcntl.LOCK_EX, timeout):
+                os.close(fd)
+                return False
+            self.stale_owner = self._read_owner(fd)
+            self._fd = fd
+            now = time.time()
+            self._write_owner({'pid': os.getpid(), 'acquired': now, 'heartbeat': now})
+            return True
+
+    def heartbeat(self):
+        """ Updates the heartbeat of the metadata, to show progress to the processes waiting for the lock
+        """
+        with self._thread_lock:
+            if self._fd is not None:
+                owner = self._read_owner(self._fd) or {'pid': os.getpid()}
+                owner['heartbeat'] = time.time()
+                self._write_owner(owner)
+
+    def release(self) -> bool:
+        """ Clears the metadata and releases the exclusive lock
+        Returns:
+            bool: False if it was not held
+        """
+        with self._thread_lock:
+            if self._fd is None:
+                return False
+            os.ftruncate(self._fd, 0)
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+            return True
+
+    def owner(self):
+        """ Returns the metadata of the process holding the exclusive lock
+        Returns:
+            dict: pid, acquired and heartbeat (epoch times). None if not held
+        """
+        if self._fd is not None:
+            return self._read_owner(self._fd)
+        fd = self._open()
+        try:
+            if self._flock(fd, fcntl.LOCK_SH, 0):
+                return None  # Not held (metadata, if any, is stale)
+            return self._read_owner(fd)
+        finally:
+            os.close(fd)
+
+    @contextmanager
+    def shared(self, timeout: float = 5):
+        """ Takes the lock in shared mode for the block: many readers at once, but not while it is held exclusively.
+            The block runs anyway if it could not be taken in time
+        Args:
+            timeout (float, optional): Max seconds to wait for it. Defaults to 5.
+        Returns:
+            context manager: Yields if the shared lock was taken
+        """
+        fd = self._open()  # Own file description: never converts the exclusive lock of this same instance
+        try:
+            yield self._flock(fd, fcntl.LOCK_SH, timeout)
+        finally:
+            os.close(fd)
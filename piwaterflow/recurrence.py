@@ -0,0 +1,232 @@
+""" Recurrence rules of the programs, and the engine that answers "next run after T" for all of them.
+    A rule combines start times of the day, weekdays, every N days (from an anchor date) and a season (date range).
+    Weekdays and "every N days" are periodic, so each rule precomputes a table over one period (lcm(7, N) days) with
+    the distance to the next allowed day, and the next occurrence is found without scanning day by day.
+    Programs with the same calendar share a rule, and the rules are merged with a heap.
+"""
+import heapq
+import threading
+from math import gcd
+from bisect import bisect_right
+from datetime import date, datetime, time, timedelta
+
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+_DEFAULT_ANCHOR = date(2000, 1, 1)
+
+
+def _parse_minutes(start_time) -> int:
+    if isinstance(start_time, str):
+        start_time = datetime.strptime(start_time, '%H:%M')
+    return start_time.hour * 60 + start_time.minute
+
+
+def _parse_weekdays(weekdays) -> frozenset:
+    if not weekdays:
+        return frozenset(range(7))
+    return frozenset(WEEKDAYS.index(day.lower()[:3]) if isinstance(day, str) else int(day) for day in weekdays)
+
+
+def _parse_month_day(month_day):
+    if isinstance(month_day, date):
+        return month_day.month, month_day.day
+    month, day = str(month_day).split('-')[-2:]
+    return int(month), int(day)
+
+
+def _date_from_month_day(year: int, month_day: tuple) -> date:
+    try:
+        return date(year, *month_day)
+    except ValueError:
+        return date(year, month_day[0], 28)  # 29th of February in a non leap year
+
+
+class RecurrenceRule():
+    """ Calendar shared by one or more programs, with all their start times
+    """
+    def __init__(self, weekdays: frozenset = frozenset(range(7)), every_n_days: int = 1,
+                 anchor: date = _DEFAULT_ANCHOR, season: tuple = None):
+        """__init__ of the class
+        Args:
+            weekdays (frozenset, optional): Allowed weekdays (0 is monday). Defaults to all.
+            every_n_days (int, optional): Run one day out of N, counting from the anchor. Defaults to 1.
+            anchor (date, optional): First day of the "every N days" cycle. Defaults to 2000-01-01.
+            season (tuple, optional): ((month, day), (month, day)) range of the year, may wrap the new year.
+                                      Defaults to None (all year).
+        """
+        self.season = season
+        self.period = every_n_days * 7 // gcd(every_n_days, 7) if weekdays != frozenset(range(7)) else every_n_days
+        self._anchor = anchor.toordinal()
+        allowed = [offset % every_n_days == 0 and (self._anchor + offset - 1) % 7 in weekdays
+                   for offset in range(self.period)]
+        # Distance from each day of the period to the next allowed day (-1 if none)
+        self._next_offset = [-1] * self.period
+        if any(allowed):
+            distance = allowed.index(True)  # Distance from the start of the next period
+            for offset in range(self.period - 1, -1, -1):
+                distance = 0 if allowed[offset] else distance + 1
+                self._next_offset[offset] = distance
+        self._entries = []
+        self._start_seconds = ()
+        self._start_names = ()
+
+    def add(self, start_minutes: int, order: int, name: str):
+        """ Adds a start time of a program to the rule
+        Args:
+            start_minutes (int): Minute of the day
+            order (int): Order of the program in the config (to break ties)
+            name (str): Name of the program
+        """
+        self._entries.append((start_minutes * 60, order, name))
+        self._entries.sort()
+        self._start_seconds = tuple(entry[0] for entry in self._entries)
+        self._start_names = tuple((entry[1], entry[2]) for entry in self._entries)
+
+    def _in_season(self, day: date) -> bool:
+        if self.season is None:
+            return True
+        month_day = (day.month, day.day)
+        start, end = self.season
+        if start <= end:
+            return start <= month_day <= end
+        return month_day >= start or month_day <= end
+
+    def _next_season_start(self, day: date) -> date:
+        start = _date_from_month_day(day.year, self.season[0])
+        return start if start >= day else _date_from_month_day(day.year + 1, self.season[0])
+
+    def runs_on(self, day: date) -> bool:
+        """ Returns if the rule runs at some time of that day
+        Args:
+            day (date): Day
+        Returns:
+            bool: True if it runs
+        """
+        return self._next_offset[(day.toordinal() - self._anchor) % self.period] == 0 and self._in_season(day)
+
+    def next_day(self, day: date):
+        """ First day, at or after "day", in which the rule runs
+        Args:
+            day (date): First day to consider
+        Returns:
+            date: Next day, or None if it never runs
+        """
+        for _ in range(100):  # Only a few jumps are needed (period table -> season start -> ...)
+            offset = self._next_offset[(day.toordinal() - self._anchor) % self.period]
+            if offset < 0 or not self._start_seconds:
+                return None
+            day = day + timedelta(days=offset)
+            if self._in_season(day):
+                return day
+            day = self._next_season_start(day)
+        return None
+
+    def next_after(self, after: datetime):
+        """ First occurrence strictly after a naive local time
+        Args:
+            after (datetime): Naive local time
+        Returns:
+            tuple: (naive datetime, order, program name), or None if it never runs
+        """
+        day = after.date()
+        if self.runs_on(day):
+            seconds = after.hour * 3600 + after.minute * 60 + after.second + after.microsecond / 1000000
+            index = bisect_right(self._start_seconds, seconds)
+            if index < len(self._start_seconds):
+                return self._occurrence(day, index)
+        next_day = self.next_day(day + timedelta(days=1))
+        if next_day is None:
+            return None
+        return self._occurrence(next_day, 0)
+
+    def _occurrence(self, day: date, index: int):
+        minutes = self._start_seconds[index] // 60
+        order, name = self._start_names[index]
+        return datetime.combine(day, time(minutes // 60, minutes % 60)), order, name
+
+    def iter_after(self, after: datetime):
+        """ Iterates over all the occurrences strictly after a naive local time
+        Args:
+            after (datetime): Naive local time
+        """
+        day = after.date()
+        index = len(self._start_seconds)
+        if self.runs_on(day):
+            seconds = after.hour * 3600 + after.minute * 60 + after.second + after.microsecond / 1000000
+            index = bisect_right(self._start_seconds, seconds)
+        while True:
+            for entry_index in range(index, len(self._start_seconds)):
+                yield self._occurrence(day, entry_index)
+            day = self.next_day(day + timedelta(days=1))
+            if day is None:
+                return
+            index = 0
+
+
+class ScheduleEngine():
+    """ Next occurrence among all the programs, merging their rules with a heap.
+        Consecutive queries with increasing times (the usual case) reuse the heap: only the rules whose cached
+        occurrence was reached are recomputed. The heap is shared by the loop, the executor thread and the control
+        server, so it is only changed with its lock held.
+    """
+    def __init__(self, programs: list):
+        """__init__ of the class
+        Args:
+            programs (list): Enabled programs, as in the config
+        """
+        rules = {}
+        for order, program in enumerate(programs):
+            season = program.get('season')
+            key = (_parse_weekdays(program.get('weekdays')),
+                   int(program.get('every_n_days') or 1),
+                   datetime.strptime(str(program['anchor_date']), '%Y-%m-%d').date()
+                   if program.get('anchor_date') else _DEFAULT_ANCHOR,
+                   (_parse_month_day(season[0]), _parse_month_day(season[1])) if season else None)
+            if key not in rules:
+                rules[key] = RecurrenceRule(*key)
+            start_times = [program['start_time']] + list(program.get('start_times') or [])
+            for start_minutes in sorted({_parse_minutes(start_time) for start_time in start_times}):
+                rules[key].add(start_minutes, order, program['name'])
+        self.rules = tuple(rules.values())
+        self._heap = None
+        self._heap_after = None
+        self._heap_lock = threading.Lock()
+
+    def _build_heap(self, after: datetime):
+        self._heap = []
+        for index, rule in enumerate(self.rules):
+            occurrence = rule.next_after(after)
+            if occurrence:
+                self._heap.append(occurrence + (index,))
+        heapq.heapify(self._heap)
+        self._heap_after = after
+
+    def next_after(self, after: datetime):
+        """ First occurrence of any program strictly after a naive local time
+        Args:
+            after (datetime): Naive local time
+        Returns:
+            tuple: (naive datetime, program name), or (None, None) if no program runs
+        """
+        with self._heap_lock:
+            if self._heap is None or after < self._heap_after:
+                self._build_heap(after)
+            else:
+                while self._heap and self._heap[0][0] <= after:
+                    index = self._heap[0][3]
+                    occurrence = self.rules[index].next_after(after)
+                    if occurrence:
+                        heapq.heapreplace(self._heap, occurrence + (index,))
+                    else:
+                        heapq.heappop(self._heap)
+                self._heap_after = after
+            if not self._heap:
+                return None, None
+            return self._heap[0][0], self._heap[0][2]
+
+    def iter_after(self, after: datetime):
+        """ Iterates over all the occurrences of all the programs (time order) strictly after a naive local time
+        Args:
+            after (datetime): Naive local time
+        """
+        for occurrence_time, _, name in heapq.merge(*(rule.iter_after(after) for rule in self.rules)):
+            yield occurrence_time, name
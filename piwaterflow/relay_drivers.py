@@ -0,0 +1,271 @@
+""" Relay drivers: how the relay channels (inverter_relay_pin, and the pin of every valve) reach the hardware.
+    - gpio: channels are header pins (BOARD numbering), as in older versions. Many changes go in a single output call
+    - mcp23017: I2C port expanders (needs smbus2, pip install piwaterflow[i2c]), 16 relays each. The whole bank of
+      an expander is written in a single bus transaction
+    - 74hc595: chain of shift registers, 8 relays each, driven by 3 header pins. The whole chain is shifted out and
+      latched at once
+    - simulated: keeps the levels and the transactions in memory (tests, development without relays)
+    Drivers receive the changes to apply from the shadow register (see PinState), which only sends actual diffs.
+"""
+try:
+    from RPi import GPIO
+except (ModuleNotFoundError, ImportError, RuntimeError):
+    from fake_rpigpio.RPi import GPIO
+
+GPIO_DRIVER = 'gpio'
+MCP23017 = 'mcp23017'
+SHIFT_REGISTER = '74hc595'
+SIMULATED = 'simulated'
+
+
+class RelayDriverError(Exception):
+    """ Specific exception for when a relay driver cannot be used
+    """
+    def __init__(self, message):
+        # Call the base class constructor with the parameters it needs
+        super().__init__(message)
+
+
+def _ensure_mode(gpio):
+    if gpio.getmode() is None:
+        gpio.setmode(GPIO.BOARD)
+        gpio.setwarnings(False)
+
+
+class GPIODriver():
+    """ Relays connected to header pins
+    """
+    def __init__(self, gpio, mode=GPIO.BOARD, batch_output: bool = True):
+        """__init__ of the class
+        Args:
+            gpio (module): GPIO library (RPi.GPIO or fake_rpigpio)
+            mode (int, optional): Pin numbering. Defaults to GPIO.BOARD.
+            batch_output (bool, optional): Set many pins in a single output() call (RPi.GPIO accepts lists of
+                                           channels). Defaults to True.
+        """
+        self.gpio = gpio
+        self.mode = mode
+        self.batch_output = batch_output
+
+    def setup(self, outputs: list, initial: dict, inputs: list = ()):
+        """ Sets up the pins
+        Args:
+            outputs (list): Relay channels
+            initial (dict): Level of every relay channel
+            inputs (list, optional): Input channels. Defaults to ().
+        """
+        self.gpio.setmode(self.mode)
+        self.gpio.setwarnings(False)
+        for pin in outputs:
+            self.gpio.setup(pin, GPIO.OUT, initial=initial[pin])
+        for pin in inputs:
+            self.gpio.setup(pin, GPIO.IN)
+
+    def write(self, levels: dict):
+        """ Changes the level of some relays
+        Args:
+            levels (dict): New level of every channel changed
+        """
+        if len(levels) > 1 and self.batch_output:
+            self.gpio.output(list(levels), list(levels.values()))
+        else:
+            for pin, level in levels.items():
+                self.gpio.output(pin, level)
+
+    def release(self):
+        """ Frees the pins
+        """
+        self.gpio.cleanup()
+
+
+class MCP23017Driver():
+    """ Relays connected to MCP23017 I2C port expanders. Channel = 16 * expander index + bit (GPA0-7, then GPB0-7)
+    """
+    _IODIRA = 0x00  # Registers in the default (IOCON.BANK = 0) layout: A and B are consecutive
+    _OLATA = 0x14
+
+    def __init__(self, bus: int = 1, addresses=(0x20,)):
+        """__init__ of the class
+        Args:
+            bus (int, optional): I2C bus. Defaults to 1.
+            addresses (list, optional): Address of every expander. Defaults to (0x20,).
+        """
+        try:
+            import smbus2  # pylint: disable=import-outside-toplevel
+        except ImportError as ex:
+            raise RelayDriverError('mcp23017 relays need smbus2 (pip install piwaterflow[i2c])') from ex
+        self._smbus = smbus2
+        self.bus_number = bus
+        self.addresses = list(addresses)
+        self._bus = None
+        self._latches = [0] * len(self.addresses)
+
+    def _split(self, channel: int):
+        expander, bit = divmod(channel, 16)
+        if expander >= len(self.addresses):
+            raise RelayDriverError(f'Relay channel {channel} out of the {len(self.addresses)} mcp23017 expanders')
+        return expander, bit
+
+    def _write_bank(self, expander: int):
+        latch = self._latches[expander]
+        self._bus.write_i2c_block_data(self.addresses[expander], self._OLATA, [latch & 0xFF, latch >> 8])
+
+    def setup(self, outputs: list, initial: dict, inputs: list = ()):
+        """ Opens the bus, and sets the direction of the channels. Latches are written before, so that no relay
+            glitches on
+        Args:
+            outputs (list): Relay channels
+            initial (dict): Level of every relay channel
+            inputs (list, optional): Input channels. Defaults to ().
+        """
+        self._bus = self._smbus.SMBus(self.bus_number)
+        directions = [0xFFFF] * len(self.addresses)  # Inputs by default
+        self._latches = [0] * len(self.addresses)
+        for channel in outputs:
+            expander, bit = self._split(channel)
+            directions[expander] &= ~(1 << bit)
+            if initial[channel]:
+                self._latches[expander] |= 1 << bit
+        for channel in inputs:
+            self._split(channel)
+        for expander, address in enumerate(self.addresses):
+            self._write_bank(expander)
+            self._bus.write_i2c_block_data(address, self._IODIRA,
+                                           [directions[expander] & 0xFF, directions[expander] >> 8])
+
+    def write(self, levels: dict):
+        """ Changes the level of some relays: a single transaction per expander changed
+        Args:
+            levels (dict): New level of every channel changed
+        """
+        changed = set()
+        for channel, level in levels.items():
+            expander, bit = self._split(channel)
+            if level:
+                self._latches[expander] |= 1 << bit
+            else:
+                self._latches[expander] &= ~(1 << bit)
+            changed.add(expander)
+        for expander in sorted(changed):
+            self._write_bank(expander)
+
+    def release(self):
+        """ Closes the bus
+        """
+        if self._bus is not None:
+            self._bus.close()
+            self._bus = None
+
+
+class ShiftRegisterDriver():
+    """ Relays connected to a chain of 74HC595 shift registers. Channel = 8 * chip + output (Q0-Q7), chip 0 being
+        the one wired to the data pin
+    """
+    def __init__(self, gpio, data_pin: int, clock_pin: int, latch_pin: int, chips: int = 1):
+        """__init__ of the class
+        Args:
+            gpio (module): GPIO library (RPi.GPIO or fake_rpigpio)
+            data_pin (int): Header pin wired to SER
+            clock_pin (int): Header pin wired to SRCLK
+            latch_pin (int): Header pin wired to RCLK
+            chips (int, optional): Chips in the chain. Defaults to 1.
+        """
+        self.gpio = gpio
+        self.data_pin = data_pin
+        self.clock_pin = clock_pin
+        self.latch_pin = latch_pin
+        self.chips = chips
+        self._bits = 0
+
+    def _shift_out(self):
+        """ Shifts the whole chain (last channel first), and latches it at once
+        """
+        for channel in reversed(range(self.chips * 8)):
+            self.gpio.output(self.data_pin, (self._bits >> channel) & 1)
+            self.gpio.output(self.clock_pin, GPIO.HIGH)
+            self.gpio.output(self.clock_pin, GPIO.LOW)
+        self.gpio.output(self.latch_pin, GPIO.HIGH)
+        self.gpio.output(self.latch_pin, GPIO.LOW)
+
+    def setup(self, outputs: list, initial: dict, inputs: list = ()):
+        """ Sets up the header pins, and latches the initial levels
+        Args:
+            outputs (list): Relay channels
+            initial (dict): Level of every relay channel
+            inputs (list, optional): Must be empty: shift registers have no inputs. Defaults to ().
+        """
+        if inputs:
+            raise RelayDriverError('74hc595 relays have no inputs: set external_ac_signal_pin to 0')
+        if any(channel >= self.chips * 8 for channel in outputs):
+            raise RelayDriverError(f'Relay channels out of the {self.chips} 74hc595 chips: {sorted(outputs)}')
+        _ensure_mode(self.gpio)
+        for pin in (self.data_pin, self.clock_pin, self.latch_pin):
+            self.gpio.setup(pin, GPIO.OUT, initial=GPIO.LOW)
+        self._bits = sum(1 << channel for channel in outputs if initial[channel])
+        self._shift_out()
+
+    def write(self, levels: dict):
+        """ Changes the level of some relays: the whole chain is latched once
+        Args:
+            levels (dict): New level of every channel changed
+        """
+        for channel, level in levels.items():
+            if level:
+                self._bits |= 1 << channel
+            else:
+                self._bits &= ~(1 << channel)
+        self._shift_out()
+
+    def release(self):
+        """ Frees the header pins (the registers keep their latched outputs)
+        """
+        self.gpio.cleanup([self.data_pin, self.clock_pin, self.latch_pin])
+
+
+class SimulatedRelayDriver():
+    """ Relays kept in memory
+    """
+    def __init__(self):
+        self.levels = {}
+        self.transactions = []  # Every setup and write, as the levels it sent
+        self.released = False
+
+    def setup(self, outputs: list, initial: dict, inputs: list = ()): # pylint: disable=unused-argument
+        """ Sets the initial levels
+        """
+        self.levels = {channel: initial[channel] for channel in outputs}
+        self.transactions.append(dict(self.levels))
+        self.released = False
+
+    def write(self, levels: dict):
+        """ Changes the level of some relays
+        """
+        self.levels.update(levels)
+        self.transactions.append(dict(levels))
+
+    def release(self):
+        """ Nothing to free
+        """
+        self.released = True
+
+
+def relay_driver_factory(relays_config: dict, gpio):
+    """ Creates the relay driver of the config
+    Args:
+        relays_config (dict): "relays" section of the config
+        gpio (module): GPIO library (RPi.GPIO or fake_rpigpio)
+    Returns:
+        GPIODriver, MCP23017Driver, ShiftRegisterDriver or SimulatedRelayDriver: Driver
+    """
+    driver = relays_config.get('driver', GPIO_DRIVER)
+    if driver == GPIO_DRIVER:
+        return GPIODriver(gpio)
+    if driver == MCP23017:
+        return MCP23017Driver(bus=relays_config.get('i2c_bus', 1),
+                              addresses=relays_config.get('i2c_addresses') or [0x20])
+    if driver == SHIFT_REGISTER:
+        return ShiftRegisterDriver(gpio, relays_config['data_pin'], relays_config['clock_pin'],
+                                   relays_config['latch_pin'], chips=relays_config.get('chips', 1))
+    if driver == SIMULATED:
+        return SimulatedRelayDriver()
+    raise RelayDriverError(f'Unknown relay driver: {driver}')
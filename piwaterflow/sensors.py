@@ -0,0 +1,278 @@
+""" Environment sensors (humidity, temperature) sampled in the background, so that the loop never waits for a slow or
+    flaky sensor: the decision to skip a program is taken in constant time from a cached moving average.
+    The samples are kept in a json file, shared by all the processes (cron runs and daemon) and rate limited: a sensor
+    is not read again before the sampling interval, whoever read it last. Averages older than max_age are stale, and
+    never used to skip a program.
+    Backends: DHT22 (needs adafruit-circuitpython-dht) and a file with the readings, as a stand-in sensor (tests,
+    readings published by another system...).
+"""
+import os
+import sys
+import json
+import time
+import select
+import logging
+import threading
+import subprocess
+import importlib.util
+
+NONE = 'none'
+DHT22 = 'dht22'
+FILE = 'file'
+
+_READ_TIMEOUT = 30  # Max seconds for a DHT22 read (the first one also starts its reader process)
+
+
+class SensorError(Exception):
+    """ Specific exception for when a sensor cannot be used
+    """
+    def __init__(self, message):
+        # Call the base class constructor with the parameters it needs
+        super().__init__(message)
+
+
+class FileSensor():
+    """ Stand-in sensor: readings from a json file, i.e. {"humidity": 45.2, "temperature": 21.5}
+    """
+    def __init__(self, path: str):
+        """__init__ of the class
+        Args:
+            path (str): File with the readings
+        """
+        self.path = path
+
+    def read(self) -> dict:
+        """ Reads the sensor
+        Returns:
+            dict: Readings (name: value)
+        """
+        with open(self.path, 'r', encoding="utf-8") as readings_file:
+            readings = json.load(readings_file)
+        return {name: float(value) for name, value in readings.items() if value is not None}
+
+    def close(self):
+        """ Nothing to close
+        """
+
+
+def _dht22_reader():
+    """ Body of the reader process of DHT22Sensor: reads the sensor for every line received in stdin, and answers with
+        a json line in stdout, with the readings or the error
+    """
+    import board  # pylint: disable=import-outside-toplevel
+    import adafruit_dht  # pylint: disable=import-outside-toplevel
+    device = adafruit_dht.DHT22(getattr(board, f'D{int(sys.argv[1])}'), use_pulseio=False)
+    try:
+        for _ in sys.stdin:
+            try:
+                answer = {'humidity': device.humidity, 'temperature': device.temperature}
+            except Exception as ex:  # pylint: disable=broad-except
+                answer = {'error': str(ex)}
+            sys.stdout.write(f'{json.dumps(answer)}\n')
+            sys.stdout.flush()
+    finally:
+        device.exit()
+
+
+class DHT22Sensor():
+    """ DHT22 humidity and temperature sensor, read in a process of its own: on the Raspberry Pi its driver (Blinka)
+        sets the pin numbering of RPi.GPIO to BCM, which conflicts with the BOARD numbering of the relays and the flow
+        meter of this process (see CHANGES 0.2.4)
+    """
+    def __init__(self, pin: int):
+        """__init__ of the class
+        Args:
+            pin (int): Data pin (BCM numbering)
+        """
+        if importlib.util.find_spec('board') is None or importlib.util.find_spec('adafruit_dht') is None:
+            raise SensorError('DHT22 sensor needs adafruit-circuitpython-dht (pip install piwaterflow[dht22])')
+        self.pin = pin
+        self._lock = threading.Lock()
+        self._process = None
+
+    def _start(self) -> subprocess.Popen:
+        return subprocess.Popen([sys.executable, '-c', 'from piwaterflow.sensors import _dht22_reader; _dht22_reader()',
+                                 str(self.pin)], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def read(self) -> dict:
+        """ Reads the sensor. DHT22 reads fail often: the sampler just tries again later
+        Returns:
+            dict: Readings (name: value)
+        """
+        with self._lock:
+            if self._process is None or self._process.poll() is not None:
+                self._process = self._start()
+            process = self._process
+            process.stdin.write(b'\n')
+            process.stdin.flush()
+            ready, _, _ = select.select([process.stdout], [], [], _READ_TIMEOUT)
+            if not ready:
+                self._stop_process(process)  # Hung: a new one is started for the next read
+                raise SensorError(f'DHT22 read took more than {_READ_TIMEOUT} seconds')
+            line = process.stdout.readline()
+        if not line:
+            raise SensorError('DHT22 reader process exited')
+        answer = json.loads(line)
+        if 'error' in answer:
+            raise SensorError(answer['error'])
+        return answer
+
+    @staticmethod
+    def _stop_process(process: subprocess.Popen):
+        try:
+            process.stdin.close()  # The reader ends, and releases the pin
+            process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            process.kill()
+            process.wait()
+
+    def close(self):
+        """ Ends the reader process, which releases the pin (killed if it does not end in time)
+        """
+        process, self._process = self._process, None
+        if process is not None:
+            self._stop_process(process)
+
+
+def sensor_factory(sensor_config: dict):
+    """ Creates the sensor backend of the config
+    Args:
+        sensor_config (dict): "sensor" section of the config
+    Returns:
+        FileSensor or DHT22Sensor: Backend. None if there is no sensor
+    """
+    sensor_type = sensor_config.get('type', NONE)
+    if sensor_type == DHT22:
+        return DHT22Sensor(sensor_config.get('pin', 4))
+    if sensor_type == FILE:
+        return FileSensor(sensor_config['path'])
+    if sensor_type in (NONE, None):
+        return None
+    raise SensorError(f'Unknown sensor type: {sensor_type}')
+
+
+class SensorSampler():
+    """ Samples a sensor in a background thread, and keeps the moving average of the last samples in a cache file
+    """
+    def __init__(self, sensor, cache_path: str, interval: float = 60, window: int = 5, max_age: float = 600):
+        """__init__ of the class
+        Args:
+            sensor (FileSensor or DHT22Sensor): Backend
+            cache_path (str): Cache file of the samples, shared by all the processes
+            interval (float, optional): Min seconds between samples. Defaults to 60.
+            window (int, optional): Samples in the moving average. Defaults to 5.
+            max_age (float, optional): Seconds after which the average is stale. Defaults to 600.
+        """
+        self.sensor = sensor
+        self.cache_path = cache_path
+        self.interval = interval
+        self.window = window
+        self.max_age = max_age
+        self.logger = logging.getLogger()
+        self._cache = None
+        self._cache_mtime = None
+        self._sampled = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """ Starts sampling in the background (once)
+        """
+        with self._sampled:
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name='waterflow-sensors', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """ Stops sampling. A read in progress is not waited for
+        """
+        self._stop.set()
+        with self._sampled:
+            self._thread = None
+
+    def close(self):
+        """ Stops sampling, and releases the sensor
+        """
+        self.stop()
+        self.sensor.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            cache = self._read_cache()
+            due = (cache['updated'] if cache else 0) + self.interval - time.time()
+            if due <= 0:
+                self.sample()
+                due = self.interval
+            self._stop.wait(due)
+
+    def sample(self) -> bool:
+        """ Reads the sensor once, and adds the readings to the cache
+        Returns:
+            bool: False if the read failed
+        """
+        try:
+            readings = self.sensor.read()
+        except Exception as ex:  # pylint: disable=broad-except
+            self.logger.debug('Sensor read failed: %s', str(ex))
+            return False
+        now = time.time()
+        cache = self._read_cache() or {'samples': []}
+        samples = (cache['samples'] + [[now, readings]])[-self.window:]
+        average = {}
+        for name in {name for _, sample in samples for name in sample}:
+            values = [sample[name] for _, sample in samples if sample.get(name) is not None]
+            if values:
+                average[name] = sum(values) / len(values)
+        cache = {'updated': now, 'samples': samples, 'average': average}
+        tmp_path = f'{self.cache_path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding="utf-8") as cache_file:
+                json.dump(cache, cache_file)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as ex:
+            self.logger.warning('Sensor cache could not be written: %s', str(ex))
+        with self._sampled:
+            self._cache = cache
+            self._sampled.notify_all()
+        return True
+
+    def _read_cache(self):
+        """ Cache of this process, or the one written by another process if newer. Only reloaded when it changes
+        """
+        try:
+            mtime = os.stat(self.cache_path).st_mtime_ns
+        except OSError:
+            return self._cache
+        if mtime != self._cache_mtime:
+            try:
+                with open(self.cache_path, 'r', encoding="utf-8") as cache_file:
+                    cache = json.load(cache_file)
+            except (OSError, ValueError):
+                return self._cache
+            self._cache_mtime = mtime
+            if not self._cache or cache['updated'] >= self._cache['updated']:
+                self._cache = cache
+        return self._cache
+
+    def average(self, name: str, timeout: float = 0):
+        """ Returns the moving average of a reading, if it is not stale
+        Args:
+            name (str): Reading (i.e. "humidity")
+            timeout (float, optional): Max seconds to wait for a sample of the background thread if the average is
+                                       stale (it never waits for the sensor itself). Defaults to 0.
+        Returns:
+            tuple: Average and its age in seconds, or (None, None) if stale or never sampled
+        """
+        deadline = time.monotonic() + timeout
+        with self._sampled:
+            while True:
+                cache = self._read_cache()
+                if cache and name in cache['average']:
+                    age = time.time() - cache['updated']
+                    if age <= self.max_age:
+                        return cache['average'][name], age
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._thread is None:
+                    return None, None
+                self._sampled.wait(remaining)
@@ -0,0 +1,347 @@
+""" Simulation of the waterflow, with a virtual clock and the state kept in memory.
+    Runs the same loop logic over a date range, jumping from program to program instead of looping every few minutes,
+    and without touching the homevar files, the relays or the metrics backend. Intended to validate a config before
+    deploying it: a whole year of schedule is simulated in a fraction of a second.
+"""
+import os
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from fake_rpigpio.RPi import GPIO as FakeGPIO
+
+from .waterflow import Waterflow
+from .config_waterflow import WaterflowConfig
+from .command_queue import CommandQueue
+from .executor import IDLE
+from .instrumentation import Instrumentation, nullcontext
+from .state_store import SqliteStateStore
+from .usage import UsageRollups
+from .flow_meter import FlowMeter
+
+
+class _MemoryJournal():
+    """ EventJournal kept in memory, in a single segment
+    """
+    def __init__(self):
+        self._events = []
+
+    def append(self, event) -> bool:
+        """ Appends an event
+        Returns:
+            bool: Never rotates
+        """
+        self._events.append(event)
+        return False
+
+    def read(self) -> list:
+        """ Returns all the events
+        """
+        return list(self._events)
+
+    def iter_events(self, archived: bool = False): # pylint: disable=unused-argument
+        """ Iterates over all the events, oldest first
+        """
+        yield from self._events
+
+    def iter_range(self, since: str = None, until: str = None, reverse: bool = False, archived: bool = False): # pylint: disable=unused-argument
+        """ Iterates over the events in a time range (see EventJournal.iter_range)
+        """
+        for event in reversed(self._events) if reverse else self._events:
+            if (since is None or event[0] >= since) and (until is None or event[0] < until):
+                yield event
+
+    def close(self):
+        """ Nothing to close
+        """
+
+
+class _InlineExecutor():
+    """ Executor that runs the job right away in the caller thread: the virtual clock only moves forward in it
+    """
+    busy = False
+    error = None
+
+    def start(self, _type_exec: str, _name: str, job) -> bool:
+        """ Runs the job
+        """
+        job()
+        return True
+
+    def get_state(self) -> dict:
+        """ Always idle once start() returned
+        """
+        return {'state': IDLE}
+
+    def heartbeat(self, **_info) -> bool:
+        """ Nothing to supervise
+        """
+        return True
+
+    def advance(self, _type_exec: str, _name: str) -> bool:
+        """ Nothing to supervise
+        """
+        return True
+
+    def stopping(self) -> bool:
+        """ Stops are served by the loop, between executions
+        """
+        return False
+
+    def request_stop(self) -> bool:
+        """ Never running when the loop is
+        """
+        return False
+
+    def is_stuck(self) -> bool:
+        """ Never stuck
+        """
+        return False
+
+    def wait(self, _timeout: float = None) -> bool:
+        """ Already finished
+        """
+        return True
+
+
+class _NoProcessLock():
+    """ Loop lock of a single process: always free
+    """
+    stale_owner = None
+
+    def acquire(self, timeout: float = 0) -> bool: # pylint: disable=unused-argument
+        """ Always taken
+        """
+        return True
+
+    def release(self) -> bool:
+        """ Always released
+        """
+        return True
+
+    def heartbeat(self):
+        """ Nobody waits for it
+        """
+
+    def shared(self, timeout: float = 5): # pylint: disable=unused-argument
+        """ Readers never wait
+        """
+        return nullcontext(True)
+
+
+class _FakePins():
+    """ PinState of fake relays: only the state is kept
+    """
+    def __init__(self):
+        self._state = {}
+
+    def declare(self, outputs, inputs=()): # pylint: disable=unused-argument
+        """ Nothing to declare
+        """
+
+    def prepare(self):
+        """ Nothing to set up
+        """
+
+    def set(self, pin: int, level: int):
+        """ Keeps the state of the pin
+        """
+        self._state[pin] = level
+
+    def batch(self):
+        """ Changes are applied right away
+        """
+        return nullcontext(self)
+
+    def reset(self):
+        """ All relays off
+        """
+        self._state.clear()
+
+    release = reset
+
+    def state(self, pin: int):
+        """ Returns the state of the pin
+        """
+        return self._state.get(pin)
+
+
+class _DeferredRollups(UsageRollups):
+    """ UsageRollups in memory that keeps the events, and rolls them up in a single transaction when queried: the
+        usage of a simulation is asked once at most, at the end
+    """
+    def __init__(self):
+        super().__init__(':memory:')
+        self._queued = []
+
+    def add(self, event):
+        """ Keeps the event, to be rolled up on the next query
+        """
+        self._queued.append(event)
+
+    def rebuild(self, events) -> int:
+        """ Reconstructs the rollups from the events (see UsageRollups.rebuild). Queued ones are part of them
+        """
+        self._queued = []
+        return super().rebuild(events)
+
+    def usage(self, *args, **kwargs) -> list:
+        """ Rolls up the queued events, and returns the usage (see UsageRollups.usage)
+        """
+        if self._queued:
+            queued, self._queued = self._queued, []
+            with self._conn_lock:
+                self._connect().execute('BEGIN IMMEDIATE')
+                try:
+                    for event in queued:
+                        self._apply(event)
+                    self._conn.execute('COMMIT')
+                except BaseException:
+                    self._conn.execute('ROLLBACK')
+                    raise
+        return super().usage(*args, **kwargs)
+
+
+class SimulatedWaterflow(Waterflow):
+    """ Waterflow running with a virtual clock, and its state (events, last program, commands) in memory.
+        Relays are fake and no metric is emitted
+    """
+    def __init__(self, template_config_path: str = None, config_path: str = None, start: datetime = None):
+        """__init__ of the class
+        Args:
+            template_config_path (str, optional): Template config to use. Defaults to the one of the package.
+            config_path (str, optional): Config to be simulated. Defaults to the deployed one, if any.
+            start (datetime, optional): Initial time of the virtual clock. Defaults to now.
+        """
+        if config_path is None:
+            deployed_path = os.path.join(str(Path.home()), 'var', self.class_name(), 'config.yml')
+            config_path = deployed_path if os.path.exists(deployed_path) else None
+        self._config_path = config_path
+        self._clock = (start or datetime.now()).astimezone().replace(microsecond=0)
+        self._last_program_time = None
+        self._last_loop_time = None
+        self._time_str = (None, None)
+        self._next_program = (None, None)
+
+        # Not a dry run: valves are not skipped, their time is spent in the virtual clock
+        super().__init__(template_config_path=template_config_path, fake_now=self._clock)
+        self.gpio = FakeGPIO
+
+    # Components kept in memory, or disabled: the homevar is never created
+
+    def _init_homevar(self) -> str:
+        return os.path.join(str(Path.home()), 'var', self.class_name(), 'simulation')
+
+    def _create_config(self, template_config_path: str) -> WaterflowConfig:
+        return WaterflowConfig(package_name=self.class_name(),
+                               template_path=template_config_path,
+                               config_file_name="config.yml",
+                               dry_run=True,
+                               dry_run_abs_path=self._config_path)
+
+    def _create_instrumentation(self) -> Instrumentation:
+        return Instrumentation(None, enabled=False)
+
+    def _create_event_journal(self) -> _MemoryJournal:
+        return _MemoryJournal()
+
+    def _create_rollups(self) -> UsageRollups:
+        return _DeferredRollups()  # Water usage of the simulation (see usage)
+
+    def _create_state_store(self) -> SqliteStateStore:
+        return SqliteStateStore(':memory:')  # Lock, token and last program are kept in attributes (faster)
+
+    def _create_loop_lock(self) -> _NoProcessLock:
+        return _NoProcessLock()
+
+    def _create_command_queue(self) -> CommandQueue:
+        return CommandQueue(self.state)
+
+    def _create_executor(self) -> _InlineExecutor:
+        return _InlineExecutor()
+
+    def _create_pins(self) -> _FakePins:
+        return _FakePins()
+
+    def _create_flow_meter(self) -> FlowMeter:
+        return FlowMeter(FakeGPIO, None)  # No water flows in a simulation
+
+    def _create_sensor_sampler(self):
+        return None  # Programs are never skipped, nor scaled, by the weather
+
+    def _create_water_budget(self):
+        return None
+
+    def _create_metrics(self):
+        return None
+
+    def time_to_str(self, time_var: datetime) -> str: # pylint: disable=arguments-differ
+        # Many events share the same virtual time: format it only once
+        if time_var is not self._time_str[0]:
+            self._time_str = (time_var, Waterflow.time_to_str(time_var))
+        return self._time_str[1]
+
+    def _now(self) -> datetime:
+        return self._clock
+
+    def _monotonic(self) -> float:
+        return self._clock.timestamp()
+
+    def _recalc_next_program(self, last_program_time: datetime):
+        # The loop and run() ask for the same next program: calculate it once
+        key = (self.curr_time, last_program_time)
+        if key != self._next_program[0]:
+            self._next_program = (key, super()._recalc_next_program(last_program_time))
+        return self._next_program[1]
+
+    def _sleep(self, time_sleep):
+        # Clamp sleep time... as the real one
+        time_sleep = min(time_sleep, self.config['max_valve_time'] * 60)
+        if time_sleep > 0:
+            self._clock += timedelta(seconds=time_sleep)
+
+
+    def _read_last_program_time(self, default: datetime = None):
+        if self._last_program_time is None:
+            self._last_program_time = (default or self._now()).astimezone()
+        return self._last_program_time
+
+    def _write_last_program_time(self, time_last: datetime):
+        self._last_program_time = time_last
+
+    def _touch_token(self):
+        self._last_loop_time = self._now()
+
+    def last_loop_time(self):
+        return self._last_loop_time or datetime.fromtimestamp(0).astimezone()
+
+    def _import_legacy_requests(self):
+        pass
+
+    def compact_events(self):
+        pass
+
+    def _emit_action_metric(self, action, forced):
+        pass
+
+    def run(self, until: datetime, since: datetime = None) -> list:
+        """ Runs the loop once at the start, and then at each program time until "until".
+            Forced commands queued before (see enqueue) are served by the first loop
+        Args:
+            until (datetime): End of the simulation
+            since (datetime, optional): Start of the simulation. Defaults to the current virtual time.
+        Returns:
+            list: Timeline of events (time string, event, value)
+        """
+        if since:
+            self._clock = since.astimezone().replace(microsecond=0)
+        until = until.astimezone()
+        self.loop(self._clock)
+        while True:
+            next_program_time, _ = self._recalc_next_program(self._read_last_program_time())
+            if next_program_time is None or next_program_time > until:
+                break
+            # Deadline to deadline: nothing happens in between
+            self._clock = max(self._clock, next_program_time)
+            self.loop(self._clock)
+        self._clock = max(self._clock, until)
+        return self._read_events()
@@ -0,0 +1,419 @@
+""" Crash-safe store of the controller state of the waterflow: last successful loop (token), time of the last
+    program, state of the execution (see executor) and queue of commands (see command_queue).
+    The default backend is SQLite in WAL mode: the changes of a loop tick are committed together in a single
+    transaction, and an interrupted write (i.e. a power cut) never leaves the state half written.
+    The files backend keeps the layout of older versions (token and lastprogram.yml in the homevar, plus execution.json
+    and the commands folder), now written atomically. It is the compatibility mode, and the format the SQLite state is
+    exported to (see export).
+    Events have their own crash-safe store (see event_journal), and the loop lock is a kernel lock (see process_lock).
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from .process_lock import ProcessLock
+
+SQLITE = 'sqlite'
+FILES = 'files'
+
+_TOKEN = 'token'
+_LAST_PROGRAM = 'last_program'
+_EXECUTION = 'execution'
+
+_LOCK_TIMEOUT = 5  # Max seconds to wait for another process in a transaction (files backend)
+_BUSY_TIMEOUT = 30  # Max seconds to wait for the transaction of another process (i.e. a loop tick)
+
+
+class FileStateStore():
+    """ State kept in the files layout of older versions. Every change is written right away, each file atomically
+    """
+    def __init__(self, path: str):
+        """__init__ of the class
+        Args:
+            path (str): Folder of the files (homevar)
+        """
+        self.path = path
+        self.commands_path = os.path.join(path, 'commands')
+        self._lock = threading.RLock()
+        # Outside of the commands folder, as in older versions
+        self._process_lock = ProcessLock(os.path.join(path, 'commands.lock'))
+        self._depth = 0
+
+    def _file_path(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    @staticmethod
+    def _write_json(path: str, data: dict):
+        tmp_path = os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.tmp')
+        with open(tmp_path, 'w', encoding="utf-8") as file:
+            json.dump(data, file)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _read_json(path: str):
+        try:
+            with open(path, 'r', encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    @contextmanager
+    def transaction(self):
+        """ Serializes the block among the threads and the processes, so that a read and the write that depends on it
+            are not interleaved with other changes (i.e. queuing a command only once). Files are still written as soon
+            as they change. Runs anyway if the lock could not be taken in time. Nested blocks are part of the outer one
+        """
+        with self._lock:
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield self
+                finally:
+                    self._depth -= 1
+                return
+            taken = self._process_lock.acquire(timeout=_LOCK_TIMEOUT)
+            self._depth = 1
+            try:
+                yield self
+            finally:
+                self._depth = 0
+                if taken:
+                    self._process_lock.release()
+
+    def read_token(self):
+        """ Returns the time of the last successful loop
+        Returns:
+            float: Epoch time, or None if no loop ever finished
+        """
+        try:
+            return os.path.getmtime(self._file_path('token'))
+        except FileNotFoundError:
+            return None
+
+    def touch_token(self, now: float = None):
+        """ Registers a successful loop
+        Args:
+            now (float, optional): Epoch time of the loop. Defaults to now.
+        """
+        now = time.time() if now is None else now
+        token_path = self._file_path('token')
+        with open(token_path, 'a', encoding="utf-8"):
+            pass
+        os.utime(token_path, (now, now))
+
+    def read_last_program(self):
+        """ Returns the time of the last program executed
+        Returns:
+            str: Time ('%Y-%m-%d %H:%M:%S'), or None if unknown
+        """
+        try:
+            with open(self._file_path('lastprogram.yml'), 'r', encoding="utf-8") as file:
+                line = file.readline().strip()
+        except FileNotFoundError:
+            return None
+        # Only the first 19 characters: older versions wrote the time twice in the same line
+        return line[:19] or None
+
+    def write_last_program(self, time_str: str):
+        """ Registers the time of the last program executed
+        Args:
+            time_str (str): Time ('%Y-%m-%d %H:%M:%S')
+        """
+        last_program_path = self._file_path('lastprogram.yml')
+        tmp_path = f'{last_program_path}.tmp'
+        with open(tmp_path, 'w', encoding="utf-8") as file:
+            file.write(time_str)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, last_program_path)
+
+    def get_state(self) -> dict:
+        """ Returns the whole state
+        Returns:
+            dict: token (epoch or None) and last_program (time string or None)
+        """
+        return {_TOKEN: self.read_token(),
+                _LAST_PROGRAM: self.read_last_program()}
+
+    def set_state(self, state: dict):
+        """ Replaces the whole state
+        Args:
+            state (dict): State, as returned by get_state
+        """
+        if state.get(_TOKEN) is not None:
+            self.touch_token(state[_TOKEN])
+        if state.get(_LAST_PROGRAM) is not None:
+            self.write_last_program(state[_LAST_PROGRAM])
+
+    def read_execution(self):
+        """ Returns the state of the execution (see executor)
+        Returns:
+            dict: State, or None if never written
+        """
+        return self._read_json(self._file_path('execution.json'))
+
+    def write_execution(self, state: dict):
+        """ Replaces the state of the execution
+        Args:
+            state (dict): State
+        """
+        self._write_json(self._file_path('execution.json'), state)
+
+    def _command_path(self, command_id: str) -> str:
+        return os.path.join(self.commands_path, f'{command_id}.json')
+
+    def read_command(self, command_id: str):
+        """ Returns a command of the queue
+        Args:
+            command_id (str): Id of the command
+        Returns:
+            dict: Command, or None if unknown
+        """
+        return self._read_json(self._command_path(command_id))
+
+    def read_commands(self, statuses: tuple = None) -> list:
+        """ Returns the commands of the queue, in arrival (id) order
+        Args:
+            statuses (tuple, optional): Only commands with these statuses. Defaults to None (all).
+        Returns:
+            list: Commands
+        """
+        if not os.path.isdir(self.commands_path):
+            return []
+        result = []
+        for file_name in sorted(os.listdir(self.commands_path)):
+            if file_name.endswith('.json'):
+                command = self.read_command(file_name[:-len('.json')])
+                if command and (statuses is None or command['status'] in statuses):
+                    result.append(command)
+        return result
+
+    def write_command(self, command: dict):
+        """ Adds or replaces a command of the queue
+        Args:
+            command (dict): Command, with its id
+        """
+        os.makedirs(self.commands_path, exist_ok=True)
+        self._write_json(self._command_path(command['id']), command)
+
+    def delete_command(self, command_id: str):
+        """ Removes a command from the queue
+        Args:
+            command_id (str): Id of the command
+        """
+        try:
+            os.remove(self._command_path(command_id))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        """ Removes the state files (and the lock file of older versions)
+        """
+        for name in ('lock', 'token', 'lastprogram.yml'):
+            if os.path.exists(self._file_path(name)):
+                os.remove(self._file_path(name))
+
+    def export(self, target):
+        """ Copies the state to another store
+        Args:
+            target (FileStateStore or SqliteStateStore): Destination
+        """
+        target.set_state(self.get_state())
+
+    def close(self):
+        """ Nothing to close
+        """
+
+
+class SqliteStateStore():
+    """ State kept in a SQLite database in WAL mode. Changes made inside transaction() are committed together
+    """
+    def __init__(self, path: str):
+        """__init__ of the class
+        Args:
+            path (str): Database file (":memory:" for a volatile one)
+        """
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=_BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        # In WAL mode a commit is never torn. A power cut may only lose the last ticks (at worst, a program runs again)
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS commands (id TEXT PRIMARY KEY, status TEXT NOT NULL, '
+                           'value TEXT NOT NULL)')
+        # Connection shared by the loop, the executor thread and the control server. Held during a transaction
+        self._conn_lock = threading.RLock()
+        self._depth = 0
+
+    def __del__(self):
+        self.close()
+
+    @contextmanager
+    def transaction(self):
+        """ Runs the block (i.e. a loop tick) in a single database transaction, committed when it ends, also if it
+            raises: the state reflects what was done. The other threads wait until it ends, and the other processes
+            until it is committed. Nested blocks are part of the outer one
+        """
+        with self._conn_lock:
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield self
+                finally:
+                    self._depth -= 1
+                return
+            self._conn.execute('BEGIN IMMEDIATE')
+            self._depth = 1
+            try:
+                yield self
+            finally:
+                self._depth = 0
+                try:
+                    self._conn.execute('COMMIT')
+                except BaseException:
+                    self._conn.execute('ROLLBACK')
+                    raise
+
+    def _execute(self, sql: str, parameters: tuple = ()) -> list:
+        with self._conn_lock:
+            return self._conn.execute(sql, parameters).fetchall()
+
+    def _get(self, key: str):
+        rows = self._execute('SELECT value FROM state WHERE key = ?', (key,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def _set(self, key: str, value):
+        if value is None:
+            self._execute('DELETE FROM state WHERE key = ?', (key,))
+        else:
+            self._execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def read_token(self):
+        """ Returns the time of the last successful loop
+        Returns:
+            float: Epoch time, or None if no loop ever finished
+        """
+        return self._get(_TOKEN)
+
+    def touch_token(self, now: float = None):
+        """ Registers a successful loop
+        Args:
+            now (float, optional): Epoch time of the loop. Defaults to now.
+        """
+        self._set(_TOKEN, time.time() if now is None else now)
+
+    def read_last_program(self):
+        """ Returns the time of the last program executed
+        Returns:
+            str: Time ('%Y-%m-%d %H:%M:%S'), or None if unknown
+        """
+        return self._get(_LAST_PROGRAM)
+
+    def write_last_program(self, time_str: str):
+        """ Registers the time of the last program executed
+        Args:
+            time_str (str): Time ('%Y-%m-%d %H:%M:%S')
+        """
+        self._set(_LAST_PROGRAM, time_str)
+
+    def get_state(self) -> dict:
+        """ Returns the whole state
+        Returns:
+            dict: token (epoch or None) and last_program (time string or None)
+        """
+        return {_TOKEN: self._get(_TOKEN),
+                _LAST_PROGRAM: self._get(_LAST_PROGRAM)}
+
+    def set_state(self, state: dict):
+        """ Replaces the whole state, in a single transaction
+        Args:
+            state (dict): State, as returned by get_state
+        """
+        with self.transaction():
+            self._set(_TOKEN, state.get(_TOKEN))
+            self._set(_LAST_PROGRAM, state.get(_LAST_PROGRAM))
+
+    def read_execution(self):
+        """ Returns the state of the execution (see executor)
+        Returns:
+            dict: State, or None if never written
+        """
+        return self._get(_EXECUTION)
+
+    def write_execution(self, state: dict):
+        """ Replaces the state of the execution
+        Args:
+            state (dict): State
+        """
+        self._set(_EXECUTION, state)
+
+    def read_command(self, command_id: str):
+        """ Returns a command of the queue
+        Args:
+            command_id (str): Id of the command
+        Returns:
+            dict: Command, or None if unknown
+        """
+        rows = self._execute('SELECT value FROM commands WHERE id = ?', (command_id,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def read_commands(self, statuses: tuple = None) -> list:
+        """ Returns the commands of the queue, in arrival (id) order
+        Args:
+            statuses (tuple, optional): Only commands with these statuses. Defaults to None (all).
+        Returns:
+            list: Commands
+        """
+        if statuses is None:
+            rows = self._execute('SELECT value FROM commands ORDER BY id')
+        else:
+            rows = self._execute(f'SELECT value FROM commands WHERE status IN ({", ".join("?" * len(statuses))}) '
+                                 'ORDER BY id', tuple(statuses))
+        return [json.loads(row[0]) for row in rows]
+
+    def write_command(self, command: dict):
+        """ Adds or replaces a command of the queue
+        Args:
+            command (dict): Command, with its id
+        """
+        self._execute('INSERT OR REPLACE INTO commands (id, status, value) VALUES (?, ?, ?)',
+                      (command['id'], command['status'], json.dumps(command)))
+
+    def delete_command(self, command_id: str):
+        """ Removes a command from the queue
+        Args:
+            command_id (str): Id of the command
+        """
+        self._execute('DELETE FROM commands WHERE id = ?', (command_id,))
+
+    def migrate(self, legacy: FileStateStore) -> bool:
+        """ One-shot import of the state files of older versions, removed afterwards
+        Args:
+            legacy (FileStateStore): Store of the files layout
+        Returns:
+            bool: True if there was legacy state to migrate
+        """
+        state = legacy.get_state()
+        if all(value is None for value in state.values()):
+            return False
+        if self._execute('SELECT COUNT(*) FROM state')[0][0] == 0:
+            self.set_state(state)
+        legacy.clear()
+        return True
+
+    def export(self, target):
+        """ Copies the state to another store (i.e. to the files layout, for tools of older versions)
+        Args:
+            target (FileStateStore or SqliteStateStore): Destination
+        """
+        target.set_state(self.get_state())
+
+    def close(self):
+        """ Closes the database
+        """
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
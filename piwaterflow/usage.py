@@ -0,0 +1,210 @@
+""" Water usage rollups: runtime of every valve per day and program, maintained incrementally as the events are
+    appended, so that usage queries cost O(days) instead of replaying the whole events history.
+    Kept in a SQLite database next to the events journal. As they are derived from the events, they can always be
+    rebuilt from them (see rebuild).
+"""
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+GRANULARITIES = {'day': 'day',
+                 'week': 'iso_week(day)',
+                 'month': 'substr(day, 1, 7)',
+                 'year': 'substr(day, 1, 4)',
+                 'total': "'total'"}
+
+_EVENTS = ('ExecProg', 'ExecValve', 'ValveON', 'ValveOFF', 'ExecStuck')
+_CLOSING_EVENTS = ('ValveOFF', 'ExecStuck')
+
+
+def _iso_week(day: str) -> str:
+    """ Key of the ISO 8601 week of a day: weeks start on monday, and the days of a week that spans two years
+        belong to the year of its thursday (i.e. 2021-01-01 is in 2020-W53)
+    Args:
+        day (str): Day ('%Y-%m-%d')
+    Returns:
+        str: ISO year and week ('%G-W%V')
+    """
+    iso_year, iso_week, _ = datetime.strptime(day, '%Y-%m-%d').isocalendar()
+    return f'{iso_year}-W{iso_week:02d}'
+
+
+def _split_days(start: datetime, end: datetime):
+    """ Splits a time interval at midnight
+    Yields:
+        tuple: Day ('%Y-%m-%d') and seconds of the interval in that day
+    """
+    while start < end:
+        next_day = datetime.combine(start.date() + timedelta(days=1), datetime.min.time())
+        chunk_end = min(end, next_day)
+        yield start.strftime('%Y-%m-%d'), (chunk_end - start).total_seconds()
+        start = chunk_end
+
+
+class UsageRollups():
+    """ Per day, valve and program runtime, updated with every valve event
+    """
+    def __init__(self, path: str):
+        """__init__ of the class
+        Args:
+            path (str): Database file (":memory:" for a volatile one)
+        """
+        self.path = path
+        self._conn = None  # Opened on first use (see _connect)
+        self._conn_lock = threading.Lock()  # Events come from the loop and from the executor thread
+        self._program = ''
+
+    def __del__(self):
+        if getattr(self, '_conn', None) is not None:
+            self.close()
+
+    def _connect(self):
+        """ Opens the database on first use, so that the loops that do not touch the valves never pay for it.
+            Called with the connection lock held
+        Returns:
+            sqlite3.Connection: Connection
+        """
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.create_function('iso_week', 1, _iso_week)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS usage (day TEXT NOT NULL, valve TEXT NOT NULL, '
+                         'program TEXT NOT NULL, seconds REAL NOT NULL, runs INTEGER NOT NULL, '
+                         'PRIMARY KEY (day, valve, program))')
+            # Valves open right now (ON without OFF yet). Persisted, so that a takeover by another process closes them
+            conn.execute('CREATE TABLE IF NOT EXISTS open_valves (valve TEXT PRIMARY KEY, since TEXT NOT NULL, '
+                         'program TEXT NOT NULL)')
+            self._conn = conn
+        return self._conn
+
+    def is_empty(self) -> bool:
+        """ Returns if nothing was ever rolled up
+        Returns:
+            bool: True if empty
+        """
+        with self._conn_lock:
+            return self._connect().execute('SELECT COUNT(*) FROM usage').fetchone()[0] == 0
+
+    def _close_valve(self, valve: str, since: str, program: str, until: str):
+        self._conn.execute('DELETE FROM open_valves WHERE valve = ?', (valve,))
+        start = datetime.strptime(since, '%Y-%m-%d %H:%M:%S')
+        end = datetime.strptime(until, '%Y-%m-%d %H:%M:%S')
+        runs = 1
+        for day, seconds in _split_days(start, end) if end > start else [(start.strftime('%Y-%m-%d'), 0)]:
+            self._conn.execute('INSERT INTO usage (day, valve, program, seconds, runs) VALUES (?, ?, ?, ?, ?) '
+                               'ON CONFLICT (day, valve, program) DO UPDATE '
+                               'SET seconds = seconds + excluded.seconds, runs = runs + excluded.runs',
+                               (day, valve, program, seconds, runs))
+            runs = 0  # A run counts in the day it started
+
+    def _apply(self, event):
+        event_time, event_type, value = event[0], event[1], event[2]
+        if event_type == 'ExecProg':
+            self._program = value or ''
+        elif event_type == 'ExecValve':
+            self._program = ''  # Forced valve: no program
+        elif event_type == 'ValveON':
+            self._conn.execute('INSERT OR IGNORE INTO open_valves (valve, since, program) VALUES (?, ?, ?)',
+                               (value, event_time, self._program))
+        elif event_type == 'ValveOFF':
+            row = self._conn.execute('SELECT since, program FROM open_valves WHERE valve = ?', (value,)).fetchone()
+            if row:
+                self._close_valve(value, row[0], row[1], event_time)
+        elif event_type == 'ExecStuck':
+            # Valves were closed by the takeover
+            for valve, since, program in self._conn.execute('SELECT valve, since, program FROM open_valves').fetchall():
+                self._close_valve(valve, since, program, event_time)
+
+    def add(self, event):
+        """ Updates the rollups with a new event. Events that do not change the valves are ignored
+        Args:
+            event (tuple): Event (time string, event type, value)
+        """
+        if event[1] not in _EVENTS:
+            return
+        with self._conn_lock:
+            self._connect()
+            if event[1] not in _CLOSING_EVENTS:
+                self._apply(event)  # A single statement at most: no transaction needed
+                return
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._apply(event)
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def rebuild(self, events) -> int:
+        """ Reconstructs the rollups from the raw events, in a single transaction
+        Args:
+            events (iterable): All the events, oldest first
+        Returns:
+            int: Number of valve events applied
+        """
+        applied = 0
+        with self._conn_lock:
+            self._connect().execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute('DELETE FROM usage')
+                self._conn.execute('DELETE FROM open_valves')
+                self._program = ''
+                for event in events:
+                    if event[1] in _EVENTS:
+                        self._apply(event)
+                        applied += 1
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return applied
+
+    def usage(self, valve: str = None, since=None, until=None, granularity: str = 'day',
+              by_program: bool = False) -> list:
+        """ Valve runtime, aggregated by period
+        Args:
+            valve (str, optional): Only this valve. Defaults to None (all).
+            since (date, optional): First day included. Defaults to None.
+            until (date, optional): First day not included. Defaults to None.
+            granularity (str, optional): "day", "week" (ISO week, i.e. "2020-W53"), "month", "year" or "total".
+                                         Defaults to "day".
+            by_program (bool, optional): Split the runtime by program too. Defaults to False.
+        Returns:
+            list: Rows (oldest first) with period, valve, program (if by_program, None for forced valves), minutes
+                  and runs
+        """
+        period = GRANULARITIES.get(granularity)
+        if period is None:
+            raise ValueError(f'Unknown granularity: {granularity}')
+        conditions = []
+        parameters = []
+        if valve is not None:
+            conditions.append('valve = ?')
+            parameters.append(valve)
+        if since is not None:
+            conditions.append('day >= ?')
+            parameters.append(since.strftime('%Y-%m-%d'))
+        if until is not None:
+            conditions.append('day < ?')
+            parameters.append(until.strftime('%Y-%m-%d'))
+        where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+        group = 'period, valve, program' if by_program else 'period, valve'
+        with self._conn_lock:
+            rows = self._connect().execute(f'SELECT {period} AS period, valve, program, SUM(seconds), SUM(runs) '
+                                         f'FROM usage {where} GROUP BY {group} ORDER BY {group}',
+                                         parameters).fetchall()
+        result = []
+        for row_period, row_valve, program, seconds, runs in rows:
+            row = {'period': row_period, 'valve': row_valve, 'minutes': seconds / 60, 'runs': runs}
+            if by_program:
+                row['program'] = program or None
+            result.append(row)
+        return result
+
+    def close(self):
+        """ Closes the database
+        """
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,196 @@
+""" Water budget: scales the valve times of the programs with the evapotranspiration of the last days, instead of
+    adjusting them by hand.
+    Reads a local weather history (csv or json drop-in file, with date, tmin, tmax and rain columns), computes the
+    daily reference evapotranspiration (ET0, Hargreaves) and a soil water balance over the whole history, and scales
+    the configured times by the irrigation requirement of the last day, relative to the ET0 they were set for.
+    The series are vectorized with NumPy when it is installed (pip install piwaterflow[budget]), with a pure Python
+    fallback. The scale is computed once per day, and cached in a json file.
+"""
+import os
+import csv
+import json
+import math
+from datetime import date, datetime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_SOLAR_CONSTANT = 0.0820  # MJ/m2/min
+_MJ_TO_MM = 0.408  # Evaporation equivalent of the radiation
+
+
+def read_weather(path: str) -> dict:
+    """ Reads a weather history file: csv with header, or json list of objects
+    Args:
+        path (str): File, with date (YYYY-MM-DD), tmin and tmax (Celsius) and rain (mm, optional) per day
+    Returns:
+        dict: Columns (date, tmin, tmax, rain) as lists, sorted by date
+    """
+    with open(path, 'r', encoding="utf-8") as weather_file:
+        if path.endswith('.json'):
+            rows = json.load(weather_file)
+        else:
+            rows = list(csv.DictReader(weather_file))
+    rows.sort(key=lambda row: row['date'])
+    return {'date': [datetime.strptime(row['date'], '%Y-%m-%d').date() for row in rows],
+            'tmin': [float(row['tmin']) for row in rows],
+            'tmax': [float(row['tmax']) for row in rows],
+            'rain': [float(row.get('rain') or 0) for row in rows]}
+
+
+def hargreaves_et0(day_of_year, tmin, tmax, latitude: float):
+    """ Daily reference evapotranspiration (FAO-56, Hargreaves equation)
+    Args:
+        day_of_year (list): Day of the year (1-366) of each day
+        tmin (list): Min temperature (Celsius)
+        tmax (list): Max temperature (Celsius)
+        latitude (float): Latitude (degrees)
+    Returns:
+        list: ET0 (mm/day) of each day. A NumPy array if it is installed
+    """
+    phi = math.radians(latitude)
+    if np is not None:
+        day_of_year = np.asarray(day_of_year, dtype=float)
+        tmin = np.asarray(tmin, dtype=float)
+        tmax = np.asarray(tmax, dtype=float)
+        angle = 2 * np.pi * day_of_year / 365
+        inverse_distance = 1 + 0.033 * np.cos(angle)
+        declination = 0.409 * np.sin(angle - 1.39)
+        sunset_angle = np.arccos(np.clip(-math.tan(phi) * np.tan(declination), -1, 1))
+        radiation = 24 * 60 / np.pi * _SOLAR_CONSTANT * inverse_distance * \
+            (sunset_angle * math.sin(phi) * np.sin(declination) +
+             math.cos(phi) * np.cos(declination) * np.sin(sunset_angle))
+        return 0.0023 * ((tmin + tmax) / 2 + 17.8) * np.sqrt(np.maximum(tmax - tmin, 0)) * _MJ_TO_MM * radiation
+
+    result = []
+    for doy, low, high in zip(day_of_year, tmin, tmax):
+        angle = 2 * math.pi * doy / 365
+        inverse_distance = 1 + 0.033 * math.cos(angle)
+        declination = 0.409 * math.sin(angle - 1.39)
+        sunset_angle = math.acos(min(1, max(-1, -math.tan(phi) * math.tan(declination))))
+        radiation = 24 * 60 / math.pi * _SOLAR_CONSTANT * inverse_distance * \
+            (sunset_angle * math.sin(phi) * math.sin(declination) +
+             math.cos(phi) * math.cos(declination) * math.sin(sunset_angle))
+        result.append(0.0023 * ((low + high) / 2 + 17.8) * math.sqrt(max(high - low, 0)) * _MJ_TO_MM * radiation)
+    return result
+
+
+def soil_balance(et0, rain, capacity: float):
+    """ Daily irrigation requirement: ET0 not covered by the rain of the day, nor by the rain stored in the soil
+        (up to its capacity) from previous days. Irrigation is assumed to cover the requirement every day
+    Args:
+        et0 (list): ET0 (mm/day) of each day
+        rain (list): Rain (mm) of each day
+        capacity (float): Water the root zone holds (mm)
+    Returns:
+        tuple: Requirement and soil storage (mm) at the end of each day. NumPy arrays if it is installed
+    """
+    if np is not None:
+        return _soil_balance_vectorized(np.asarray(et0, dtype=float), np.asarray(rain, dtype=float), capacity)
+    storage = []
+    requirement = []
+    level = 0.0
+    for day_et0, day_rain in zip(et0, rain):
+        level += day_rain - day_et0
+        requirement.append(-level if level < 0 else 0.0)
+        level = min(capacity, max(0.0, level))
+        storage.append(level)
+    return requirement, storage
+
+
+def _soil_balance_vectorized(et0, rain, capacity: float):
+    """ soil_balance with NumPy. A day maps the storage of the previous day x to clip(x + balance, 0, capacity), and
+        a sequence of such clipped shifts is itself one: clip(x + shift, low, high). The composition up to every day
+        is computed with a prefix scan (cumulative shift, and clipped bounds), in log2(days) vectorized steps
+    """
+    balance = rain - et0
+    shift = balance.copy()
+    low = np.zeros(len(balance))
+    high = np.full(len(balance), float(capacity))
+    step = 1
+    while step < len(balance):
+        # Every day composes its range with the one "step" days before: both are computed from the previous step
+        later_shift, later_low, later_high = shift[step:], low[step:], high[step:]
+        low[step:], high[step:] = (np.clip(low[:-step] + later_shift, later_low, later_high),
+                                   np.clip(high[:-step] + later_shift, later_low, later_high))
+        shift[step:] = shift[:-step] + later_shift
+        step *= 2
+    storage = np.clip(shift, low, high)  # Empty soil before the first day
+    previous = np.concatenate(([0.0], storage[:-1]))
+    return np.maximum(-(previous + balance), 0), storage
+
+
+class WaterBudget():
+    """ Scale of the valve times, from the water budget of the weather history
+    """
+    def __init__(self, weather_path: str, cache_path: str, latitude: float, reference_et: float = 5,
+                 soil_capacity: float = 25, min_scale: float = 0, max_scale: float = 2, max_age_days: int = 3):
+        """__init__ of the class
+        Args:
+            weather_path (str): Weather history file (see read_weather)
+            cache_path (str): Cache file of the scale of the day
+            latitude (float): Latitude (degrees) of the garden
+            reference_et (float, optional): ET0 (mm/day) the configured valve times are meant for. Defaults to 5.
+            soil_capacity (float, optional): Rain the soil stores for the next days (mm). Defaults to 25.
+            min_scale (float, optional): Min scale. Defaults to 0 (skip watering).
+            max_scale (float, optional): Max scale. Defaults to 2.
+            max_age_days (int, optional): Weather older than this is outdated: times are not scaled. Defaults to 3.
+        """
+        self.weather_path = weather_path
+        self.cache_path = cache_path
+        self.latitude = latitude
+        self.reference_et = reference_et
+        self.soil_capacity = soil_capacity
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.max_age_days = max_age_days
+
+    def compute(self) -> dict:
+        """ Computes the water budget over the whole weather history
+        Returns:
+            dict: Columns (date, tmin, tmax, rain, et0, requirement, storage), one value per day
+        """
+        weather = read_weather(self.weather_path)
+        weather['et0'] = hargreaves_et0([day.timetuple().tm_yday for day in weather['date']],
+                                        weather['tmin'], weather['tmax'], self.latitude)
+        weather['requirement'], weather['storage'] = soil_balance(weather['et0'], weather['rain'],
+                                                                  self.soil_capacity)
+        return weather
+
+    def _cache_key(self) -> list:
+        stat = os.stat(self.weather_path)
+        return [stat.st_size, stat.st_mtime_ns, self.latitude, self.reference_et, self.soil_capacity,
+                self.min_scale, self.max_scale, self.max_age_days]
+
+    def scale(self, day: date) -> dict:
+        """ Returns the scale of the valve times of a day. Computed once per day (and weather file)
+        Args:
+            day (date): Day of the watering
+        Returns:
+            dict: scale, and the et0 and requirement (mm) of the last day of the history it comes from (None if the
+                  weather is outdated, then scale is 1)
+        """
+        key = self._cache_key()
+        try:
+            with open(self.cache_path, 'r', encoding="utf-8") as cache_file:
+                cache = json.load(cache_file)
+            if cache['day'] == day.isoformat() and cache['key'] == key:
+                return cache['budget']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        weather = self.compute()
+        budget = {'scale': 1.0, 'date': None, 'et0': None, 'requirement': None}
+        if weather['date'] and 0 <= (day - weather['date'][-1]).days <= self.max_age_days:
+            requirement = float(weather['requirement'][-1])
+            budget = {'scale': round(min(self.max_scale, max(self.min_scale, requirement / self.reference_et)), 2),
+                      'date': weather['date'][-1].isoformat(),
+                      'et0': round(float(weather['et0'][-1]), 2),
+                      'requirement': round(requirement, 2)}
+        tmp_path = f'{self.cache_path}.tmp'
+        with open(tmp_path, 'w', encoding="utf-8") as cache_file:
+            json.dump({'day': day.isoformat(), 'key': key, 'budget': budget}, cache_file)
+        os.replace(tmp_path, self.cache_path)
+        return budget
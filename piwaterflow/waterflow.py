@@ -6,6 +6,10 @@ import os
 import re
 import time
 import shutil
+import signal
+import weakref
+import threading
+from itertools import islice
 from datetime import datetime, timedelta
 from pathlib import Path
 import json
@@ -18,6 +22,44 @@ except (ModuleNotFoundError, ImportError, RuntimeError):
 
 from influxdb_wrapper import influxdb_factory
 from .config_waterflow import WaterflowConfig
+from .event_journal import EventJournal
+from .control_watcher import ControlWatcher
+from .control_server import ControlServer
+from .metrics import MetricsEmitter
+from .circuit_breaker import CircuitBreaker
+from .valve_scheduler import plan_valves, plan_actions
+from .executor import ProgramExecutor
+from .command_queue import CommandQueue, STOP, VALVE, PROGRAM, RUNNING, DONE, CANCELLED
+from .instrumentation import Instrumentation
+from .state_store import FileStateStore, SqliteStateStore, FILES
+from .process_lock import ProcessLock
+from .usage import UsageRollups
+from .flow_meter import FlowMeter
+from .sensors import SensorSampler, SensorError, sensor_factory
+from .water_budget import WaterBudget
+from .pin_state import PinState
+from .relay_drivers import relay_driver_factory
+
+_HEARTBEAT_INTERVAL = 30  # Seconds between heartbeats of the executor while a valve is open
+_LOCK_TIMEOUT = 5  # Max seconds readers wait for the loop lock (held by a loop deciding). The loop never waits
+_COMMANDS_SIGNAL = 'commands.signal'  # Touched in the homevar when a command is queued (see CommandQueue)
+
+
+def _weak_method(method):
+    """ Callback that calls a bound method without keeping its instance alive, so that the components of a
+        Waterflow can call it back without a reference cycle
+    Args:
+        method (method): Bound method
+    Returns:
+        callable: Callback. Does nothing once the instance is gone
+    """
+    reference = weakref.WeakMethod(method)
+
+    def callback(*args, **kwargs):
+        bound = reference()
+        return bound(*args, **kwargs) if bound is not None else None
+    return callback
+
 
 class Waterflow():
     """ Waterflow class that manages a loop system to activate/deactivate watering valves.
@@ -35,38 +77,213 @@ class Waterflow():
             template_config_path (str, optional): Template config to use. Defaults to None.
             dry_run (bool, optional): If true, it will just simulate, and wont make any change. Defaults to False.
         """
-        self.homevar = os.path.join(str(Path.home()), 'var', self.class_name())
-
+        self._closed = False
         self.dry_run = dry_run
         self.curr_time = fake_now
-
-        if dry_run:
-            self.homevar = os.path.join(self.homevar, 'dryrun')
-            if os.path.exists(self.homevar): # Only one instance of waterflow can run at a time, so this is safe
-                shutil.rmtree(self.homevar)
-            if not os.path.exists(self.homevar):
-                os.makedirs(self.homevar)
-
+        self.gpio = GPIO
         self.logger = logging.getLogger()
+        self.homevar = self._init_homevar()
 
         if not template_config_path:
             template_config_path = os.path.join(Path(__file__).parent.resolve(), './config-template.yml')
 
-        self.config = WaterflowConfig(package_name=self.class_name(),
-                                      template_path=template_config_path,
-                                      config_file_name="config.yml",
-                                      dry_run=dry_run)
-
-        self.events = self._read_events()
-
-        influx_conn_type = self.config['influxdbconn'].get('type', 'influx')
-        self.conn = influxdb_factory(influx_conn_type)
-        self.conn.open_conn(self.config['influxdbconn'])
+        config_start = time.perf_counter()
+        self.config = self._create_config(template_config_path)
+        self._config_lock = threading.Lock()
+
+        # Created once the config says if it is enabled: the config load is recorded afterwards
+        self.instrumentation = self._create_instrumentation()
+        self.instrumentation.record('config', time.perf_counter() - config_start)
+
+        with self.instrumentation.span('events'):
+            self.event_journal = self._create_event_journal()
+            self._events_lock = threading.Lock()
+            self.events = self._read_events()
+
+            self.rollups = self._create_rollups()  # Opened on first use
+            if self.events and not os.path.exists(self.rollups.path):
+                self.logger.info('Water usage rolled up from %s events.', self.rebuild_usage())
+
+        self._daemon_running = False
+        self._control_watcher = None
+        self._stop_watcher = None
+
+        self.state = self._create_state_store()
+        self.loop_lock = self._create_loop_lock()
+        self.commands = self._create_command_queue()
+        self.executor = self._create_executor()
+        self.pins = self._create_pins()
+        self.flow_meter = self._create_flow_meter()
+        self.sensors = self._create_sensor_sampler()
+        self._sensor_timeout = (self.config['sensor'] or {}).get('timeout', 2)
+        self.water_budget = self._create_water_budget()
+
+        # Influx connection is opened on first use (see conn)
+        self._conn = None
+        self.metrics = self._create_metrics()
+
+    # Factories of the components, overridden by the simulation (see SimulatedWaterflow)
+
+    def _init_homevar(self) -> str:
+        """ Folder of the state of the waterflow. A dry run starts with an empty one
+        Returns:
+            str: Path
+        """
+        homevar = os.path.join(str(Path.home()), 'var', self.class_name())
+        if self.dry_run:
+            homevar = os.path.join(homevar, 'dryrun')
+            if os.path.exists(homevar): # Only one instance of waterflow can run at a time, so this is safe
+                shutil.rmtree(homevar)
+            if not os.path.exists(homevar):
+                os.makedirs(homevar)
+        return homevar
+
+    def _create_config(self, template_config_path: str) -> WaterflowConfig:
+        return WaterflowConfig(package_name=self.class_name(),
+                               template_path=template_config_path,
+                               config_file_name="config.yml",
+                               dry_run=self.dry_run)
+
+    def _create_instrumentation(self) -> Instrumentation:
+        instrumentation_config = self.config['instrumentation'] or {}
+        return Instrumentation(self._get_homevar_path('timings.json'),
+                               enabled=instrumentation_config.get('enabled', False),
+                               on_flush=_weak_method(self._emit_timing_metrics))
+
+    def _create_event_journal(self) -> EventJournal:
+        events_config = self.config['events'] or {}
+        event_journal = EventJournal(self._get_homevar_path('events.jsonl'),
+                                     fsync=events_config.get('fsync', 'always'),
+                                     fsync_interval=events_config.get('fsync_interval', 5),
+                                     segment_max_kb=events_config.get('segment_max_kb', 0),
+                                     segment_max_days=events_config.get('segment_max_days', 0))
+        if event_journal.migrate(self._get_homevar_path('events')):
+            self.logger.info('Legacy events file migrated to the events journal.')
+        return event_journal
+
+    def _create_rollups(self) -> UsageRollups:
+        return UsageRollups(self._get_homevar_path('usage.db'))
+
+    def _create_state_store(self):
+        state_config = self.config['state'] or {}
+        if state_config.get('store', 'sqlite') == FILES:
+            return FileStateStore(self.homevar)
+        state = SqliteStateStore(self._get_homevar_path('state.db'))
+        if state.migrate(FileStateStore(self.homevar)):
+            self.logger.info('Legacy state files migrated to the state store.')
+        return state
+
+    def _create_loop_lock(self) -> ProcessLock:
+        return ProcessLock(self._get_homevar_path('loop.lock'))
+
+    def _create_command_queue(self) -> CommandQueue:
+        return CommandQueue(self.state, signal_path=self._get_homevar_path(_COMMANDS_SIGNAL))
+
+    def _create_executor(self) -> ProgramExecutor:
+        return ProgramExecutor(self.state,
+                               stuck_timeout=(self.config['max_stuck_time'] or 5) * 60,
+                               on_finish=_weak_method(self._execution_finished))
+
+    def _create_pins(self) -> PinState:
+        return PinState(relay_driver_factory(self.config['relays'] or {}, self.gpio))
+
+    def _create_flow_meter(self) -> FlowMeter:
+        flow_meter_config = self.config['flow_meter'] or {}
+        return FlowMeter(self.gpio, flow_meter_config.get('pin', 0),
+                         pulses_per_liter=flow_meter_config.get('pulses_per_liter', 450),
+                         bouncetime=flow_meter_config.get('bouncetime', 0))
+
+    def _create_sensor_sampler(self):
+        sensor_config = self.config['sensor'] or {}
+        try:
+            sensor = sensor_factory(sensor_config)
+        except SensorError as ex:
+            self.logger.error('Sensor disabled: %s', str(ex))
+            sensor = None
+        if sensor is None:
+            return None
+        return SensorSampler(sensor, self._get_homevar_path('sensors.json'),
+                             interval=sensor_config.get('interval', 60),
+                             window=sensor_config.get('window', 5),
+                             max_age=sensor_config.get('max_age', 600))
+
+    def _create_water_budget(self):
+        budget_config = self.config['water_budget'] or {}
+        if not budget_config.get('enabled', False):
+            return None
+        return WaterBudget(os.path.expanduser(budget_config['weather_path']),
+                           self._get_homevar_path('water_budget.json'),
+                           latitude=budget_config.get('latitude', 40),
+                           reference_et=budget_config.get('reference_et', 5),
+                           soil_capacity=budget_config.get('soil_capacity', 25),
+                           min_scale=budget_config.get('min_scale', 0),
+                           max_scale=budget_config.get('max_scale', 2),
+                           max_age_days=budget_config.get('max_age_days', 3))
+
+    def _create_metrics(self):
+        pipeline_config = self.config['metrics_pipeline'] or {}
+        influx_breaker = CircuitBreaker(self._get_homevar_path('influx_breaker.json'),
+                                        failure_threshold=pipeline_config.get('breaker_threshold', 2),
+                                        reset_timeout=pipeline_config.get('breaker_reset_time', 10) * 60)
+        waterflow = weakref.ref(self)  # No reference cycle (see _weak_method)
+        return MetricsEmitter(lambda: waterflow().conn, self._get_homevar_path('metrics.spool'),
+                              queue_size=pipeline_config.get('queue_size', 1000),
+                              batch_size=pipeline_config.get('batch_size', 100),
+                              flush_interval=pipeline_config.get('flush_interval', 2),
+                              breaker=influx_breaker)
 
     def __del__(self):
+        self._release()  # Only a safety net: the homevar of a dry run is removed by close()
+
+    def close(self):
+        """ Stops the background threads, and closes the files and databases. A dry run also removes its homevar
+        """
+        self._release()
         if self.dry_run and os.path.exists(self.homevar):
             shutil.rmtree(self.homevar)
 
+    def _release(self):
+        # Also called for a partly built instance (__init__ failed): only what was created is released
+        if getattr(self, '_closed', True):
+            return
+        self._closed = True
+        if getattr(self, 'sensors', None):
+            self.sensors.close()
+        if getattr(self, 'instrumentation', None):
+            self.instrumentation.flush()
+        for name in ('metrics', 'event_journal', 'rollups', 'state', '_control_watcher', '_stop_watcher'):
+            resource = getattr(self, name, None)
+            if resource is not None:
+                resource.close()
+
+    @property
+    def conn(self):
+        """ Influx connection. Opened on first use, so that runs that emit no metrics never pay for it
+        Returns:
+            DBConn: Connection
+        """
+        if self._conn is None:
+            influx_conn_type = self.config['influxdbconn'].get('type', 'influx')
+            with self.instrumentation.span('connect'):
+                conn = influxdb_factory(influx_conn_type)
+                conn.open_conn(self.config['influxdbconn'])
+            self._conn = conn
+        return self._conn
+
+    def _now(self) -> datetime:
+        """ Current time. Overridden by the simulation, that runs with a virtual clock
+        Returns:
+            datetime: Current time (naive local)
+        """
+        return datetime.now()
+
+    def _monotonic(self) -> float:
+        """ Clock to measure intervals. Overridden by the simulation, that runs with a virtual clock
+        Returns:
+            float: Seconds
+        """
+        return time.monotonic()
+
     @classmethod
     def class_name(cls):
         """ class name """
@@ -82,11 +299,17 @@ class Waterflow():
         """
         # TODO: Verify parameters in bounds
 
-        # Update config in mem
-        self.config.update({'programs': programs})
+        # Updates come from the control server threads: each one applied and written whole
+        with self._config_lock:
+            # Update config in mem
+            self.config.update({'programs': programs})
+
+            # Write back config to disk
+            self.config.write()
 
-        # Write back config to disk
-        self.config.write()
+        # A running daemon must recalculate its next deadline
+        if self._control_watcher:
+            self._control_watcher.notify()
 
     def _get_program_data(self, program):
         return next(iter(program.values()))
@@ -112,135 +335,120 @@ class Waterflow():
         return datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S').astimezone()
 
     def _setup_gpio(self, valves):
-        GPIO.setmode(GPIO.BOARD)
-        GPIO.setwarnings(False)
-
-        GPIO.setup(self.config['inverter_relay_pin'], GPIO.OUT)
-        GPIO.output(self.config['inverter_relay_pin'], GPIO.LOW)
-        GPIO.setup(self.config['external_ac_signal_pin'], GPIO.IN)
-        for valve in valves.values():
-            GPIO.setup(valve['pin'], GPIO.OUT)
-            GPIO.output(valve['pin'], GPIO.LOW)
+        # Only declared: the hardware is set up when an execution drives them (see PinState)
+        external_ac_signal_pin = self.config['external_ac_signal_pin']
+        self.pins.declare([self.config['inverter_relay_pin']] + [valve['pin'] for valve in valves.values()],
+                          inputs=[external_ac_signal_pin] if external_ac_signal_pin else [])
 
     def _recalc_next_program(self, last_program_time: datetime):
         """ Calculates which is the next program to be executed, depending on the one previously executed
         Args:
             last_program_time: (datetime): Time in which previous program was executed (local aware to watering system)
-            today (datetime, optional): Naive time to make the calculations. Normally used just for debug/unittesting
         Returns:
             tuple: time of next program, and program name
         """
-        next_program_time = None
-        program_name = None
-
-        # Only used to get "today"... hour and minute will be overwritten for comparations with last_program_time
-        current_time = self.curr_time.astimezone().replace(microsecond=0)
-
-        prog_list = self.config['programs']
-        prog_list.sort(key=lambda prog: prog['start_time'])
-
-        # Find if next program is today, considering the last program time executed
-        for program in prog_list:
-            if program['enabled'] is True:
-                candidate_time = current_time.replace(hour=program['start_time'].hour,
-                                                      minute=program['start_time'].minute,
-                                                      second=0).astimezone()
-                # If this candidate is after the last one executed AND its not older than 10 minutes, choose it
-                if candidate_time > last_program_time:
-                    next_program_time = candidate_time
-                    program_name = program['name']
-                    break
-
-        # If its not today, it could be tomorrow... find the first one enabled
-        if next_program_time is None:
-            for program in prog_list:
-                if program['enabled'] is True:
-                    next_program_time = current_time + timedelta(days=1)
-                    next_program_time = next_program_time.replace(hour=program['start_time'].hour,
-                                                                  minute=program['start_time'].minute,
-                                                                  second=0).astimezone()
-                    program_name = program['name']
-                    break
+        with self.instrumentation.span('schedule'):
+            # Only used to get "today"... hour and minute will be overwritten for comparations with last_program_time
+            current_time = self.curr_time.astimezone().replace(microsecond=0)
 
-        return next_program_time, program_name
-
-    def _last_program_path(self):
-        return self._get_homevar_path('lastprogram.yml')
+            return self.config.schedule.next_program(current_time, last_program_time)
 
     def _read_last_program_time(self, default: datetime = None):
-        last_program_path = self._last_program_path()
+        last_program_str = self.state.read_last_program()
 
-        if os.path.exists(last_program_path):
-            with open(last_program_path, 'r', encoding="utf-8") as file:
-                data = file.readlines()
-                last_program_time = self.str_to_time(data[0][:-1])
+        if last_program_str:
+            last_program_time = self.str_to_time(last_program_str)
         else:
             if default:
                 last_program_time = default.astimezone()
             else:
-                last_program_time = datetime.now().astimezone()
-            with open(last_program_path, 'w', encoding="utf-8") as file:
-                time_str = self.time_to_str(last_program_time)
-                file.writelines([time_str, time_str])
+                last_program_time = self._now().astimezone()
+            self._write_last_program_time(last_program_time)
         return last_program_time
 
     def _write_last_program_time(self, time_last: datetime):
-        last_program_path = self._last_program_path()
-        with open(last_program_path, 'w', encoding="utf-8") as file:
-            file.write(self.time_to_str(time_last))
+        self.state.write_last_program(self.time_to_str(time_last))
 
     def get_lock(self):
         """
         This is to ensure that only one execution will run from cron at the same time
-        Use file as a lock... not using DB locks because we want to maximize resiliency
+        Kernel lock (see process_lock): released as soon as the owner dies, so a crashed loop is detected right away
         """
-        lock_path = self._get_homevar_path('lock')
-
-        if not os.path.exists(lock_path):
-            with open(lock_path, 'w', encoding="utf-8"):
-                return True
-        else:
-            modified_time = datetime.fromtimestamp(os.path.getmtime(lock_path)).astimezone()
-            if (datetime.now().astimezone() - modified_time) > timedelta(minutes=self.config['max_loop_time']):
-                self._add_event('LockExpired', self.time_to_str(modified_time))
-                Path(lock_path).touch()  # Previous token expired (previous loop crashed?)... we will retouch to retry
-                return True
-        return False
+        if not self.loop_lock.acquire():  # Never waits: a cron tick overlapping a loop returns right away
+            owner = self.loop_lock.owner()
+            if owner and time.time() - owner.get('heartbeat', 0) > self.config['max_loop_time'] * 60:
+                self.logger.error('Loop lock held by process %s with no heartbeat since %s. Hung?',
+                                  owner.get('pid'), self.time_to_str(datetime.fromtimestamp(owner['heartbeat'])))
+            return False
+        stale_owner = self.loop_lock.stale_owner
+        if stale_owner is not None:  # Previous owner died holding it
+            self.logger.warning('Loop lock of process %s (dead) taken over.', stale_owner.get('pid'))
+            stale_time = datetime.fromtimestamp(stale_owner.get('heartbeat', time.time()))
+            self._add_event('LockExpired', self.time_to_str(stale_time))
+        return True
 
     def release_lock(self):
         """Lock the loop... so the 2 loops cannot happen at the same time
         """
-        lock_path = self._get_homevar_path('lock')
-
-        if os.path.exists(lock_path):
-            os.remove(lock_path)
-        else:
+        if not self.loop_lock.release():
             self._add_event('CannotUnlock', None)
 
+    def _shared_lock(self):
+        """ Lock for readers: they can read at the same time, and only wait for a loop deciding (not watering)
+        Returns:
+            context manager: Shared lock
+        """
+        return self.loop_lock.shared(_LOCK_TIMEOUT)
+
     def is_looping_correctly(self):
         """ Returns if a loop has succesfully run in the last x minutes
         Returns:
            bool: 
         """
-        time_now = datetime.now().astimezone()
+        time_now = self._now().astimezone()
         return (time_now - self.last_loop_time()) < timedelta(minutes=self.config['max_loop_time'])
 
+    def _touch_token(self):
+        self.state.touch_token()
+
     def last_loop_time(self):
         """ Returns the last time in that a loop was succesfully executed
         Returns:
            datetime: Time in which last loop was executed
         """
-        token_path = self._get_homevar_path('token')
-        if os.path.exists(token_path):
-            mod_time_since_epoc = os.path.getmtime(token_path)
-            modification_time = datetime.fromtimestamp(mod_time_since_epoc).astimezone()
+        token_time = self.state.read_token()
+        if token_time is not None:
+            modification_time = datetime.fromtimestamp(token_time).astimezone()
         else:
-            modification_time = datetime.fromtimestamp(0) # Loop never run ok. Return oldest possible date
+            modification_time = datetime.fromtimestamp(0).astimezone() # Loop never run ok. Oldest possible date
 
         return modification_time
 
+    def enqueue(self, type_command: str, value: str = None):
+        """ Queues a command for the loop. Identical pending commands are only queued once
+        Args:
+            type_command (str): Can be "stop", "valve" or "program"
+            value (str, optional): Name of the valve or program. Defaults to None.
+        Returns:
+            str: Id of the command, to query its status (see get_command). None if the valve or program is unknown
+        """
+        if (type_command == PROGRAM and self._get_program(value)) or \
+           (type_command == VALVE and self._get_valve_data(value)) or \
+           type_command == STOP:
+            return self.commands.push(type_command, value)
+        return None
+
+    def get_command(self, command_id: str):
+        """ Returns a queued command, with its status (queued, running, done or cancelled)
+        Args:
+            command_id (str): Id returned by enqueue
+        Returns:
+            dict: Command, or None if unknown
+        """
+        return self.commands.get(command_id)
+
     def force(self, type_force: str, value: str):
-        """ Set the force-flag, so that the loop will start the execution of a program or valve
+        """ Queues a forced execution of a program or valve
             If a program is forced, it will execute with the times defined in the config
             If a valve is forced, it will start delivering water, until manually stopped
         Args:
@@ -250,66 +458,155 @@ class Waterflow():
         Returns:
             bool: If forced correctly
         """
-        if (type_force == 'program' and self._get_program(value)) or \
-           (type_force == 'valve' and self._get_valve_data(value)):
-            with open(self._get_homevar_path('force'), 'w', encoding="utf-8") as force_file:
-                force_file.write(f'{{"type":"{type_force}","value":"{value}"}}')
-                return True
-        else:
+        if type_force not in (PROGRAM, VALVE):
             return False
+        return self.enqueue(type_force, value) is not None
 
     def stop(self):
-        """ Set the Stop-flag, so that the loop will stop the forced valve or program execution
+        """ Queues a stop, so that the loop will stop the forced valve or program execution
+            It has priority over any other command, and cancels the pending forced ones
         Returns:
-            _type_: _description_
+            bool: If stop was requested
         """
-        stop_req_path = self._get_homevar_path('stop')
-        Path(stop_req_path).touch()
+        self.enqueue(STOP)
         return True
 
     def stop_remove(self):
-        """ Returns if a stop has already been requested
-        Returns:
-           bool: Return true if a stop has been requested
+        """ Marks the pending stops as done
         """
-        stop_req_path = self._get_homevar_path('stop')
-        return os.remove(stop_req_path)
+        for command in self.commands.pending():
+            if command['type'] == STOP:
+                self.commands.set_status(command['id'], DONE)
 
     def stop_requested(self):
         """ Returns if a stop has already been requested
         Returns:
            bool: Return true if a stop has been requested
         """
-        stop_req_path = self._get_homevar_path('stop')
-        return os.path.exists(stop_req_path)
+        return any(command['type'] == STOP for command in self.commands.pending())
 
     def get_forced_info(self):
-        """ Returns the forced info of the waterflow
+        """ Returns the forced info of the waterflow: the next forced program or valve to be executed
         Returns:
-            dict: Forced info
+            dict: Forced info (type and value), or None
+        """
+        for command in self.commands.pending():
+            if command['type'] != STOP:
+                return {'type': command['type'], 'value': command['value']}
+        return None
+
+    def _import_legacy_requests(self):
+        """ Queues the requests written as files by older versions (single "force" file, and "stop" file)
         """
         force_file_path = self._get_homevar_path('force')
         if os.path.exists(force_file_path):
-            with open(force_file_path, 'r', encoding="utf-8") as force_file:
-                data = json.load(force_file)
-                return data
-        else:
-            return None
+            try:
+                with open(force_file_path, 'r', encoding="utf-8") as force_file:
+                    data = json.load(force_file)
+                self.force(data.get('type'), data.get('value'))
+            except ValueError:
+                self.logger.error('Invalid force file ignored.')
+            os.remove(force_file_path)
+        stop_file_path = self._get_homevar_path('stop')
+        if os.path.exists(stop_file_path):
+            self.stop()
+            os.remove(stop_file_path)
+
+    def export_state(self, path: str):
+        """ Writes the controller state (lock, token and lastprogram.yml) in the files layout of older versions
+        Args:
+            path (str): Destination folder
+        """
+        os.makedirs(path, exist_ok=True)
+        self.state.export(FileStateStore(path))
 
-    def _add_event(self, event: str, value):
-        self.events.append((self.time_to_str(datetime.now()), event, value))
+    def get_status(self) -> dict:
+        """ Returns a summary of the waterflow state, as shown in the wwwaterflow
+        Returns:
+            dict: Status (version, forced info, stop requested, last loop time, looping correctly, next program,
+                  execution in progress, relays)
+        """
+        with self._shared_lock():
+            next_program = None
+            for event in reversed(self.events):
+                if event[1] == 'LastProg':
+                    next_program = event[2]
+                    break
+            return {'version': self.get_version(),
+                    'forced': self.get_forced_info(),
+                    'stop_requested': self.stop_requested(),
+                    'last_loop_time': self.time_to_str(self.last_loop_time()),
+                    'looping_correctly': self.is_looping_correctly(),
+                    'next_program': next_program,
+                    'execution': self.executor.get_state(),
+                    'relays': self.get_relays()}
+
+    def get_relays(self) -> dict:
+        """ Returns the state of the relays, as applied by this process (i.e. the daemon), without touching the
+            hardware
+        Returns:
+            dict: inverter and every valve: True (on), False (off), or None if not driven by this process
+        """
+        pins = {'inverter': self.config['inverter_relay_pin']}
+        pins.update({name: valve['pin'] for name, valve in self.config['valves'].items()})
+        relays = {}
+        for name, pin in pins.items():
+            level = self.pins.state(pin)
+            relays[name] = None if level is None else level == GPIO.HIGH
+        return relays
 
-        events_file_path = self._get_homevar_path('events')
-        with open(events_file_path, 'w', encoding="utf-8") as events_file:
-            json.dump(self.events, events_file)
+    def _add_event(self, event: str, value):
+        new_event = (self.time_to_str(self._now()), event, value)
+        with self._events_lock, self.instrumentation.span('events_write'):  # Events come from loop and executor
+            if self.event_journal.append(new_event):
+                self.events.clear()  # Segment rotated: memory only mirrors the current segment
+            self.events.append(new_event)
+            self.rollups.add(new_event)
 
     def _read_events(self):
-        events = []
-        events_file_path = self._get_homevar_path('events')
-        if os.path.exists(events_file_path):
-            with open(events_file_path, 'r', encoding="utf-8") as events_file:
-                events = json.load(events_file)
-        return events
+        return self.event_journal.read()
+
+    def compact_events(self):
+        """ Applies the events retention policy (compress old segments, delete expired archives).
+            Runs outside of the watering critical path, at most once a day
+        """
+        marker_path = self._get_homevar_path('compacted')
+        if os.path.exists(marker_path) and \
+           time.time() - os.path.getmtime(marker_path) < timedelta(days=1).total_seconds():
+            return
+        events_config = self.config['events'] or {}
+        try:
+            changes = self.event_journal.compact(hot_days=events_config.get('hot_days', 0),
+                                                 archive_days=events_config.get('archive_days', 0))
+            if changes:
+                self.logger.info('Events compaction: %s segments compressed or deleted.', changes)
+        except OSError as ex:
+            self.logger.error('Events compaction failed: %s', str(ex))
+        Path(marker_path).touch()
+
+    def usage(self, valve: str = None, since: datetime = None, until: datetime = None, granularity: str = 'day',
+              by_program: bool = False) -> list:
+        """ Returns how long the valves watered, from the rollups maintained as events are added
+        Args:
+            valve (str, optional): Only this valve. Defaults to None (all).
+            since (datetime, optional): First day included. Defaults to None.
+            until (datetime, optional): First day not included. Defaults to None.
+            granularity (str, optional): "day", "week" (ISO week, i.e. "2020-W53"), "month", "year" or "total".
+                                         Defaults to "day".
+            by_program (bool, optional): Split the runtime by program too. Defaults to False.
+        Returns:
+            list: Rows (oldest first) with period, valve, program (if by_program), minutes and runs
+        """
+        return self.rollups.usage(valve=valve, since=since, until=until, granularity=granularity,
+                                  by_program=by_program)
+
+    def rebuild_usage(self) -> int:
+        """ Reconstructs the water usage rollups from the whole events history (archived segments included)
+        Returns:
+            int: Number of valve events applied
+        """
+        with self._events_lock:
+            return self.rollups.rebuild(self.event_journal.iter_events(archived=True))
 
     def _get_event_string(self, event: tuple):
         if event[1] == 'ExecProg':
@@ -339,6 +636,14 @@ class Waterflow():
             result = f'Forced valve {event[2]} executing now.'
         elif event[1] == 'Stop':
             result = 'Activity stopped.'
+        elif event[1] == 'ExecStuck':
+            result = f'Execution of {event[2]} stuck: valves closed.'
+        elif event[1] == 'Budget':
+            result = f'Water budget: valve times at {event[2]:.0%}.'
+        elif event[1] == 'HumiditySkip':
+            result = f'Program skipped: humidity {event[2]}% above threshold.'
+        elif event[1] == 'Flow':
+            result = f'Valve {event[2][0]} delivered {event[2][1]} liters ({event[2][2]} pulses).'
         elif event[1] == 'Exception':
             result = f'Error looping: {event[2]}'
         else:
@@ -346,41 +651,119 @@ class Waterflow():
 
         return f'{event[0]}:{result}'
 
+    def iter_log(self, since: datetime = None, until: datetime = None, limit: int = None, reverse: bool = True,
+                 archived: bool = False):
+        """ Iterates over the user log lines. Cost is proportional to the lines returned, not to the whole history
+        Args:
+            since (datetime, optional): Only events at or after this time. Defaults to None.
+            until (datetime, optional): Only events before this time. Defaults to None.
+            limit (int, optional): Maximum number of lines. Defaults to None (no limit).
+            reverse (bool, optional): Newest lines first. Defaults to True.
+            archived (bool, optional): Include the archived (compressed) events too. Defaults to False.
+        """
+        events = self.event_journal.iter_range(since=self.time_to_str(since) if since else None,
+                                               until=self.time_to_str(until) if until else None,
+                                               reverse=reverse,
+                                               archived=archived)
+        for event in islice(events, limit):
+            yield self._get_event_string(event)
+
     def get_log(self):
         """ Get the user log (not the debug log). This is the one the is shown in the wwwaterflow
         Returns:
             str: The whole user logs
         """
-        log = ''
-        for event in self.events:
-            log += f'{self._get_event_string(event)}\n'
-        return log
+        with self._shared_lock():
+            return ''.join(f'{line}\n' for line in self.iter_log(reverse=False))
+
+    def _get_control_watcher(self) -> ControlWatcher:
+        """ Watcher of the command queue, created on first use
+        Returns:
+            ControlWatcher: Watcher that wakes up when a command (stop or force) is queued
+        """
+        if self._control_watcher is None:
+            self._control_watcher = ControlWatcher(self.homevar, (_COMMANDS_SIGNAL,))
+        return self._control_watcher
+
+    def _get_stop_watcher(self) -> ControlWatcher:
+        """ Watcher of the command queue for the executor thread (a watcher cannot be shared between threads)
+        Returns:
+            ControlWatcher: Watcher that wakes up when a command (i.e. stop) is queued
+        """
+        if self._stop_watcher is None:
+            self._stop_watcher = ControlWatcher(self.homevar, (_COMMANDS_SIGNAL,))
+        return self._stop_watcher
+
+    def _stopping(self):
+        return self.stop_requested() or self.executor.stopping()
 
     def _sleep(self, time_sleep):
-        """ Sleep "time_sleep" time, but checks every 5 seconds if a stop has been requested
+        """ Sleep "time_sleep" time, but wakes up as soon as a stop has been requested
         Args:
             time_sleep (int): Number of seconds to sleep
         """
-        time_count = 0
-
         # Clamp sleep time... as safety. Never let a valve stay ON more than this
         if time_sleep > self.config['max_valve_time']*60:
             time_sleep = self.config['max_valve_time']*60
             self.logger.info('Valve time clamped to %s minutes.', self.config["max_valve_time"])
 
-        while not self.stop_requested() and time_count < time_sleep:
-            time_count = time_count + 5
-            time.sleep(5)  # Every X seconds
+        watcher = self._get_stop_watcher()
+        end_time = time.monotonic() + time_sleep
+        while not self._stopping():
+            remaining = end_time - time.monotonic()
+            if remaining <= 0:
+                break
+            watcher.wait(min(remaining, _HEARTBEAT_INTERVAL))
+            if not self.executor.heartbeat():
+                break
+
+    def _emit_timing_metrics(self, samples: list):
+        """ Emits the durations recorded by the instrumentation, if enabled in the config
+        Args:
+            samples (list): (phase, seconds) recorded since the previous flush
+        """
+        if self.config['metrics'] and (self.config['instrumentation'] or {}).get('metrics', False):
+            for phase, seconds in samples:
+                self.metrics.emit("piwaterflow_timings", {
+                    "tags": {"phase": phase},
+                    "fields": {"duration_ms": seconds * 1000}
+                })
+
+    def get_timings(self) -> dict:
+        """ Returns the histograms of the durations of the phases (config, events, connect, lock, setup_gpio,
+            schedule, execution, events_write and cleanup), accumulated by all the processes
+        Returns:
+            dict: Histogram per phase (see Instrumentation.histograms). Empty if the instrumentation is disabled
+        """
+        return self.instrumentation.histograms()
 
     def _emit_action_metric(self, action, forced):
-        if self.config['metrics'] and self.conn:
-            action_body = [
-                {
-                    "tags": {"action": action, "forced": forced},
-                    "fields": {"fake": 0}
-                }
-            ]
-            self.conn.insert("piwaterflow", action_body)
+        if self.config['metrics']:
+            # Queued: sent in background, so valve timing never waits for the database
+            self.metrics.emit("piwaterflow", {
+                "tags": {"action": action, "forced": forced},
+                "fields": {"fake": 0}
+            })
+
+    def _emit_flow_metric(self, valve: str, pulses: int, liters: float):
+        if self.config['metrics']:
+            self.metrics.emit("piwaterflow_flow", {
+                "tags": {"valve": valve},
+                "fields": {"pulses": pulses, "liters": liters}
+            })
+
+    def _record_flow(self, valve: str, start_pulses: int):
+        """ Flushes the pulses counted during a valve activation to the events and metrics, in a single batch
+        Args:
+            valve (str): Valve just closed
+            start_pulses (int): Pulses of the meter when it was opened (see FlowMeter.pulses)
+        """
+        if not self.flow_meter.enabled:
+            return
+        pulses = self.flow_meter.pulses() - start_pulses
+        liters = round(self.flow_meter.liters(pulses), 2)
+        self._add_event('Flow', [valve, liters, pulses])
+        self._emit_flow_metric(valve, pulses, liters)
 
     def _execute_valve(self, valve):
         # ------------------------------------
@@ -388,53 +771,66 @@ class Waterflow():
         # if inverter_enable: # If we dont have external 220V power input, then activate inverter
         self._add_event('ExecValve', valve)
 
-        GPIO.output(self.config['inverter_relay_pin'], GPIO.HIGH)
-        self._add_event('InverterON', None)
         valve_pin = self.config['valves'][valve]['pin']
-        GPIO.output(valve_pin, GPIO.HIGH)
+        start_pulses = self.flow_meter.pulses()
+        with self.pins.batch():
+            self.pins.set(self.config['inverter_relay_pin'], GPIO.HIGH)
+            self.pins.set(valve_pin, GPIO.HIGH)
+        self._add_event('InverterON', None)
         self._add_event('ValveON', valve)
+        self.executor.heartbeat(valves=[valve])
 
         # If dry run, then we fast forward the sleep
         if not self.dry_run:
             self._sleep(self.config['max_valve_time']*60)
 
-        GPIO.output(valve_pin, GPIO.LOW)
+        with self.pins.batch():
+            self.pins.set(valve_pin, GPIO.LOW)
+            # if inverter_enable: # If we dont have external 220V power input, then activate inverter
+            self.pins.set(self.config['inverter_relay_pin'], GPIO.LOW)  # INVERTER always OFF after operations
         self._add_event('ValveOFF', valve)
-        # if inverter_enable: # If we dont have external 220V power input, then activate inverter
-        GPIO.output(self.config['inverter_relay_pin'], GPIO.LOW)  # INVERTER always OFF after operations
+        self._record_flow(valve, start_pulses)
         self._add_event('InverterOFF', None)
 
-    def _skip_program(self):
-        # print(self.config['humidity_threshold'])
-        # if self.is_raspberry_pi():
-        #     import adafruit_dht
-        #     dhtSensor = adafruit_dht.DHT22(self.config['pin'])
-        #     humidity = dhtSensor.humidity
-        #     temp_c = dhtSensor.temperature
-        #     if humidity >= self.config['humidity_threshold']:
-        #         self.logger.info('(humidity {} > {}.'.format(humidity, self.config['humidity_threshold']))
-        #         return True
-        #     else:
-        #         return False
-        # else:
-        #    return False
+    def _skip_program(self) -> bool:
+        """ Returns if the program due is skipped because of the humidity. Answered from the moving average of the
+            background samples: it waits for a sample at most the sensor timeout, and never skips with a stale one
+        """
+        if self.sensors is None or not self.config['humidity_threshold']:
+            return False
+        humidity, age = self.sensors.average('humidity', timeout=self._sensor_timeout)
+        if humidity is None:
+            self.logger.warning('No recent humidity reading: program not skipped.')
+            return False
+        if humidity >= self.config['humidity_threshold']:
+            self.logger.info('Humidity %.1f%% (%d seconds ago) above %s%%: program skipped.', humidity, age,
+                             self.config['humidity_threshold'])
+            self._add_event('HumiditySkip', round(humidity, 1))
+            return True
         return False
 
     def _get_program(self, program_name: str):
-        program = None
-        for program_it in self.config['programs']:
-            if program_it['name'] == program_name:
-                program = program_it
-                break
-        return program
+        return self.config.schedule.programs.get(program_name)
 
     def _get_valve_data(self, valve_name: str):
-        valve_data = None
-        for it_valve_name, it_valve_data in self.config['valves'].items():
-            if it_valve_name == valve_name:
-                valve_data = it_valve_data
-                break
-        return valve_data
+        return self.config.schedule.valves.get(valve_name)
+
+    def _budgeted_program(self, program: dict) -> dict:
+        """ Returns the program with its valve times scaled by the water budget of the day (if enabled). If the
+            budget cannot be calculated, the configured times are used
+        """
+        if self.water_budget is None:
+            return program
+        try:
+            budget = self.water_budget.scale(self.curr_time.date())
+        except (OSError, ValueError, TypeError, KeyError) as ex:  # Missing or malformed weather
+            self.logger.warning('Water budget not available: %s', str(ex))
+            return program
+        self._add_event('Budget', budget['scale'])
+        if budget['scale'] == 1:
+            return program
+        return dict(program, valves=[dict(valve, time=valve['time'] * budget['scale'])
+                                     for valve in program['valves']])
 
     def _execute_program(self, program_name: str):
         """
@@ -443,27 +839,73 @@ class Waterflow():
         self._add_event('ExecProg', program_name)
         # inverter_enable =  not GPIO.input(self.config['external_ac_signal_pin'])
         # if inverter_enable: # If we don't have external 220V power input, then activate inverter
-        GPIO.output(self.config['inverter_relay_pin'], GPIO.HIGH)
+        self.pins.set(self.config['inverter_relay_pin'], GPIO.HIGH)
         self._add_event('InverterON', None)
-        program = self._get_program(program_name)
+        program = self._budgeted_program(self._get_program(program_name))
+
+        if self.config['supply_capacity']:
+            self._execute_valves_concurrently(program)
+        else:
+            self._execute_valves_sequentially(program)
 
+        # if inverter_enable: # If we dont have external 220V power input, then activate inverter
+        self.pins.set(self.config['inverter_relay_pin'], GPIO.LOW)  # INVERTER always OFF after operations
+        self._add_event('InverterOFF', None)
+
+    def _execute_valves_sequentially(self, program: dict):
         for valve in program['valves']:
-            if valve['time'] > 0 and not self.stop_requested():
+            if valve['time'] > 0 and not self._stopping():
                 valve_pin = self.config['valves'][valve['name']]['pin']
-                GPIO.output(valve_pin, GPIO.HIGH)
+                start_pulses = self.flow_meter.pulses()
+                self.pins.set(valve_pin, GPIO.HIGH)
                 self._add_event('ValveON', valve['name'])
+                self.executor.heartbeat(valves=[valve['name']])
 
                 # If dry run, then we fast forward the sleep
                 if not self.dry_run:
                     self._sleep(valve['time'] * 60)
 
-                GPIO.output(valve_pin, GPIO.LOW)
+                self.pins.set(valve_pin, GPIO.LOW)
                 self._add_event('ValveOFF', valve['name'])
+                self._record_flow(valve['name'], start_pulses)
+                self.executor.heartbeat(valves=[])
             else:
                 self._add_event('ValveSkip', valve['name'])
-        # if inverter_enable: # If we dont have external 220V power input, then activate inverter
-        GPIO.output(self.config['inverter_relay_pin'], GPIO.LOW)  # INVERTER always OFF after operations
-        self._add_event('InverterOFF', None)
+
+    def _execute_valves_concurrently(self, program: dict):
+        """ Opens at the same time as many valves as the supply capacity allows (see valve_scheduler).
+            A stop closes the open valves right away, and skips the ones not opened yet
+        """
+        valves = []
+        for valve in program['valves']:
+            if valve['time'] > 0:
+                seconds = min(valve['time'], self.config['max_valve_time']) * 60
+                valves.append((valve['name'], seconds, self.config['valves'][valve['name']].get('flow')))
+            else:
+                self._add_event('ValveSkip', valve['name'])
+
+        opened = {}  # Open valves, and the pulses of the meter when they were opened
+        start_time = self._monotonic()
+        for second, is_on, valve_name in plan_actions(plan_valves(valves, self.config['supply_capacity'])):
+            # If dry run, then we fast forward the sleep
+            if not self.dry_run:
+                self._sleep(start_time + second - self._monotonic())
+
+            valve_pin = self.config['valves'][valve_name]['pin']
+            if is_on:
+                if self._stopping():
+                    self._add_event('ValveSkip', valve_name)
+                    continue
+                opened[valve_name] = self.flow_meter.pulses()
+                self.pins.set(valve_pin, GPIO.HIGH)
+                self._add_event('ValveON', valve_name)
+            elif valve_name in opened:
+                self.pins.set(valve_pin, GPIO.LOW)
+                start_pulses = opened.pop(valve_name)
+                self._add_event('ValveOFF', valve_name)
+                # A single meter measures the whole supply: valves open at the same time share the pulses
+                self._record_flow(valve_name, start_pulses)
+            self.executor.heartbeat(valves=sorted(opened))
 
     def _log_next_program_time(self):
         new_next_program_time, _ = self._recalc_next_program(self.curr_time)
@@ -476,90 +918,267 @@ class Waterflow():
         if not self.events or self.events[-1][1] != 'LastProg' or self.events[-1][2] != last_event_date:
             self._add_event('LastProg', last_event_date)
 
-    def _execute_forced(self, forced_info: dict):
-        forced_type = forced_info.get("type")
-        forced_value = forced_info.get("value")
-        if forced_type == "program":
-            self.logger.info("Executing forced program: %s", forced_value)
-            self._add_event('ForcedProg', forced_value)
-            # ------------------------
-            self._emit_action_metric(f'prog{forced_value}', True)
-            self._execute_program(forced_value)
+    def _run_execution(self, execute, name: str):
+        """ Body of the executor thread: executes the program/valve, and then registers the next program and the
+            successful loop, as the loop does when nothing is executed
+        """
+        try:
+            self.pins.prepare()  # Relays set up only when something is executed
+            self.flow_meter.start()
+            with self.instrumentation.span('execution'):
+                execute(name)
+            self._log_next_program_time()
+            self._touch_token()
+        except Exception as ex:
+            self._add_event('Exception', str(ex))
+            raise
+        finally:
+            self.flow_meter.stop()
+            self.pins.release()
+
+    def _start_execution(self, type_exec: str, name: str, execute) -> bool:
+        started = self.executor.start(type_exec, name, lambda: self._run_execution(execute, name))
+        if not started:
+            self.logger.warning('Cannot execute %s %s: another execution in progress.', type_exec, name)
+        return started
+
+    def _execution_finished(self):
+        # Wake up a running daemon, so that it serves the requests that arrived meanwhile
+        if self._control_watcher:
+            self._control_watcher.notify()
+
+    def _supervise_execution(self):
+        """ Takes over an execution that stopped making progress (hung worker, or dead process): closes all valves
+        """
+        if self.executor.is_stuck():
+            state = self.executor.reset()
+            self.logger.error('Execution of %s %s stuck. Closing all valves.', state.get('type'), state.get('name'))
+            self._add_event('ExecStuck', state.get('name'))
+            for command in self.commands.commands((RUNNING,)):
+                self.commands.set_status(command['id'], CANCELLED)
+            if self._stop_watcher:
+                self._stop_watcher.notify()
+            self._setup_gpio(self.config['valves'])
+            self.pins.reset()
+
+    def _execute_commands(self, commands: list):
+        """ Executes the forced commands one after the other, in the executor thread.
+            A stop cancels the ones not started yet
+        """
+        for command in commands:
+            forced_type = command['type']
+            forced_value = command['value']
+            if self._stopping() or not self.executor.advance(forced_type, forced_value):
+                self.commands.set_status(command['id'], CANCELLED)
+                continue
+            self.commands.set_status(command['id'], RUNNING)
+            try:
+                if forced_type == PROGRAM:
+                    self.logger.info("Executing forced program: %s", forced_value)
+                    self._add_event('ForcedProg', forced_value)
+                    # ------------------------
+                    self._emit_action_metric(f'prog{forced_value}', True)
+                    self._execute_program(forced_value)
+                else:
+                    self.logger.info("Executing forced valve: %s", forced_value)
+                    self._add_event('ForcedValve', forced_value)
+                    # ------------------------
+                    self._emit_action_metric(f'valve{forced_value}', True)
+                    self._execute_valve(forced_value)
+            except Exception:
+                self.commands.set_status(command['id'], CANCELLED)
+                raise
+            self.commands.set_status(command['id'], DONE)
+
+    def _execute_forced(self, commands: list) -> bool:
+        """ Drains the pending forced commands: all of them run in a single execution, by priority
+        """
+        if any(command['type'] == PROGRAM for command in commands):
             self._write_last_program_time(self.curr_time)
-        elif forced_type == "valve":
-            self.logger.info("Executing forced valve: %s", forced_value)
-            self._add_event('ForcedValve', forced_value)
-            # ------------------------
-            self._emit_action_metric(f'valve{forced_value}', True)
-            self._execute_valve(forced_value)
+        # Set running by the executor thread, once it is accepted: if it is not, they stay queued for the next loop
+        first = commands[0]
+        return self._start_execution(first['type'], first['value'], lambda _: self._execute_commands(commands))
 
-    def _check_and_execute_program(self):
+    def _check_and_execute_program(self) -> bool:
+        if self.sensors:
+            self.sensors.start()  # Samples in the background, so that the average is fresh when a program is due
         last_program_time = self._read_last_program_time(default=self.curr_time)
         new_next_program, new_program_name = self._recalc_next_program(last_program_time)
         if new_next_program:
             # ------------------------
             time_reached = self.curr_time >= new_next_program
             threshold_exceeded = self.curr_time > (new_next_program + timedelta(minutes=self.config['max_loop_time']))
-            skip_program = self._skip_program()
+            # Only asked when the program is due
+            skip_program = time_reached and not threshold_exceeded and self._skip_program()
             # If we have reached the time of the new_program_time, BUT not by more than 10 minutes...
             if time_reached and not threshold_exceeded and not skip_program:
                 self._emit_action_metric(f'prog_{new_program_name}', False)
-                self._execute_program(new_program_name)
-                program_executed = True
+                program_executed = self._start_execution('program', new_program_name, self._execute_program)
             else:
                 program_executed = False
 
             if program_executed or skip_program or threshold_exceeded:
                 self._write_last_program_time(self.curr_time)
+            return program_executed
+        return False
 
-    def loop(self, date_now: datetime = None):
+    def loop(self, date_now: datetime = None, wait: bool = True):
         """ Loop executed every x minutes... in crontab for example.
+            The watering runs in the executor thread, and the lock is only held while deciding, so that the loops
+            that come meanwhile keep recalculating the next program and registering stop requests.
         Args:
             date_now (datetime): Naive date to consider the execution of the loop. 
                                  Normally used only for debuggin/unittesting
+            wait (bool, optional): Wait until the watering started by this loop finishes. Defaults to True.
+                                   A process that exits after the loop (cron) must wait, or valves would stay open.
+        Returns:
+            bool: False if the loop could not run because a previous execution holds the lock
         """
-        if self.get_lock():  # To ensure a single execution despite of cron overlapping
+        with self.instrumentation.span('lock'):
+            locked = self.get_lock()  # To ensure a single execution despite of cron overlapping
+        if locked:
+            busy = executing = False
             try:
-                if date_now:
-                    self.curr_time = date_now.astimezone() # Make aware
-                else:
-                    self.curr_time = datetime.now().astimezone()
-                forced_info = self.get_forced_info()
-
-                if not self.stop_requested():
-                    self.logger.info('Looping...')
-                    self._setup_gpio(self.config['valves'])
-
-                    if forced_info:
-                        self._execute_forced(forced_info)
+                with self.state.transaction():  # State changes of the tick, committed at once before releasing the lock
+                    if date_now:
+                        self.curr_time = date_now.astimezone() # Make aware
                     else:
-                        self._check_and_execute_program()
-                else:
-                    self.logger.info('Loop skipped (Stop request).')
-                    self._add_event('Stop', None)
-                    self._emit_action_metric('Stop', True)
-                    self.stop_remove()
+                        self.curr_time = self._now().astimezone()
+                    self._import_legacy_requests()
+                    self._supervise_execution()
+                    self.loop_lock.heartbeat()
+                    busy = self.executor.busy
+
+                    # The whole queue is drained in one pass
+                    commands = self.commands.pending()
+                    stops = [command for command in commands if command['type'] == STOP]
+                    forced = [command for command in commands if command['type'] != STOP]
+
+                    if stops:
+                        self.logger.info('Loop skipped (Stop request).')
+                        if busy and self.executor.request_stop():
+                            self.logger.info('Stopping the execution in progress.')
+                        self._add_event('Stop', None)
+                        self._emit_action_metric('Stop', True)
+                        for command in stops:
+                            self.commands.set_status(command['id'], DONE)
+                        for command in forced:
+                            self.commands.set_status(command['id'], CANCELLED)
+                    elif busy:
+                        pass  # Watering in progress: forced commands wait until it finishes
+                    else:
+                        self.logger.info('Looping...')
+                        with self.instrumentation.span('setup_gpio'):
+                            self._setup_gpio(self.config['valves'])
 
-                if forced_info:
-                    # Remove force token file
-                    os.remove(os.path.join(self.homevar, 'force'))
+                        if forced:
+                            executing = self._execute_forced(forced)
+                        else:
+                            executing = self._check_and_execute_program()
 
-                # Recalc next program time
-                self._log_next_program_time()
+                    # Done by the executor when it finishes, if it was started now
+                    if not executing:
+                        # Recalc next program time
+                        self._log_next_program_time()
 
-                # Updates "modified" time AT THE END, so that we can keep track about waterflow looping SUCCESFULLY.
-                token_path = os.path.join(self.homevar, 'token')
-                Path(token_path).touch()
+                        # Updates "modified" time AT THE END, so that we can keep track about waterflow looping
+                        # SUCCESFULLY.
+                        self._touch_token()
 
             except Exception as ex:
                 self.logger.error('Exception looping: %s', str(ex), exc_info=True)
                 self._add_event('Exception', str(ex))
                 raise RuntimeError(ex) from ex
             finally:
-                GPIO.cleanup()
-                self.release_lock()
-        else:
-            self.logger.error('Loop executed while locked by previous execution.')
+                with self.instrumentation.span('cleanup'):
+                    if not busy and not executing:  # Otherwise the executor cleans up when it finishes
+                        self.pins.release()  # Nothing to do if no pin was set up (idle tick)
+                with self.instrumentation.span('lock'):
+                    self.release_lock()
+                self.instrumentation.flush()
+            if executing and wait:
+                self.executor.wait()
+                self.instrumentation.flush()
+                if self.executor.error:
+                    raise RuntimeError(self.executor.error) from self.executor.error
+            self.compact_events()
+            return True
+
+        self.logger.error('Loop executed while locked by previous execution.')
+        return False
+
+    def next_deadline(self, now: datetime = None) -> datetime:
+        """ Next time the loop needs to run: the start of the next program, or the heartbeat that keeps
+            is_looping_correctly() true, whatever comes first
+        Args:
+            now (datetime, optional): Reference time. Defaults to now.
+        Returns:
+            datetime: Time of the next loop (local aware)
+        """
+        now = (now or self._now()).astimezone()
+        self.curr_time = now
+        last_program_time = self._read_last_program_time(default=now)
+        next_program_time, _ = self._recalc_next_program(last_program_time)
+
+        deadline = now + timedelta(minutes=self.config['max_loop_time']) / 2
+        if next_program_time and now < next_program_time < deadline:
+            deadline = next_program_time
+        return deadline
+
+    def _control_requested(self):
+        if self.executor.busy:
+            return False  # The executor reacts to the stop itself. The rest waits until it finishes
+        return self.stop_requested() or self.get_forced_info() is not None
+
+    def _wait_until(self, deadline: datetime):
+        """ Sleeps until the deadline, but wakes up earlier if a control request (force/stop) arrives
+        Args:
+            deadline (datetime): Time to wake up (local aware)
+        """
+        watcher = self._get_control_watcher()
+        while self._daemon_running and not self._control_requested():
+            remaining = (deadline - datetime.now().astimezone()).total_seconds()
+            if remaining <= 0:
+                break
+            # Bounded, so that wall clock changes (NTP, DST) are noticed
+            if watcher.wait(min(remaining, 60)):
+                break  # Something changed (i.e. config updated): run the loop and recalculate the deadline
+
+    def stop_daemon(self, *_):
+        """ Makes run_daemon() return after the current loop. Can be used as a signal handler
+        """
+        self._daemon_running = False
+        self._get_control_watcher().notify()
+
+    def run_daemon(self):
+        """ Long running alternative to executing the loop from cron: keeps this instance alive, and runs the loop
+            only when the next program is due, when a control request arrives, or as a heartbeat.
+        """
+        self._daemon_running = True
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop_daemon)
+            signal.signal(signal.SIGINT, self.stop_daemon)
+        self.logger.info('Daemon started.')
+
+        control_server = ControlServer(self, self._get_homevar_path('control.sock'))
+        control_server.start()
+        try:
+            while self._daemon_running:
+                try:
+                    looped = self.loop(wait=False)
+                except RuntimeError:
+                    looped = True  # Already logged and registered as an event by the loop itself
+                if not looped:
+                    # Locked by another process: do not spin on a request that cannot be served yet
+                    time.sleep(1)
+                self._wait_until(self.next_deadline())
+        finally:
+            control_server.stop()
+            # Do not leave valves open behind: the executor thread dies with the process
+            if self.executor.request_stop():
+                self._get_stop_watcher().notify()
+            self.executor.wait()
+        self.logger.info('Daemon stopped.')
 
     @classmethod
     def get_version(cls) -> str:
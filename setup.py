@@ -43,5 +43,10 @@ setuptools.setup(
         'fake-rpigpio>=0.1.1',
         'influxdb_wrapper>=0.0.5'
     ],
+    extras_require={
+        'dht22': ['adafruit-circuitpython-dht>=3.7.0'],
+        'budget': ['numpy>=1.19'],
+        'i2c': ['smbus2>=0.4.1'],
+    },
     python_requires='>=3.6',
 )
\ No newline at end of file
@@ -14,6 +14,7 @@ class Testing(unittest.TestCase):
         self.waterflow = Waterflow(template_config_path=template_config_path, dry_run=True)
 
     def tearDown(self):
+        self.waterflow.close()
         del self.waterflow
         gc.collect()
 
@@ -15,6 +15,9 @@ class Testing(unittest.TestCase):
                                    fake_now=Waterflow.str_to_time('2023-04-27 00:01:00'),
                                    dry_run=True)
 
+    def tearDown(self):
+        self.waterflow.close()
+
     def test_0021_recalc_next_program(self):
         """ Test the recalc_next_program function
         """
@@ -3,6 +3,7 @@ import os
 import time
 import unittest
 from pathlib import Path
+import gc
 
 from piwaterflow import Waterflow
 
@@ -14,21 +15,31 @@ class Testing(unittest.TestCase):
         template_config_path = f'{Path(__file__).parent}/data/config-template.yml'
         self.waterflow = Waterflow(template_config_path=template_config_path, dry_run=True)
 
+    def tearDown(self):
+        self.waterflow.close()
+        del self.waterflow
+        gc.collect()
+
     def test_0030_loop(self):
         """ Test the loop and main high-level functionalities
         """
         first_lock = self.waterflow.get_lock()
         self.assertTrue(first_lock)
 
+        start = time.monotonic()
         second_lock = self.waterflow.get_lock()
         self.assertFalse(second_lock)
+        self.assertLess(time.monotonic() - start, 1)  # The loop does not wait for the lock
 
-        # Simulate lock expiring
-        lock_path = self.waterflow._get_homevar_path('lock') # pylint: disable=protected-access
-        past_epoch = time.time() - 1260
-        os.utime(lock_path, (past_epoch, past_epoch) ) # 21 minutes before to simulate expiring
+        # Simulate the process holding the lock dying: the kernel releases it, and its metadata is left behind
+        loop_lock = self.waterflow.loop_lock
+        os.close(loop_lock._fd) # pylint: disable=protected-access
+        loop_lock._fd = None # pylint: disable=protected-access
+        start = time.monotonic()
         third_lock = self.waterflow.get_lock()
         self.assertTrue(third_lock)
+        self.assertLess(time.monotonic() - start, 1)  # Right away, not after max_loop_time
+        self.assertEqual(self.waterflow._read_events()[-1][1], 'LockExpired') # pylint: disable=protected-access
 
 
 if __name__ == '__main__':
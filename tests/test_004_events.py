@@ -1,9 +1,14 @@
 """ Unittesting """
+import os
+import json
+import time
+import shutil
 import unittest
 from pathlib import Path
 import gc
 
 from piwaterflow import Waterflow
+from piwaterflow.event_journal import EventJournal
 
 
 class Testing(unittest.TestCase):
@@ -14,6 +19,7 @@ class Testing(unittest.TestCase):
         self.waterflow = Waterflow(template_config_path=template_config_path, dry_run=True)
 
     def tearDown(self):
+        self.waterflow.close()
         del self.waterflow
         gc.collect()
 
@@ -29,6 +35,136 @@ class Testing(unittest.TestCase):
         else:
             self.fail("not the right events generated.")
 
+    def test_0001_torn_last_record(self):
+        """ A record interrupted in the middle of a write must be ignored, and not break the following appends
+        """
+        self.waterflow._add_event('LastProg', '2023-05-27 09:51:00') # pylint: disable=protected-access
+        self.waterflow.event_journal.close()
+        with open(self.waterflow.event_journal.path, 'a', encoding="utf-8") as journal_file:
+            journal_file.write('["2023-05-27 09:52:00","Val')
+
+        events = self.waterflow._read_events() # pylint: disable=protected-access
+        self.assertEqual(len(events), 1)
+
+        self.waterflow._add_event('Stop', None) # pylint: disable=protected-access
+        events = self.waterflow._read_events() # pylint: disable=protected-access
+        self.assertEqual(len(events), 2)
+        self.assertTrue(events[1][1] == "Stop" and events[1][2] is None)
+
+    def test_0002_migrate_legacy_events(self):
+        """ The legacy events file (a whole JSON array) is migrated once into the journal
+        """
+        legacy_path = self.waterflow._get_homevar_path('events') # pylint: disable=protected-access
+        with open(legacy_path, 'w', encoding="utf-8") as legacy_file:
+            json.dump([["2023-05-27 09:51:00", "ExecProg", "first"], ["2023-05-27 09:52:00", "Stop", None]],
+                      legacy_file)
+
+        self.assertTrue(self.waterflow.event_journal.migrate(legacy_path))
+        self.assertFalse(Path(legacy_path).exists())
+        self.assertFalse(self.waterflow.event_journal.migrate(legacy_path))
+
+        # Migrated into a rotated segment: the current one, read on startup, is empty
+        self.assertEqual(self.waterflow._read_events(), []) # pylint: disable=protected-access
+        self.assertEqual(len(self.waterflow.event_journal.segments()), 1)
+        events = list(self.waterflow.event_journal.iter_events())
+        self.assertEqual(len(events), 2)
+        self.assertTrue(events[0][1] == "ExecProg" and events[0][2] == "first")
+
+    def test_0003_segment_rotation(self):
+        """ Segments rotate by size and by age, and the current segment is the only one read on startup
+        """
+        journal_path = self.waterflow._get_homevar_path('rotated.jsonl') # pylint: disable=protected-access
+        journal = EventJournal(journal_path, fsync='never', segment_max_kb=1, segment_max_days=7)
+        for minute in range(40):
+            journal.append((f'2023-05-27 10:{minute:02}:00', 'ValveON', 'main'))
+        self.assertTrue(len(journal.segments()) >= 1)
+        self.assertEqual(len(list(journal.iter_events())), 40)
+        self.assertTrue(len(journal.read()) < 40)
+
+        # Age based rotation
+        self.assertTrue(journal.append(('2023-06-10 10:00:00', 'ValveOFF', 'main')))
+        self.assertEqual(journal.read(), [['2023-06-10 10:00:00', 'ValveOFF', 'main']])
+        journal.close()
+
+    def test_0004_compaction(self):
+        """ Old segments get compressed, and expired archives deleted, without losing the events in between
+        """
+        journal_path = self.waterflow._get_homevar_path('compacted.jsonl') # pylint: disable=protected-access
+        journal = EventJournal(journal_path, fsync='never')
+        for day in range(1, 4):
+            journal.append((f'2023-05-0{day} 10:00:00', 'ValveON', 'main'))
+            journal.rotate()
+        journal.append(('2023-05-04 10:00:00', 'ValveON', 'main'))
+
+        segments = journal.segments()
+        self.assertEqual(len(segments), 3)
+        old_epoch = time.time() - 100 * 86400
+        os.utime(segments[0], (old_epoch, old_epoch))
+        os.utime(segments[1], (old_epoch, old_epoch))
+
+        self.assertEqual(journal.compact(hot_days=90), 2)
+        self.assertEqual(len(journal.segments()), 1)
+        self.assertEqual(len(journal.segments(archived=True)), 3)
+        self.assertEqual(len(list(journal.iter_events(archived=True))), 4)
+
+        self.assertEqual(journal.compact(hot_days=90, archive_days=30), 2)
+        self.assertEqual([event[0] for event in journal.iter_events(archived=True)],
+                         ['2023-05-03 10:00:00', '2023-05-04 10:00:00'])
+        journal.close()
+
+    def test_0005_missing_folder(self):
+        """ The folder of the journal is created again if it is removed while the journal is closed
+        """
+        journal_folder = self.waterflow._get_homevar_path('journal') # pylint: disable=protected-access
+        journal = EventJournal(os.path.join(journal_folder, 'events.jsonl'), fsync='never')
+        self.assertEqual(journal.read(), [])
+        journal.append(('2023-05-27 10:00:00', 'ValveON', 'main'))
+        journal.close()
+        shutil.rmtree(journal_folder)
+
+        self.assertEqual(journal.read(), [])
+        journal.append(('2023-05-27 10:01:00', 'ValveOFF', 'main'))
+        self.assertEqual(journal.read(), [['2023-05-27 10:01:00', 'ValveOFF', 'main']])
+        journal.close()
+
+    def test_0006_rotated_by_another_process(self):
+        """ A journal whose current segment was rotated by another instance appends to the new current segment
+        """
+        journal_path = self.waterflow._get_homevar_path('shared.jsonl') # pylint: disable=protected-access
+        journal = EventJournal(journal_path, fsync='never')
+        other_journal = EventJournal(journal_path, fsync='never')
+        journal.append(('2023-05-27 10:00:00', 'ValveON', 'main'))
+        other_journal.append(('2023-05-27 10:01:00', 'ValveOFF', 'main'))
+        other_journal.rotate()
+
+        journal.append(('2023-05-27 10:02:00', 'Stop', None))
+        self.assertEqual(journal.read(), [['2023-05-27 10:02:00', 'Stop', None]])
+        self.assertEqual(len(list(journal.iter_events())), 3)
+        journal.close()
+        other_journal.close()
+    def test_0007_clock_gone_back(self):
+        """ At the end of DST the local timestamps go back: range queries still find the events of the repeated hour
+        """
+        journal_path = self.waterflow._get_homevar_path('dst.jsonl') # pylint: disable=protected-access
+        journal = EventJournal(journal_path, fsync='never')
+        stamps = ['2023-10-29 01:30:00', '2023-10-29 01:59:00', '2023-10-29 01:00:00', '2023-10-29 01:10:00',
+                  '2023-10-29 02:00:00']
+        rotations = [journal.append((stamp, 'ValveON', 'main')) for stamp in stamps]
+        self.assertEqual(rotations, [False, False, True, False, False])
+        self.assertEqual([event[0] for event in journal.iter_events()], stamps)
+        journal.rotate()  # Named after the previous segment: arrival order is kept
+        journal.append(('2023-10-29 03:00:00', 'ValveOFF', 'main'))
+        stamps.append('2023-10-29 03:00:00')
+        self.assertEqual([event[0] for event in journal.iter_events()], stamps)
+
+        found = [event[0] for event in journal.iter_range(since='2023-10-29 01:05:00', until='2023-10-29 01:40:00')]
+        self.assertEqual(found, ['2023-10-29 01:30:00', '2023-10-29 01:10:00'])
+        found = [event[0] for event in journal.iter_range(since='2023-10-29 01:05:00', until='2023-10-29 01:40:00',
+                                                          reverse=True)]
+        self.assertEqual(found, ['2023-10-29 01:10:00', '2023-10-29 01:30:00'])
+        journal.close()
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,71 @@
+""" Unittesting """
+import unittest
+from pathlib import Path
+from datetime import datetime, timedelta
+import gc
+
+from piwaterflow import Waterflow
+from piwaterflow.event_journal import EventJournal
+
+
+class Testing(unittest.TestCase):
+    """ Unittesting class
+    """
+    def setUp(self):
+        template_config_path = f'{Path(__file__).parent}/data/config-template.yml'
+        self.waterflow = Waterflow(template_config_path=template_config_path, dry_run=True)
+
+    def tearDown(self):
+        self.waterflow.close()
+        del self.waterflow
+        gc.collect()
+
+    def test_0050_iter_range(self):
+        """ Time range queries over several segments match a plain scan of the whole history
+        """
+        journal_path = self.waterflow._get_homevar_path('ranged.jsonl') # pylint: disable=protected-access
+        journal = EventJournal(journal_path, fsync='never', segment_max_kb=2)
+        start = datetime(2023, 5, 1)
+        events = []
+        for minute in range(0, 3000, 7):
+            event = [Waterflow.time_to_str(start + timedelta(minutes=minute)), 'ValveON', f'valve{minute}']
+            events.append(event)
+            journal.append(event)
+        # Leave a torn record at the end of the current segment
+        journal.close()
+        with open(journal_path, 'a', encoding="utf-8") as journal_file:
+            journal_file.write('["2023-05-03 02:00:00","Val')
+        self.assertTrue(len(journal.segments()) > 3)
+
+        for since_minute, until_minute in [(None, None), (0, 3000), (100, 101), (99, 1500), (2990, None),
+                                           (None, 14), (700, 700), (5000, None)]:
+            since = Waterflow.time_to_str(start + timedelta(minutes=since_minute)) if since_minute is not None \
+                else None
+            until = Waterflow.time_to_str(start + timedelta(minutes=until_minute)) if until_minute is not None \
+                else None
+            expected = [event for event in events
+                        if (since is None or event[0] >= since) and (until is None or event[0] < until)]
+            self.assertEqual(list(journal.iter_range(since, until)), expected)
+            self.assertEqual(list(journal.iter_range(since, until, reverse=True)), expected[::-1])
+
+    def test_0051_iter_log(self):
+        """ iter_log returns the newest lines first, and get_log keeps returning the whole log in order
+        """
+        self.waterflow._add_event('ExecProg', 'first') # pylint: disable=protected-access
+        self.waterflow._add_event('ValveON', 'main') # pylint: disable=protected-access
+        self.waterflow._add_event('ValveOFF', 'main') # pylint: disable=protected-access
+
+        lines = list(self.waterflow.iter_log(limit=2))
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].endswith('Valve main OFF.'))
+        self.assertTrue(lines[1].endswith('Valve main ON.'))
+
+        self.assertEqual(list(self.waterflow.iter_log(since=datetime.now() + timedelta(days=1))), [])
+
+        log = self.waterflow.get_log().splitlines()
+        self.assertEqual(len(log), 3)
+        self.assertTrue(log[0].endswith('Executing program first.'))
+
+
+if __name__ == '__main__':
+    unittest.main()
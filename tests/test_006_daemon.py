@@ -0,0 +1,58 @@
+""" Unittesting """
+import time
+import threading
+import unittest
+from pathlib import Path
+from datetime import datetime
+import gc
+
+from piwaterflow import Waterflow
+
+
+class Testing(unittest.TestCase):
+    """ Unittesting class
+    """
+    def setUp(self):
+        template_config_path = f'{Path(__file__).parent}/data/config-template.yml'
+        self.waterflow = Waterflow(template_config_path=template_config_path, dry_run=True)
+
+    def tearDown(self):
+        self.waterflow.close()
+        del self.waterflow
+        gc.collect()
+
+    def test_0060_next_deadline(self):
+        """ The daemon wakes up for the next program, or for the heartbeat if the program is further away
+        """
+        self.waterflow._write_last_program_time(Waterflow.str_to_time('2023-05-27 08:00:00')) # pylint: disable=protected-access
+
+        deadline = self.waterflow.next_deadline(Waterflow.str_to_time('2023-05-27 09:45:00'))
+        self.assertEqual(deadline, datetime(2023, 5, 27, 9, 51).astimezone())
+
+        deadline = self.waterflow.next_deadline(Waterflow.str_to_time('2023-05-27 09:30:00'))
+        self.assertEqual(deadline, datetime(2023, 5, 27, 9, 40).astimezone())
+
+    def test_0061_daemon_serves_force(self):
+        """ A forced valve is executed by the running daemon without waiting for the next deadline
+        """
+        daemon = threading.Thread(target=self.waterflow.run_daemon)
+        daemon.start()
+        try:
+            time.sleep(0.2)
+            self.waterflow.force('valve', 'grass')
+            start = time.monotonic()
+            while time.monotonic() - start < 5:
+                if any(event[1] == 'ForcedValve' for event in self.waterflow._read_events()): # pylint: disable=protected-access
+                    break
+                time.sleep(0.05)
+            else:
+                self.fail("Forced valve not executed by the daemon.")
+        finally:
+            self.waterflow.stop_daemon()
+            daemon.join(5)
+        self.assertFalse(daemon.is_alive())
+        self.assertIsNone(self.waterflow.get_forced_info())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+""" Unittesting """
+import time
+import threading
+import unittest
+from pathlib import Path
+import gc
+
+from piwaterflow import Waterflow
+from piwaterflow.control_watcher import ControlWatcher
+
+
+class Testing(unittest.TestCase):
+    """ Unittesting class
+    """
+    def setUp(self):
+        template_config_path = f'{Path(__file__).parent}/data/config-template.yml'
+        self.waterflow = Waterflow(template_config_path=template_config_path, dry_run=True)
+
+    def tearDown(self):
+        self.waterflow.close()
+        del self.waterflow
+        gc.collect()
+
+    def test_0070_stop_wakes_sleep(self):
+        """ A stop request ends a valve sleep in milliseconds, not in the next polling period
+        """
+        stopper = threading.Timer(0.2, self.waterflow.stop)
+        start = time.monotonic()
+        stopper.start()
+        self.waterflow._sleep(60) # pylint: disable=protected-access
+        elapsed = time.monotonic() - start
+        stopper.join()
+        self.assertTrue(elapsed < 1, f'Stop took {elapsed} seconds')
+
+    def test_0071_watcher(self):
+        """ The watcher wakes up for the watched files and for notify(), with or without inotify
+        """
+        for use_inotify in (True, False):
+            watcher = ControlWatcher(self.waterflow.homevar, ('commands.signal',), poll_interval=0.1,
+                                     use_inotify=use_inotify)
+            self.assertFalse(watcher.wait(0.05))
+
+            notifier = threading.Timer(0.1, watcher.notify)
+            notifier.start()
+            start = time.monotonic()
+            while not watcher.wait(5):
+                self.assertTrue(time.monotonic() - start < 2)
+            notifier.join()
+
+            if watcher.uses_inotify:
+                threading.Timer(0.1, self.waterflow.force, ('valve', 'grass')).start()
+                self.assertTrue(watcher.wait(5))
+            watcher.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+""" Unittesting """
+import json
+import socket
+import unittest
+from pathlib import Path
+import gc
+
+from piwaterflow import Waterflow, WaterflowClient, ControlError
+from piwaterflow.control_server import ControlServer, MAX_REQUEST_SIZE
+
+
+class Testing(unittest.TestCase):
+    """ Unittesting class
+    """
+    def setUp(self):
+        template_config_path = f'{Path(__file__).parent}/data/config-template.yml'
+        self.waterflow = Waterflow(template_config_path=template_config_path, dry_run=True)
+        socket_path = self.waterflow._get_homevar_path('control.sock') # pylint: disable=protected-access
+        self.server = ControlServer(self.waterflow, socket_path)
+        self.server.start()
+        self.client = WaterflowClient(socket_path)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        self.waterflow.close()
+        del self.waterflow
+        gc.collect()
+
+    def test_0080_force_and_stop(self):
+        """ Force, forced info and stop through the socket
+        """
+        self.assertTrue(self.client.force('valve', 'grass'))
+        self.assertFalse(self.client.force('valve', 'nonexistent'))
+        self.assertEqual(self.client.get_forced_info(), {'type': 'valve', 'value': 'grass'})
+
+        self.assertTrue(self.client.stop())
+        status = self.client.status()
+        self.assertTrue(status['stop_requested'])
+        self.assertEqual(status['forced'], {'type': 'valve', 'value': 'grass'})
+
+    def test_0081_log(self):
+        """ Log queries through the socket
+        """
+        self.waterflow.loop(Waterflow.str_to_time('2023-05-27 08:30:00'))
+        self.assertTrue(self.client.get_log().endswith('Next program: 2023-05-27 09:51:00.\n'))
+        self.assertEqual(len(self.client.iter_log(limit=1)), 1)
+        self.assertEqual(self.client.status()['next_program'], '2023-05-27 09:51:00')
+
+    def test_0082_update_config(self):
+        """ Programs updated through the socket are used by the waterflow instance
+        """
+        config = self.waterflow.config.get_dict()
+        programs = [{'name': 'first', 'start_time': '07:15'}]
+        self.assertTrue(self.client.update_config(programs))
+        program = self.waterflow._get_program('first') # pylint: disable=protected-access
+        self.assertEqual(program['start_time'].strftime('%H:%M'), '07:15')
+        # Replaced, not changed in place: a reader (i.e. the executor) keeps a consistent config
+        self.assertEqual(config['programs'][0]['start_time'].strftime('%H:%M'), '09:51')
+
+        with self.assertRaises(ControlError):
+            self.client.request('nonexistent')
+
+    def test_0083_request_too_large(self):
+        """ A request larger than the limit gets an error response, and the next one on the connection is served
+        """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client_socket:
+            client_socket.connect(self.server.socket_path)
+            client_socket.sendall(b'{"op": "stop", "args": {"x": "' + b'x' * MAX_REQUEST_SIZE + b'"}}\n' +
+                                  b'{"op": "get_forced_info"}\n')
+            with client_socket.makefile('rb') as responses:
+                response = json.loads(responses.readline())
+                self.assertFalse(response['ok'])
+                self.assertIn('larger', response['error'])
+                self.assertEqual(json.loads(responses.readline()), {'ok': True, 'result': None})
+        self.assertFalse(self.waterflow.stop_requested())
+
+
+if __name__ == '__main__':
+    unittest.main()
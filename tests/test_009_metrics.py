@@ -0,0 +1,152 @@
+""" Unittesting """
+import os
+import time
+import unittest
+from pathlib import Path
+import gc
+
+from piwaterflow import Waterflow
+from piwaterflow.metrics import MetricsEmitter
+from piwaterflow.circuit_breaker import CircuitBreaker
+
+
+class FakeConn():
+    """ Connection that records the inserted points, and can be switched down or slowed down
+    """
+    def __init__(self):
+        self.available = True
+        self.delay = 0
+        self.points = []
+        self.calls = 0
+
+    def insert(self, table, rows):
+        """ Fake insert """
+        self.calls += 1
+        time.sleep(self.delay)
+        if not self.available:
+            raise ConnectionError('Backend down')
+        self.points.extend((table, row) for row in rows)
+
+
+class Testing(unittest.TestCase):
+    """ Unittesting class
+    """
+    def setUp(self):
+        template_config_path = f'{Path(__file__).parent}/data/config-template.yml'
+        self.waterflow = Waterflow(template_config_path=template_config_path, dry_run=True)
+        self.conn = FakeConn()
+        self.spool_path = self.waterflow._get_homevar_path('test.spool') # pylint: disable=protected-access
+
+    def tearDown(self):
+        self.waterflow.close()
+        del self.waterflow
+        gc.collect()
+
+    def test_0090_batches(self):
+        """ Points are inserted in batches by the background thread
+        """
+        emitter = MetricsEmitter(lambda: self.conn, self.spool_path, batch_size=10, flush_interval=0.05)
+        for index in range(25):
+            emitter.emit('piwaterflow', {'tags': {'action': f'a{index}'}, 'fields': {'fake': 0}})
+        emitter.close()
+        self.assertEqual(len(self.conn.points), 25)
+        self.assertTrue(all(point['time'] for _, point in self.conn.points))
+
+    def test_0091_spool_and_replay(self):
+        """ Points are spooled while the backend is down, and replayed by a later emitter once it recovers
+        """
+        self.conn.available = False
+        emitter = MetricsEmitter(lambda: self.conn, self.spool_path, flush_interval=0.05)
+        for index in range(5):
+            emitter.emit('piwaterflow', {'tags': {'action': f'a{index}'}, 'fields': {'fake': 0}})
+        emitter.close()
+        self.assertTrue(os.path.exists(self.spool_path))
+        self.assertEqual(len(self.conn.points), 0)
+
+        self.conn.available = True
+        emitter = MetricsEmitter(lambda: self.conn, self.spool_path, flush_interval=0.05)
+        emitter.emit('piwaterflow', {'tags': {'action': 'new'}, 'fields': {'fake': 0}})
+        emitter.close()
+        self.assertEqual(len(self.conn.points), 6)
+        self.assertFalse(os.path.exists(self.spool_path))
+
+    def test_0092_slow_backend(self):
+        """ Emitting never waits for a slow backend, and what is not sent on close is spooled
+        """
+        self.conn.delay = 1
+        emitter = MetricsEmitter(lambda: self.conn, self.spool_path, flush_interval=0.05)
+        start = time.monotonic()
+        for index in range(5):
+            emitter.emit('piwaterflow', {'tags': {'action': f'a{index}'}, 'fields': {'fake': 0}})
+        self.assertTrue(time.monotonic() - start < 0.1)
+        emitter.close(timeout=0.2)
+        self.assertTrue(os.path.exists(self.spool_path))
+
+    def test_0093_lazy_connection(self):
+        """ Influx connection is not opened until a metric is sent
+        """
+        self.assertIsNone(self.waterflow._conn) # pylint: disable=protected-access
+        self.waterflow.loop(Waterflow.str_to_time('2023-05-27 08:30:00'))
+        self.waterflow.get_log()
+        self.assertIsNone(self.waterflow._conn) # pylint: disable=protected-access
+        self.assertIsNotNone(self.waterflow.conn)
+
+    def test_0094_circuit_breaker(self):
+        """ A backend known to be down is skipped by the following processes, until the reset time passes
+        """
+        breaker_path = self.waterflow._get_homevar_path('test_breaker.json') # pylint: disable=protected-access
+        self.conn.available = False
+        for _ in range(2):
+            emitter = MetricsEmitter(lambda: self.conn, self.spool_path, flush_interval=0.05,
+                                     breaker=CircuitBreaker(breaker_path, failure_threshold=2))
+            emitter.emit('piwaterflow', {'tags': {'action': 'a'}, 'fields': {'fake': 0}})
+            emitter.close()
+        calls = self.conn.calls
+        self.assertEqual(CircuitBreaker(breaker_path).state, 'open')
+
+        # New "process": backend not even tried, and the spool is not rewritten
+        spool_inode = os.stat(self.spool_path).st_ino
+        emitter = MetricsEmitter(lambda: self.conn, self.spool_path, flush_interval=0.05,
+                                 breaker=CircuitBreaker(breaker_path, failure_threshold=2))
+        emitter.emit('piwaterflow', {'tags': {'action': 'b'}, 'fields': {'fake': 0}})
+        emitter.close()
+        self.assertEqual(self.conn.calls, calls)
+        self.assertEqual(os.stat(self.spool_path).st_ino, spool_inode)
+
+        # Reset time passed and backend back: trial closes the circuit and the spool is replayed
+        self.conn.available = True
+        emitter = MetricsEmitter(lambda: self.conn, self.spool_path, flush_interval=0.05,
+                                 breaker=CircuitBreaker(breaker_path, failure_threshold=2, reset_timeout=0))
+        emitter.emit('piwaterflow', {'tags': {'action': 'c'}, 'fields': {'fake': 0}})
+        emitter.close()
+        self.assertEqual(CircuitBreaker(breaker_path).state, 'closed')
+        self.assertEqual(len(self.conn.points), 4)
+
+    def test_0095_concurrent_replay(self):
+        """ A single emitter replays the spool at a time, and the others keep flushing their own points
+        """
+        self.conn.available = False
+        emitter = MetricsEmitter(lambda: self.conn, self.spool_path, flush_interval=0.05)
+        for index in range(20):
+            emitter.emit('piwaterflow', {'tags': {'action': f'a{index}'}, 'fields': {'fake': 0}})
+        emitter.close()
+
+        self.conn.available = True
+        self.conn.delay = 0.5
+        replaying = MetricsEmitter(lambda: self.conn, self.spool_path, flush_interval=0.05)
+        replaying.emit('piwaterflow', {'tags': {'action': 'first'}, 'fields': {'fake': 0}})
+        time.sleep(0.1)
+        other = MetricsEmitter(lambda: self.conn, self.spool_path, flush_interval=0.05)
+        other.emit('piwaterflow', {'tags': {'action': 'second'}, 'fields': {'fake': 0}})
+        time.sleep(0.2)
+        self.assertTrue(replaying._thread.is_alive() and other._thread.is_alive()) # pylint: disable=protected-access
+        other.close()
+        replaying.close()
+
+        self.assertEqual(len(self.conn.points), 22)
+        self.assertFalse(os.path.exists(self.spool_path))
+        self.assertFalse(os.path.exists(f'{self.spool_path}.replay'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+""" Unittesting """
+import os
+import random
+import unittest
+from pathlib import Path
+from datetime import datetime, timedelta
+import gc
+
+from piwaterflow import Waterflow
+from piwaterflow.recurrence import ScheduleEngine
+
+
+def reference_next_program(programs, current_time, last_program_time):
+    """ Plain scan of the programs, as a reference for the compiled schedule """
+    current_time = current_time.astimezone().replace(microsecond=0)
+    prog_list = sorted(programs, key=lambda prog: (prog['start_time'].hour, prog['start_time'].minute))
+    for program in prog_list:
+        if program['enabled'] is True:
+            candidate_time = current_time.replace(hour=program['start_time'].hour,
+                                                  minute=program['start_time'].minute, second=0).astimezone()
+            if candidate_time > last_program_time:
+                return candidate_time, program['name']
+    for program in prog_list:
+        if program['enabled'] is True:
+            next_time = (current_time + timedelta(days=1)).replace(hour=program['start_time'].hour,
+                                                                   minute=program['start_time'].minute,
+                                                                   second=0).astimezone()
+            return next_time, program['name']
+    return None, None
+
+
+class Testing(unittest.TestCase):
+    """ Unittesting class
+    """
+    def setUp(self):
+        template_config_path = f'{Path(__file__).parent}/data/config-template.yml'
+        self.waterflow = Waterflow(template_config_path=template_config_path,
+                                   fake_now=Waterflow.str_to_time('2023-04-27 00:01:00'),
+                                   dry_run=True)
+
+    def tearDown(self):
+        self.waterflow.close()
+        del self.waterflow
+        gc.collect()
+
+    def test_0100_many_programs(self):
+        """ The bisected lookup matches a plain scan with lots of programs
+        """
+        rand = random.Random(7)
+        programs = [{'name': f'prog{index}', 'enabled': rand.random() > 0.2,
+                     'start_time': f'{rand.randrange(24):02}:{rand.randrange(60):02}', 'valves': []}
+                    for index in range(300)]
+        self.waterflow.update_config(programs)
+        all_programs = self.waterflow.config['programs']
+
+        current_time = Waterflow.str_to_time('2023-04-27 00:01:00')
+        # Last program times up to the end of today (the reference only looks one day ahead)
+        for minutes in range(-60, 24 * 60 - 1, 7):
+            last_program_time = current_time + timedelta(minutes=minutes, seconds=minutes % 60)
+            self.assertEqual(self.waterflow._recalc_next_program(last_program_time), # pylint: disable=protected-access
+                             reference_next_program(all_programs, current_time, last_program_time))
+
+    def test_0101_invalidation(self):
+        """ Compiled schedule only changes when programs are updated
+        """
+        schedule = self.waterflow.config.schedule
+        self.assertIs(self.waterflow.config.schedule, schedule)
+        self.assertEqual(self.waterflow._get_valve_data('grass'), {'pin': 35}) # pylint: disable=protected-access
+
+        self.waterflow.update_config([{'name': 'first', 'enabled': False}])
+        self.assertIsNot(self.waterflow.config.schedule, schedule)
+        time_prog, program_name = self.waterflow._recalc_next_program( # pylint: disable=protected-access
+            Waterflow.str_to_time('2023-04-26 23:30:27'))
+        self.assertEqual(program_name, 'second')
+        self.assertEqual(Waterflow.time_to_str(time_prog), '2023-04-27 19:04:00')
+
+    def test_0102_recurrence(self):
+        """ Weekdays, every N days, several start times and seasons
+        """
+        engine = ScheduleEngine([
+            {'name': 'weekly', 'start_time': '08:00', 'weekdays': ['mon', 'thu']},
+            {'name': 'alternate', 'start_time': '07:00', 'start_times': ['21:00'], 'every_n_days': 3,
+             'anchor_date': '2023-05-01'},
+            {'name': 'summer', 'start_time': '06:00', 'season': ['06-15', '09-15']},
+        ])
+        occurrences = []
+        for occurrence_time, name in engine.iter_after(datetime(2023, 5, 1)):
+            if occurrence_time >= datetime(2023, 5, 8):
+                break
+            occurrences.append((occurrence_time.strftime('%a %d %H:%M'), name))
+        self.assertEqual(occurrences, [('Mon 01 07:00', 'alternate'), ('Mon 01 08:00', 'weekly'),
+                                       ('Mon 01 21:00', 'alternate'), ('Thu 04 07:00', 'alternate'),
+                                       ('Thu 04 08:00', 'weekly'), ('Thu 04 21:00', 'alternate'),
+                                       ('Sun 07 07:00', 'alternate'), ('Sun 07 21:00', 'alternate')])
+
+        # Season start is found without walking the days in between
+        self.assertEqual(ScheduleEngine([{'name': 'summer', 'start_time': '06:00',
+                                          'season': ['06-15', '09-15']}]).next_after(datetime(2023, 9, 16)),
+                         (datetime(2024, 6, 15, 6, 0), 'summer'))
+
+        # Heap reused for increasing queries gives the same answers as fresh engines
+        programs = [{'name': f'prog{index}', 'start_time': f'{index % 24:02}:{index % 60:02}',
+                     'weekdays': [index % 7, (index + 3) % 7], 'every_n_days': 1 + index % 4}
+                    for index in range(200)]
+        engine = ScheduleEngine(programs)
+        query = datetime(2023, 1, 1)
+        for _ in range(100):
+            self.assertEqual(engine.next_after(query), ScheduleEngine(programs).next_after(query))
+            query += timedelta(minutes=197)
+
+        next_time, name = next(ScheduleEngine(programs).iter_after(datetime(2023, 1, 1)))
+        self.assertEqual(ScheduleEngine(programs).next_after(datetime(2023, 1, 1)), (next_time, name))
+
+    def test_0103_recalc_with_rules(self):
+        """ Next program is not limited to tomorrow anymore
+        """
+        self.waterflow.update_config([{'name': 'first', 'enabled': False},
+                                      {'name': 'second', 'enabled': True, 'weekdays': ['mon']}])
+        time_prog, program_name = self.waterflow._recalc_next_program( # pylint: disable=protected-access
+            Waterflow.str_to_time('2023-04-27 10:00:00'))
+        self.assertEqual(program_name, 'second')
+        self.assertEqual(time_prog, datetime(2023, 5, 1, 19, 4).astimezone())
+
+    def test_0104_update_shrinks_lists(self):
+        """ Lists of a program are replaced by an update, and they are kept so when the config is read again
+        """
+        self.waterflow.update_config([{'name': 'second', 'weekdays': ['mon', 'thu'],
+                                       'start_times': ['07:00', '21:00']}])
+        self.waterflow.update_config([{'name': 'second', 'weekdays': ['thu'], 'start_times': [],
+                                       'valves': [{'name': 'grass', 'time': 3}]}])
+        expected = {'weekdays': ['thu'], 'start_times': [], 'valves': [{'name': 'grass', 'time': 3}]}
+        program = self.waterflow.config.schedule.programs['second']
+        self.assertEqual({key: program[key] for key in expected}, expected)
+
+        os.remove(self.waterflow.config._snapshot_path()) # pylint: disable=protected-access
+        self.waterflow.config.read_config()  # Config yaml merged into the template again
+        program = self.waterflow.config.schedule.programs['second']
+        self.assertEqual({key: program[key] for key in expected}, expected)
+        time_prog, program_name = self.waterflow._recalc_next_program( # pylint: disable=protected-access
+            Waterflow.str_to_time('2023-04-27 10:00:00'))
+        self.assertEqual((Waterflow.time_to_str(time_prog), program_name), ('2023-04-27 19:04:00', 'second'))
+
+
+if __name__ == '__main__':
+    unittest.main()
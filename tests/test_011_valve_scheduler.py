@@ -0,0 +1,78 @@
+""" Unittesting """
+import unittest
+from pathlib import Path
+import gc
+
+from piwaterflow import Waterflow
+from piwaterflow.valve_scheduler import plan_valves, plan_actions
+
+
+class Testing(unittest.TestCase):
+    """ Unittesting class
+    """
+    def setUp(self):
+        template_config_path = f'{Path(__file__).parent}/data/config-template.yml'
+        self.waterflow = Waterflow(template_config_path=template_config_path, dry_run=True)
+
+    def tearDown(self):
+        self.waterflow.close()
+        del self.waterflow
+        gc.collect()
+
+    def _set_capacity(self, capacity, flows):
+        config = self.waterflow.config.get_dict()
+        config['supply_capacity'] = capacity
+        for name, flow in flows.items():
+            config['valves'][name]['flow'] = flow
+
+    def test_0110_plan_within_capacity(self):
+        """ Valves run together while their demand fits in the capacity, longest first
+        """
+        plan = plan_valves([('a', 60, 5), ('b', 120, 5), ('c', 30, 5), ('d', 90, 5)], 10)
+        self.assertEqual(plan, [(0, 120, 'b'), (0, 90, 'd'), (90, 150, 'a'), (120, 150, 'c')])
+
+        # Never exceeds the capacity at any time
+        for second, _, _ in plan:
+            demand = sum(5 for start, end, _ in plan if start <= second < end)
+            self.assertLessEqual(demand, 10)
+
+    def test_0111_plan_oversized_valve(self):
+        """ A valve with no demand, or with more demand than the capacity, runs alone
+        """
+        plan = plan_valves([('a', 60, None), ('b', 60, 30), ('c', 60, 5), ('d', 0, 5)], 10)
+        self.assertEqual(plan, [(0, 60, 'a'), (60, 120, 'b'), (120, 180, 'c')])
+
+    def test_0112_actions_close_before_open(self):
+        """ At the same second the valves are closed before the next ones are opened
+        """
+        actions = plan_actions([(0, 60, 'a'), (60, 120, 'b')])
+        self.assertEqual(actions, [(0, True, 'a'), (60, False, 'a'), (60, True, 'b'), (120, False, 'b')])
+
+    def test_0113_loop_concurrent(self):
+        """ With supply_capacity, the valves of a program are opened at the same time
+        """
+        self._set_capacity(20, {'main': 10, 'grass': 10})
+        self.waterflow._write_last_program_time(Waterflow.str_to_time('2023-05-26 23:59:00')) # pylint: disable=protected-access
+        self.waterflow.loop(Waterflow.str_to_time('2023-05-27 09:52:00'))
+
+        events = [(event[1], event[2]) for event in self.waterflow._read_events()] # pylint: disable=protected-access
+        self.assertEqual(events, [('ExecProg', 'first'), ('InverterON', None),
+                                  ('ValveON', 'main'), ('ValveON', 'grass'),
+                                  ('ValveOFF', 'grass'), ('ValveOFF', 'main'),
+                                  ('InverterOFF', None), ('LastProg', '2023-05-27 19:04:00')])
+
+    def test_0114_loop_concurrent_stop(self):
+        """ A stop skips the valves not opened yet
+        """
+        self._set_capacity(10, {'main': 10, 'grass': 10})
+        self.waterflow.stop()
+        program = self.waterflow._get_program('first') # pylint: disable=protected-access
+        self.waterflow._execute_valves_concurrently(program) # pylint: disable=protected-access
+        self.waterflow.stop_remove()
+
+        events = [(event[1], event[2]) for event in self.waterflow._read_events()] # pylint: disable=protected-access
+        self.assertEqual(events, [('ValveSkip', 'main'), ('ValveSkip', 'grass')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+""" Unittesting """
+import os
+import time
+import threading
+import unittest
+from pathlib import Path
+import gc
+
+from piwaterflow import Waterflow
+
+
+class Testing(unittest.TestCase):
+    """ Unittesting class
+    """
+    def setUp(self):
+        template_config_path = f'{Path(__file__).parent}/data/config-template.yml'
+        self.waterflow = Waterflow(template_config_path=template_config_path, dry_run=True)
+
+    def tearDown(self):
+        self.waterflow.executor.wait(5)
+        self.waterflow.dry_run = True
+        self.waterflow.close()
+        del self.waterflow
+        gc.collect()
+
+    def _wait_state(self, state, valves=None, timeout=5):
+        end_time = time.monotonic() + timeout
+        while time.monotonic() < end_time:
+            current = self.waterflow.executor.get_state()
+            if current['state'] == state and (valves is None or current.get('valves') == valves):
+                break
+            time.sleep(0.01)
+        return self.waterflow.executor.get_state()
+
+    def test_0120_loop_not_blocked(self):
+        """ The loop returns while the forced valve is still open, and a later loop stops it
+        """
+        self.waterflow.dry_run = False  # Real sleep of the valve (GPIO is fake anyway)
+        self.waterflow.force('valve', 'grass')
+        self.assertTrue(self.waterflow.loop(wait=False))
+
+        state = self._wait_state('running_valve', valves=['grass'])
+        self.assertEqual(state['state'], 'running_valve')
+        self.assertEqual(state['name'], 'grass')
+        self.assertIsNone(self.waterflow.get_forced_info())
+        self.assertEqual(self.waterflow.get_status()['execution']['state'], 'running_valve')
+
+        # Another loop meanwhile is not locked out
+        self.waterflow.stop()
+        self.assertTrue(self.waterflow.loop())
+        self.assertTrue(self.waterflow.executor.wait(5))
+        self.assertEqual(self.waterflow.executor.get_state()['state'], 'idle')
+
+        events = [event[1] for event in self.waterflow._read_events() # pylint: disable=protected-access
+                  if event[1] not in ('LastProg', 'Stop')]
+        self.assertEqual(events, ['ForcedValve', 'ExecValve', 'InverterON', 'ValveON', 'ValveOFF', 'InverterOFF'])
+        self.assertFalse(self.waterflow.stop_requested())
+
+    def test_0121_force_waits_while_busy(self):
+        """ A force that arrives while watering is kept until the executor is idle
+        """
+        release = threading.Event()
+        self.assertTrue(self.waterflow.executor.start('program', 'first', release.wait))
+        self.waterflow.force('program', 'second')
+        self.waterflow.loop(Waterflow.str_to_time('2023-05-27 08:30:00'))
+        self.assertEqual(self.waterflow.get_forced_info(), {'type': 'program', 'value': 'second'})
+
+        self.waterflow.stop()
+        self.waterflow.loop(Waterflow.str_to_time('2023-05-27 08:31:00'))
+        self.assertEqual(self.waterflow.executor.get_state()['state'], 'stopping')
+        self.assertFalse(self.waterflow.executor.heartbeat())
+        release.set()
+        self.assertEqual(self._wait_state('idle')['state'], 'idle')
+
+    def test_0122_stuck_execution(self):
+        """ An execution of a dead process is taken over by the supervisor
+        """
+        self.waterflow.state.write_execution({'state': 'running_program', 'type': 'program', 'name': 'first',
+                                              'pid': 2 ** 22 + 1, 'run_id': 'dead', 'started': time.time(),
+                                              'heartbeat': time.time()})
+        self.assertTrue(self.waterflow.executor.busy)
+        self.assertTrue(self.waterflow.executor.is_stuck())
+
+        self.waterflow.loop(Waterflow.str_to_time('2023-05-27 08:30:00'))
+        events = self.waterflow._read_events() # pylint: disable=protected-access
+        self.assertTrue(events[0][1] == 'ExecStuck' and events[0][2] == 'first')
+        self.assertFalse(self.waterflow.executor.busy)
+
+    def test_0123_stale_heartbeat(self):
+        """ An execution without heartbeat for too long is stuck, even if its process is alive
+        """
+        self.waterflow.state.write_execution({'state': 'running_valve', 'pid': os.getppid(),
+                                              'heartbeat': time.time() - 3600})
+        self.assertTrue(self.waterflow.executor.is_stuck())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+""" Unittesting """
+import os
+import time
+import unittest
+import multiprocessing
+from pathlib import Path
+import gc
+
+from piwaterflow import Waterflow
+from piwaterflow.command_queue import CommandQueue
+from piwaterflow.state_store import SqliteStateStore
+
+
+def _push_forced_program(db_path: str, barrier):
+    """ Body of a process queuing a forced program, at the same time as the others. Writes slowly, so that the
+        others check the queue meanwhile
+    """
+    store = SqliteStateStore(db_path)
+    queue = CommandQueue(store)
+    write_command = store.write_command
+
+    def slow_write_command(command: dict):
+        time.sleep(0.05)
+        write_command(command)
+    store.write_command = slow_write_command
+    barrier.wait()
+    queue.push('program', 'first')
+
+
+class Testing(unittest.TestCase):
+    """ Unittesting class
+    """
+    def setUp(self):
+        template_config_path = f'{Path(__file__).parent}/data/config-template.yml'
+        self.waterflow = Waterflow(template_config_path=template_config_path, dry_run=True)
+
+    def tearDown(self):
+        self.waterflow.close()
+        del self.waterflow
+        gc.collect()
+
+    def test_0130_burst_drained_by_priority(self):
+        """ Several forces are kept, and executed in one loop: valves before programs
+        """
+        program_id = self.waterflow.enqueue('program', 'second')
+        valve_id = self.waterflow.enqueue('valve', 'grass')
+        self.assertEqual(self.waterflow.get_forced_info(), {'type': 'valve', 'value': 'grass'})
+        self.assertEqual(self.waterflow.get_command(program_id)['status'], 'queued')
+
+        self.waterflow._write_last_program_time(Waterflow.str_to_time('2023-05-27 09:51:00')) # pylint: disable=protected-access
+        self.waterflow.loop(Waterflow.str_to_time('2023-05-27 10:00:00'))
+
+        events = [(event[1], event[2]) for event in self.waterflow._read_events()] # pylint: disable=protected-access
+        self.assertEqual(events, [('ForcedValve', 'grass'), ('ExecValve', 'grass'), ('InverterON', None),
+                                  ('ValveON', 'grass'), ('ValveOFF', 'grass'), ('InverterOFF', None),
+                                  ('ForcedProg', 'second'), ('ExecProg', 'second'), ('InverterON', None),
+                                  ('ValveSkip', 'main'), ('ValveON', 'grass'), ('ValveOFF', 'grass'),
+                                  ('InverterOFF', None), ('LastProg', '2023-05-27 19:04:00')])
+        self.assertEqual(self.waterflow.get_command(valve_id)['status'], 'done')
+        self.assertEqual(self.waterflow.get_command(program_id)['status'], 'done')
+        self.assertIsNone(self.waterflow.get_forced_info())
+
+    def test_0131_deduplication(self):
+        """ An identical pending command is queued only once
+        """
+        first_id = self.waterflow.enqueue('valve', 'grass')
+        self.assertEqual(self.waterflow.enqueue('valve', 'grass'), first_id)
+        self.assertNotEqual(self.waterflow.enqueue('valve', 'main'), first_id)
+        self.assertEqual(len(self.waterflow.commands.pending()), 2)
+
+        self.assertIsNone(self.waterflow.enqueue('valve', 'unknown'))
+        self.assertFalse(self.waterflow.force('program', 'unknown'))
+
+    def test_0132_stop_cancels_forced(self):
+        """ A stop has priority, and cancels the pending forced commands
+        """
+        valve_id = self.waterflow.enqueue('valve', 'grass')
+        stop_id = self.waterflow.enqueue('stop')
+        self.assertTrue(self.waterflow.stop_requested())
+
+        self.waterflow.loop(Waterflow.str_to_time('2023-05-27 08:30:00'))
+        self.assertEqual(self.waterflow.get_command(stop_id)['status'], 'done')
+        self.assertEqual(self.waterflow.get_command(valve_id)['status'], 'cancelled')
+        self.assertFalse(self.waterflow.stop_requested())
+
+        events = self.waterflow._read_events() # pylint: disable=protected-access
+        self.assertEqual(events[0][1], 'Stop')
+
+    def test_0133_legacy_force_file(self):
+        """ A force file written by an older version is queued and executed
+        """
+        with open(self.waterflow._get_homevar_path('force'), 'w', encoding="utf-8") as force_file: # pylint: disable=protected-access
+            force_file.write('{"type":"valve","value":"grass"}')
+        self.waterflow.loop(Waterflow.str_to_time('2023-05-27 08:30:00'))
+
+        events = self.waterflow._read_events() # pylint: disable=protected-access
+        self.assertTrue(events[0][1] == 'ForcedValve' and events[0][2] == 'grass')
+        self.assertFalse(Path(self.waterflow._get_homevar_path('force')).exists()) # pylint: disable=protected-access
+
+    def test_0134_deduplication_among_processes(self):
+        """ Processes queuing the same command at the same time (CLI, control server, daemon) queue it only once
+        """
+        context = multiprocessing.get_context('fork')
+        barrier = context.Barrier(8)
+        processes = [context.Process(target=_push_forced_program, args=(self.waterflow.state.path, barrier))
+                     for _ in range(8)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(10)
+        self.assertEqual(len(self.waterflow.commands.pending()), 1)
+
+    def test_0135_not_running_until_accepted(self):
+        """ A forced command the executor does not accept stays queued, and is executed by a later loop
+        """
+        command_id = self.waterflow.enqueue('valve', 'grass')
+        self.waterflow.state.write_execution({'state': 'running_valve', 'pid': os.getpid(), 'heartbeat': time.time()})
+        self.assertFalse(self.waterflow._execute_forced(self.waterflow.commands.pending())) # pylint: disable=protected-access
+        self.assertEqual(self.waterflow.get_command(command_id)['status'], 'queued')
+
+        self.waterflow.state.write_execution({'state': 'idle'})
+        self.waterflow.loop(Waterflow.str_to_time('2023-05-27 08:30:00'))
+        self.assertEqual(self.waterflow.get_command(command_id)['status'], 'done')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+""" Unittesting """
+import os
+import time
+import unittest
+from pathlib import Path
+from datetime import datetime, timedelta
+import gc
+import yaml
+
+from piwaterflow import SimulatedWaterflow
+
+
+class Testing(unittest.TestCase):
+    """ Unittesting class
+    """
+    def setUp(self):
+        self.template_config_path = f'{Path(__file__).parent}/data/config-template.yml'
+        self.simulation = SimulatedWaterflow(template_config_path=self.template_config_path,
+                                             config_path=self.template_config_path)
+
+    def tearDown(self):
+        self.simulation.close()
+        del self.simulation
+        gc.collect()
+
+    def test_0140_timeline(self):
+        """ Valve times are spent in the virtual clock
+        """
+        events = self.simulation.run(since=datetime(2023, 5, 27, 8, 0), until=datetime(2023, 5, 27, 12, 0))
+        self.assertEqual(events, [('2023-05-27 08:00:00', 'LastProg', '2023-05-27 09:51:00'),
+                                  ('2023-05-27 09:51:00', 'ExecProg', 'first'),
+                                  ('2023-05-27 09:51:00', 'InverterON', None),
+                                  ('2023-05-27 09:51:00', 'ValveON', 'main'),
+                                  ('2023-05-27 10:01:00', 'ValveOFF', 'main'),
+                                  ('2023-05-27 10:01:00', 'ValveON', 'grass'),
+                                  ('2023-05-27 10:03:00', 'ValveOFF', 'grass'),
+                                  ('2023-05-27 10:03:00', 'InverterOFF', None),
+                                  ('2023-05-27 10:03:00', 'LastProg', '2023-05-27 19:04:00')])
+
+        # Nothing is written in the homevar
+        self.assertFalse(os.path.exists(self.simulation.homevar))
+
+    def test_0141_matches_schedule(self):
+        """ Every occurrence of the schedule is executed once, and nothing else
+        """
+        since = datetime(2023, 5, 27, 8, 0)
+        until = datetime(2023, 7, 1)
+        events = self.simulation.run(since=since, until=until)
+        executed = [(event[0], event[2]) for event in events if event[1] == 'ExecProg']
+
+        expected = []
+        for occurrence_time, name in self.simulation.config.schedule.engine.iter_after(since):
+            if occurrence_time > until:
+                break
+            expected.append((occurrence_time.strftime('%Y-%m-%d %H:%M:%S'), name))
+        self.assertEqual(executed, expected)
+
+    def test_0142_forced_and_concurrent(self):
+        """ Commands queued before the run are served first. Concurrent valves share the virtual time
+        """
+        config = self.simulation.config.get_dict()
+        config['supply_capacity'] = 20
+        config['valves']['main']['flow'] = 10
+        config['valves']['grass']['flow'] = 10
+        self.simulation.force('program', 'first')
+        events = self.simulation.run(since=datetime(2023, 5, 27, 8, 0), until=datetime(2023, 5, 27, 9, 0))
+        self.assertEqual([event[:2] for event in events[:7]],
+                         [('2023-05-27 08:00:00', 'ForcedProg'), ('2023-05-27 08:00:00', 'ExecProg'),
+                          ('2023-05-27 08:00:00', 'InverterON'), ('2023-05-27 08:00:00', 'ValveON'),
+                          ('2023-05-27 08:00:00', 'ValveON'), ('2023-05-27 08:02:00', 'ValveOFF'),
+                          ('2023-05-27 08:10:00', 'ValveOFF')])
+
+    def test_0143_year_of_large_config(self):
+        """ A year of a config with many programs is simulated in well under a second
+        """
+        programs = []
+        for index in range(12):
+            programs.append({'name': f'prog{index}', 'enabled': True, 'start_time': f'{index + 6:02d}:00',
+                             'start_times': [f'{index + 6:02d}:30'],
+                             'weekdays': ['mon', 'wed', 'fri'] if index % 2 else None,
+                             'every_n_days': 1 + index % 3,
+                             'valves': [{'name': 'main', 'time': 5}, {'name': 'grass', 'time': 3}]})
+        config_path = f'{Path(__file__).parent}/data/simulation-config.yml'
+        with open(config_path, 'w', encoding="utf-8") as config_file:
+            yaml.dump({'programs': programs}, config_file)
+        try:
+            simulation = SimulatedWaterflow(template_config_path=self.template_config_path, config_path=config_path)
+        finally:
+            os.remove(config_path)
+
+        since = datetime(2023, 1, 1)
+        start = time.perf_counter()
+        events = simulation.run(since=since, until=since + timedelta(days=365))
+        elapsed = time.perf_counter() - start
+
+        executed = sum(1 for event in events if event[1] == 'ExecProg')
+        self.assertGreater(executed, 4000)
+        self.assertLess(elapsed, 1, f'Simulation took {elapsed} seconds')
+
+
+if __name__ == '__main__':
+    unittest.main()
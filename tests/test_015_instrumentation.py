@@ -0,0 +1,111 @@
+""" Unittesting """
+import os
+import time
+import unittest
+import multiprocessing
+from pathlib import Path
+import gc
+
+from piwaterflow import Waterflow
+from piwaterflow.instrumentation import Instrumentation, BUCKETS_MS
+
+
+def _flush_many(path: str, barrier):
+    """ Body of a process flushing its durations many times, at the same time as the others
+    """
+    instrumentation = Instrumentation(path)
+    barrier.wait()
+    for _ in range(20):
+        instrumentation.record('phase', 0.001)
+        instrumentation.flush()
+
+
+class Testing(unittest.TestCase):
+    """ Unittesting class
+    """
+    def setUp(self):
+        template_config_path = f'{Path(__file__).parent}/data/config-template.yml'
+        self.waterflow = Waterflow(template_config_path=template_config_path, dry_run=True)
+
+    def tearDown(self):
+        self.waterflow.close()
+        del self.waterflow
+        gc.collect()
+
+    def test_0150_disabled(self):
+        """ Disabled by default: nothing is measured nor written
+        """
+        self.waterflow.loop(Waterflow.str_to_time('2023-05-27 08:30:00'))
+        self.assertEqual(self.waterflow.get_timings(), {})
+        self.assertFalse(os.path.exists(self.waterflow.instrumentation.path))
+
+    def test_0151_loop_phases(self):
+        """ Phases of the loop are recorded, and persisted when the loop ends
+        """
+        self.waterflow.instrumentation.enabled = True
+        self.waterflow._write_last_program_time(Waterflow.str_to_time('2023-05-26 23:59:00')) # pylint: disable=protected-access
+        self.waterflow.loop(Waterflow.str_to_time('2023-05-27 09:52:00'))
+        self.assertTrue(os.path.exists(self.waterflow.instrumentation.path))
+
+        timings = self.waterflow.get_timings()
+        for phase in ('lock', 'setup_gpio', 'schedule', 'execution', 'events_write', 'cleanup'):
+            self.assertIn(phase, timings)
+        self.assertEqual(timings['lock']['count'], 2)
+        self.assertEqual(timings['execution']['count'], 1)
+        self.assertEqual(sum(count for _, count in timings['events_write']['buckets']),
+                         timings['events_write']['count'])
+
+    def test_0152_histograms_accumulate(self):
+        """ Durations of several instances (processes) are merged in the same fixed buckets
+        """
+        path = self.waterflow._get_homevar_path('test_timings.json') # pylint: disable=protected-access
+        for seconds in (0.0005, 0.003, 120):
+            instrumentation = Instrumentation(path)
+            instrumentation.record('phase', seconds)
+            instrumentation.flush()
+
+        histogram = Instrumentation(path).histograms()['phase']
+        self.assertEqual(histogram['count'], 3)
+        self.assertEqual(histogram['max_ms'], 120000)
+        buckets = dict(histogram['buckets'])
+        self.assertEqual((buckets[1], buckets[5], buckets[None]), (1, 1, 1))
+        self.assertEqual(len(histogram['buckets']), len(BUCKETS_MS) + 1)
+
+        with instrumentation.span('other'):
+            time.sleep(0.01)
+        self.assertEqual(instrumentation.histograms()['other']['count'], 1)  # Not flushed yet, but reported
+        instrumentation.reset()
+        self.assertEqual(Instrumentation(path).histograms(), {})
+
+    def test_0153_timing_metrics(self):
+        """ Durations are emitted as metrics on flush, only when enabled in the config
+        """
+        emitted = []
+        self.waterflow.metrics.emit = lambda table, point: emitted.append((table, point))
+        self.waterflow.instrumentation.enabled = True
+        self.waterflow.loop(Waterflow.str_to_time('2023-05-27 08:30:00'))
+        self.assertEqual(emitted, [])
+
+        self.waterflow.config.get_dict()['metrics'] = True
+        self.waterflow.config.get_dict()['instrumentation'] = {'enabled': True, 'metrics': True}
+        self.waterflow.loop(Waterflow.str_to_time('2023-05-27 08:35:00'))
+        phases = {point['tags']['phase'] for table, point in emitted if table == 'piwaterflow_timings'}
+        self.assertIn('lock', phases)
+        self.assertIn('cleanup', phases)
+
+    def test_0154_concurrent_flushes(self):
+        """ Processes flushing at the same time (cron loops, daemon) do not lose the durations of the others
+        """
+        path = self.waterflow._get_homevar_path('test_timings.json') # pylint: disable=protected-access
+        context = multiprocessing.get_context('fork')
+        barrier = context.Barrier(6)
+        processes = [context.Process(target=_flush_many, args=(path, barrier)) for _ in range(6)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(20)
+        self.assertEqual(Instrumentation(path).histograms()['phase']['count'], 6 * 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
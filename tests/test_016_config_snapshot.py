@@ -0,0 +1,76 @@
+""" Unittesting """
+import os
+import pickle
+import unittest
+from pathlib import Path
+import gc
+
+from piwaterflow import Waterflow
+
+
+class Testing(unittest.TestCase):
+    """ Unittesting class
+    """
+    def setUp(self):
+        template_config_path = f'{Path(__file__).parent}/data/config-template.yml'
+        self.waterflow = Waterflow(template_config_path=template_config_path, dry_run=True)
+        self.config = self.waterflow.config
+
+    def tearDown(self):
+        self.waterflow.close()
+        del self.waterflow
+        del self.config
+        gc.collect()
+
+    def _tamper_snapshot(self, value):
+        """ Changes the snapshot contents, keeping its key: only a read from the snapshot returns the value
+        """
+        with open(self.config._snapshot_path(), 'rb') as snapshot_file: # pylint: disable=protected-access
+            snapshot = pickle.load(snapshot_file)
+        snapshot['config']['max_loop_time'] = value
+        with open(self.config._snapshot_path(), 'wb') as snapshot_file: # pylint: disable=protected-access
+            pickle.dump(snapshot, snapshot_file)
+
+    def test_0160_fresh_snapshot_used(self):
+        """ The snapshot is used while the config files do not change
+        """
+        self.assertTrue(os.path.exists(self.config._snapshot_path())) # pylint: disable=protected-access
+        self._tamper_snapshot(12345)
+        self.config.read_config()
+        self.assertEqual(self.config['max_loop_time'], 12345)
+        self.assertEqual(self.config['programs'][0]['start_time'].strftime('%H:%M'), '09:51')
+        self.assertIsNotNone(self.config.schedule.programs.get('first'))
+
+    def test_0161_stale_snapshot_ignored(self):
+        """ A change of the config file (even with the same size) or a corrupt snapshot falls back to the yaml
+        """
+        self._tamper_snapshot(12345)
+        config_path = self.config.get_config_path()
+        with open(config_path, 'r', encoding="utf-8") as config_file:
+            content = config_file.read()
+        with open(config_path, 'w', encoding="utf-8") as config_file:
+            config_file.write(content.replace('max_loop_time: 20', 'max_loop_time: 30'))
+        self.config.read_config()
+        self.assertEqual(self.config['max_loop_time'], 30)
+
+        with open(self.config._snapshot_path(), 'wb') as snapshot_file: # pylint: disable=protected-access
+            snapshot_file.write(b'garbage')
+        self.config.read_config()
+        self.assertEqual(self.config['max_loop_time'], 30)
+
+    def test_0162_update_config_refreshes(self):
+        """ update_config writes the yaml and the snapshot, and both give the same config
+        """
+        self.waterflow.update_config([{'name': 'first', 'start_time': '07:15'}])
+        self.assertFalse(os.path.exists(f'{self.config.get_config_path()}.tmp'))
+
+        self.config.read_config()  # From the snapshot
+        from_snapshot = self.config.get_dict_copy()
+        os.remove(self.config._snapshot_path()) # pylint: disable=protected-access
+        self.config.read_config()  # From the yaml
+        self.assertEqual(self.config.get_dict(), from_snapshot)
+        self.assertEqual(from_snapshot['programs'][0]['start_time'].strftime('%H:%M'), '07:15')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+""" Unittesting """
+import os
+import time
+import unittest
+from pathlib import Path
+import gc
+
+from piwaterflow import Waterflow
+from piwaterflow.state_store import FileStateStore, SqliteStateStore
+
+
+class Testing(unittest.TestCase):
+    """ Unittesting class
+    """
+    def setUp(self):
+        template_config_path = f'{Path(__file__).parent}/data/config-template.yml'
+        self.waterflow = Waterflow(template_config_path=template_config_path, dry_run=True)
+        self.db_path = self.waterflow._get_homevar_path('state.db') # pylint: disable=protected-access
+
+    def tearDown(self):
+        self.waterflow.close()
+        del self.waterflow
+        gc.collect()
+
+    def test_0170_tick_in_one_transaction(self):
+        """ Changes of a tick are seen by other processes only once the tick ends, all together
+        """
+        other = SqliteStateStore(self.db_path)
+        with self.waterflow.state.transaction():
+            self.waterflow._write_last_program_time(Waterflow.str_to_time('2023-05-27 09:51:00')) # pylint: disable=protected-access
+            self.waterflow._touch_token() # pylint: disable=protected-access
+            self.assertEqual(self.waterflow.state.read_last_program(), '2023-05-27 09:51:00')  # Read your writes
+            self.assertIsNone(other.read_last_program())
+            self.assertIsNone(other.read_token())
+        self.assertEqual(other.read_last_program(), '2023-05-27 09:51:00')
+        self.assertIsNotNone(other.read_token())
+
+        self.waterflow.loop(Waterflow.str_to_time('2023-05-27 09:52:00'))
+        self.assertEqual(other.get_state()['last_program'], '2023-05-27 09:51:00')
+        self.assertFalse(os.path.exists(self.waterflow._get_homevar_path('lastprogram.yml'))) # pylint: disable=protected-access
+        other.close()
+
+    def test_0171_legacy_files_migrated(self):
+        """ State files of older versions are imported once, and removed
+        """
+        homevar = self.waterflow.homevar
+        with open(os.path.join(homevar, 'lastprogram.yml'), 'w', encoding="utf-8") as file:
+            file.write('2023-05-27 09:51:002023-05-27 09:51:00')  # Older versions wrote it twice
+        Path(os.path.join(homevar, 'token')).touch()
+
+        store = SqliteStateStore(os.path.join(homevar, 'migrated.db'))
+        self.assertTrue(store.migrate(FileStateStore(homevar)))
+        self.assertEqual(store.read_last_program(), '2023-05-27 09:51:00')
+        self.assertAlmostEqual(store.read_token(), time.time(), delta=5)
+        self.assertFalse(os.path.exists(os.path.join(homevar, 'token')))
+        self.assertFalse(store.migrate(FileStateStore(homevar)))
+        store.close()
+
+    def test_0172_files_mode_and_export(self):
+        """ Files layout of older versions: as compatibility store, and as export format
+        """
+        self.waterflow._write_last_program_time(Waterflow.str_to_time('2023-05-27 09:51:00')) # pylint: disable=protected-access
+        self.waterflow._touch_token() # pylint: disable=protected-access
+        export_path = self.waterflow._get_homevar_path('export') # pylint: disable=protected-access
+        self.waterflow.export_state(export_path)
+        with open(os.path.join(export_path, 'lastprogram.yml'), 'r', encoding="utf-8") as file:
+            self.assertEqual(file.read(), '2023-05-27 09:51:00')
+        self.assertTrue(os.path.exists(os.path.join(export_path, 'token')))
+
+        files = FileStateStore(export_path)
+        self.assertEqual(files.get_state(), self.waterflow.state.get_state())
+        files.write_last_program('2023-05-28 09:51:00')
+        self.assertEqual(files.read_last_program(), '2023-05-28 09:51:00')
+        self.assertFalse(os.path.exists(os.path.join(export_path, 'lastprogram.yml.tmp')))
+
+    def test_0173_commands_and_execution_in_the_tick(self):
+        """ Commands and execution state are kept in the store, and committed with the tick that changed them
+        """
+        other = SqliteStateStore(self.db_path)
+        with self.waterflow.state.transaction():
+            command_id = self.waterflow.enqueue('program', 'first')
+            self.waterflow.state.write_execution({'state': 'idle', 'run_id': 'tick'})
+            self.assertEqual(self.waterflow.get_command(command_id)['status'], 'queued')
+            self.assertIsNone(other.read_command(command_id))
+            self.assertIsNone(other.read_execution())
+        self.assertEqual(other.read_command(command_id)['status'], 'queued')
+        self.assertEqual(other.read_execution()['run_id'], 'tick')
+
+        self.waterflow.loop(Waterflow.str_to_time('2023-05-27 08:30:00'))
+        self.assertEqual(other.read_command(command_id)['status'], 'done')
+        self.assertEqual(other.read_execution(), {'state': 'idle'})
+        for name in ('execution.json', 'commands'):
+            self.assertFalse(os.path.exists(self.waterflow._get_homevar_path(name))) # pylint: disable=protected-access
+        other.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
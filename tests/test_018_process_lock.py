@@ -0,0 +1,84 @@
+""" Unittesting """
+import os
+import time
+import unittest
+import threading
+import subprocess
+import sys
+from pathlib import Path
+import gc
+
+from piwaterflow import Waterflow
+from piwaterflow.process_lock import ProcessLock
+
+
+class Testing(unittest.TestCase):
+    """ Unittesting class
+    """
+    def setUp(self):
+        template_config_path = f'{Path(__file__).parent}/data/config-template.yml'
+        self.waterflow = Waterflow(template_config_path=template_config_path, dry_run=True)
+        self.lock_path = self.waterflow.loop_lock.path
+
+    def tearDown(self):
+        self.waterflow.close()
+        del self.waterflow
+        gc.collect()
+
+    def test_0180_dead_process_releases(self):
+        """ A process killed while holding the lock does not block the loop, and is reported
+        """
+        code = ('import sys, time; from piwaterflow.process_lock import ProcessLock; '
+                'lock = ProcessLock(sys.argv[1]); lock.acquire(); print("locked", flush=True); time.sleep(60)')
+        with subprocess.Popen([sys.executable, '-c', code, self.lock_path], stdout=subprocess.PIPE) as process:
+            self.assertEqual(process.stdout.readline().strip(), b'locked')
+            self.assertEqual(self.waterflow.loop_lock.owner()['pid'], process.pid)
+            self.assertFalse(self.waterflow.loop_lock.acquire())
+            process.kill()
+            process.wait()
+
+        self.assertIsNone(self.waterflow.loop_lock.owner())
+        self.assertTrue(self.waterflow.loop(Waterflow.str_to_time('2023-05-27 08:30:00')))
+        events = self.waterflow._read_events() # pylint: disable=protected-access
+        self.assertEqual(events[0][1], 'LockExpired')
+
+        # Released cleanly: nothing stale for the next one
+        self.assertTrue(self.waterflow.loop_lock.acquire())
+        self.assertIsNone(self.waterflow.loop_lock.stale_owner)
+        self.assertEqual(self.waterflow.loop_lock.owner()['pid'], os.getpid())
+        self.assertTrue(self.waterflow.loop_lock.release())
+
+    def test_0181_shared_readers(self):
+        """ Readers share the lock, and only wait for a loop deciding
+        """
+        other = ProcessLock(self.lock_path)  # Own file description: behaves as another process
+        with other.shared(timeout=0) as first, self.waterflow.loop_lock.shared(timeout=0) as second:
+            self.assertTrue(first and second)
+            self.assertFalse(self.waterflow.loop_lock.acquire(timeout=0))
+
+        self.assertTrue(other.acquire())
+        with self.waterflow.loop_lock.shared(timeout=0) as reader:
+            self.assertFalse(reader)
+        threading.Timer(0.2, other.release).start()
+        start = time.monotonic()
+        status = self.waterflow.get_status()  # Waits until released
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+        self.assertIn('next_program', status)
+
+    def test_0182_heartbeat(self):
+        """ The owner updates its heartbeat, seen by other processes
+        """
+        other = ProcessLock(self.lock_path)
+        self.assertTrue(self.waterflow.loop_lock.acquire())
+        first = other.owner()
+        time.sleep(0.01)
+        self.waterflow.loop_lock.heartbeat()
+        second = other.owner()
+        self.assertEqual(first['acquired'], second['acquired'])
+        self.assertGreater(second['heartbeat'], first['heartbeat'])
+        self.waterflow.loop_lock.release()
+        self.assertIsNone(other.owner())
+
+
+if __name__ == '__main__':
+    unittest.main()
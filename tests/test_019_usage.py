@@ -0,0 +1,89 @@
+""" Unittesting """
+import unittest
+from datetime import datetime
+from pathlib import Path
+import gc
+
+from piwaterflow import Waterflow
+from piwaterflow.simulation import SimulatedWaterflow
+from piwaterflow.usage import UsageRollups
+
+
+class Testing(unittest.TestCase):
+    """ Unittesting class
+    """
+    def setUp(self):
+        self.template_config_path = f'{Path(__file__).parent}/data/config-template.yml'
+        self.waterflow = Waterflow(template_config_path=self.template_config_path, dry_run=True)
+
+    def tearDown(self):
+        self.waterflow.close()
+        del self.waterflow
+        gc.collect()
+
+    def test_0190_rolled_up_as_events_are_added(self):
+        """ A program run is in the rollups right after the loop, and rebuilding them gives the same usage
+        """
+        self.waterflow._write_last_program_time(Waterflow.str_to_time('2023-05-26 23:59:00')) # pylint: disable=protected-access
+        self.waterflow.loop(Waterflow.str_to_time('2023-05-27 09:52:00'))
+
+        usage = self.waterflow.usage(granularity='total', by_program=True)
+        self.assertEqual([(row['valve'], row['program'], row['runs']) for row in usage],
+                         [('grass', 'first', 1), ('main', 'first', 1)])
+
+        self.assertEqual(self.waterflow.rebuild_usage(), 5)  # ExecProg, and ON/OFF of both valves
+        self.assertEqual(self.waterflow.usage(granularity='total', by_program=True), usage)
+
+    def test_0191_runs_split_at_midnight(self):
+        """ A run across midnight counts its minutes in each day, and the run in the day it started. Forced valves
+            have no program, and a takeover (ExecStuck) closes the valves left open
+        """
+        rollups = UsageRollups(':memory:')
+        for event in [('2023-05-27 23:50:00', 'ExecProg', 'night'),
+                      ('2023-05-27 23:50:00', 'ValveON', 'main'),
+                      ('2023-05-28 00:10:00', 'ValveOFF', 'main'),
+                      ('2023-05-28 08:00:00', 'ExecValve', 'grass'),
+                      ('2023-05-28 08:00:00', 'ValveON', 'grass'),
+                      ('2023-05-28 08:03:00', 'ExecStuck', None)]:
+            rollups.add(event)
+
+        self.assertEqual(rollups.usage(valve='main'),
+                         [{'period': '2023-05-27', 'valve': 'main', 'minutes': 10, 'runs': 1},
+                          {'period': '2023-05-28', 'valve': 'main', 'minutes': 10, 'runs': 0}])
+        self.assertEqual(rollups.usage(granularity='month', by_program=True),
+                         [{'period': '2023-05', 'valve': 'grass', 'minutes': 3, 'runs': 1, 'program': None},
+                          {'period': '2023-05', 'valve': 'main', 'minutes': 20, 'runs': 1, 'program': 'night'}])
+        self.assertEqual(rollups.usage(since=datetime(2023, 5, 28), until=datetime(2023, 5, 29)),
+                         [{'period': '2023-05-28', 'valve': 'grass', 'minutes': 3, 'runs': 1},
+                          {'period': '2023-05-28', 'valve': 'main', 'minutes': 10, 'runs': 0}])
+        with self.assertRaises(ValueError):
+            rollups.usage(granularity='hour')
+        rollups.close()
+
+    def test_0193_iso_weeks(self):
+        """ Weeks are ISO weeks: the days of a week that spans new year are in the same one
+        """
+        rollups = UsageRollups(':memory:')
+        for day in ('2020-12-31', '2021-01-03', '2021-01-04', '2024-12-30'):
+            rollups.add((f'{day} 08:00:00', 'ValveON', 'main'))
+            rollups.add((f'{day} 08:05:00', 'ValveOFF', 'main'))
+
+        self.assertEqual([(row['period'], row['minutes'], row['runs']) for row in rollups.usage(granularity='week')],
+                         [('2020-W53', 10, 2), ('2021-W01', 5, 1), ('2025-W01', 5, 1)])
+        rollups.close()
+
+    def test_0192_simulated_usage(self):
+        """ The usage of a simulation is the one the config would water
+        """
+        self.waterflow.close()  # A single dry run instance at a time
+        simulation = SimulatedWaterflow(template_config_path=self.template_config_path)
+        simulation.run(since=datetime(2023, 5, 1), until=datetime(2023, 5, 8))
+
+        usage = simulation.usage(granularity='total')
+        self.assertEqual([(row['valve'], row['minutes'], row['runs']) for row in usage],
+                         [('grass', 28, 14), ('main', 70, 7)])  # main is capped at max_valve_time
+        self.waterflow = simulation
+
+
+if __name__ == '__main__':
+    unittest.main()
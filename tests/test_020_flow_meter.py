@@ -0,0 +1,81 @@
+""" Unittesting """
+import threading
+import unittest
+from unittest import mock
+from pathlib import Path
+import gc
+
+from piwaterflow import Waterflow
+from piwaterflow.flow_meter import FlowMeter
+
+
+class Testing(unittest.TestCase):
+    """ Unittesting class
+    """
+    def setUp(self):
+        template_config_path = f'{Path(__file__).parent}/data/config-template.yml'
+        self.waterflow = Waterflow(template_config_path=template_config_path, dry_run=True)
+
+    def tearDown(self):
+        self.waterflow.close()
+        del self.waterflow
+        gc.collect()
+
+    def test_0200_no_edge_lost(self):
+        """ Pulse trains from many threads are all counted, while readers peek the counter
+        """
+        meter = FlowMeter(self.waterflow.gpio, 12)
+        trains = [threading.Thread(target=lambda: [meter.on_pulse(12) for _ in range(50000)]) for _ in range(4)]
+        for train in trains:
+            train.start()
+        peeks = []
+        while any(train.is_alive() for train in trains):
+            peeks.append(meter.pulses())
+        for train in trains:
+            train.join()
+
+        self.assertEqual(meter.pulses(), 200000)
+        self.assertEqual(peeks, sorted(peeks))
+
+    def test_0201_flow_per_valve_activation(self):
+        """ The pulses counted while a valve is open are flushed as a single Flow event when it closes
+        """
+        self.waterflow.flow_meter = FlowMeter(self.waterflow.gpio, 12, pulses_per_liter=450)
+        callbacks = {}
+        pulses_per_pin = {33: 450, 35: 900}  # main, grass
+
+        def add_event_detect(pin, _edge, callback=None):
+            callbacks[pin] = callback
+
+        def output(pin, value):
+            if value and pin in pulses_per_pin:  # Synthetic pulse train while the valve is open
+                for _ in range(pulses_per_pin[pin]):
+                    callbacks[12](12)
+
+        with mock.patch.object(self.waterflow.gpio, 'add_event_detect', side_effect=add_event_detect), \
+             mock.patch.object(self.waterflow.gpio, 'remove_event_detect') as remove_event_detect, \
+             mock.patch.object(self.waterflow.gpio, 'output', side_effect=output):
+            self.waterflow._write_last_program_time(Waterflow.str_to_time('2023-05-26 23:59:00')) # pylint: disable=protected-access
+            self.waterflow.loop(Waterflow.str_to_time('2023-05-27 09:52:00'))
+        remove_event_detect.assert_called_once_with(12)
+
+        events = self.waterflow._read_events() # pylint: disable=protected-access
+        self.assertEqual([event[2] for event in events if event[1] == 'Flow'],
+                         [['main', 1.0, 450], ['grass', 2.0, 900]])
+        flow_index = [event[1] for event in events].index('Flow')
+        self.assertEqual(list(events[flow_index - 1][1:]), ['ValveOFF', 'main'])
+        self.assertIn('Valve grass delivered 2.0 liters (900 pulses).', self.waterflow.get_log())
+
+    def test_0202_disabled_without_pin(self):
+        """ Without a pin, no edge detection is set up and no Flow event is added
+        """
+        with mock.patch.object(self.waterflow.gpio, 'add_event_detect') as add_event_detect:
+            self.waterflow._write_last_program_time(Waterflow.str_to_time('2023-05-26 23:59:00')) # pylint: disable=protected-access
+            self.waterflow.loop(Waterflow.str_to_time('2023-05-27 09:52:00'))
+        add_event_detect.assert_not_called()
+        events = self.waterflow._read_events() # pylint: disable=protected-access
+        self.assertFalse([event for event in events if event[1] == 'Flow'])
+
+
+if __name__ == '__main__':
+    unittest.main()
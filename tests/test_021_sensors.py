@@ -0,0 +1,139 @@
+""" Unittesting """
+import os
+import json
+import time
+import threading
+import unittest
+from pathlib import Path
+import gc
+
+from piwaterflow import Waterflow
+from piwaterflow.sensors import FileSensor, SensorSampler
+
+
+class _CountingSensor(FileSensor):
+    """ File sensor that counts its reads
+    """
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.reads = 0
+
+    def read(self) -> dict:
+        self.reads += 1
+        return super().read()
+
+
+class _HungSensor():
+    """ Sensor whose reads never end
+    """
+    def __init__(self):
+        self.release = threading.Event()
+
+    def read(self) -> dict:
+        """ Blocks until released
+        """
+        self.release.wait()
+        return {}
+
+    def close(self):
+        """ Ends the read in progress
+        """
+        self.release.set()
+
+
+class _ClosingSensor(FileSensor):
+    """ File sensor that registers if it was closed
+    """
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class Testing(unittest.TestCase):
+    """ Unittesting class
+    """
+    def setUp(self):
+        template_config_path = f'{Path(__file__).parent}/data/config-template.yml'
+        self.waterflow = Waterflow(template_config_path=template_config_path, dry_run=True)
+        self.readings_path = self.waterflow._get_homevar_path('readings.json') # pylint: disable=protected-access
+        self.cache_path = self.waterflow._get_homevar_path('sensors.json') # pylint: disable=protected-access
+
+    def tearDown(self):
+        if self.waterflow.sensors:
+            self.waterflow.sensors.stop()
+        self.waterflow.close()
+        del self.waterflow
+        gc.collect()
+
+    def _write_readings(self, humidity: float):
+        with open(self.readings_path, 'w', encoding="utf-8") as readings_file:
+            json.dump({'humidity': humidity, 'temperature': 20}, readings_file)
+
+    def _loop_at_program_time(self):
+        self.waterflow._write_last_program_time(Waterflow.str_to_time('2023-05-26 23:59:00')) # pylint: disable=protected-access
+        self.waterflow.loop(Waterflow.str_to_time('2023-05-27 09:52:00'))
+        return [event[1] for event in self.waterflow._read_events()] # pylint: disable=protected-access
+
+    def test_0210_moving_average_shared_and_rate_limited(self):
+        """ The average of the last samples is shared by all the processes, which do not read the sensor again
+            before the interval, and it is not used once stale
+        """
+        sensor = _CountingSensor(self.readings_path)
+        sampler = SensorSampler(sensor, self.cache_path, interval=60, window=3, max_age=600)
+        for humidity in (10, 20, 30, 40):
+            self._write_readings(humidity)
+            self.assertTrue(sampler.sample())
+        self.assertEqual(sampler.average('humidity')[0], 30)  # Last 3 samples
+
+        other_sensor = _CountingSensor(self.readings_path)
+        other = SensorSampler(other_sensor, self.cache_path, interval=60, window=3, max_age=600)
+        other.start()
+        self.assertEqual(other.average('humidity', timeout=1)[0], 30)
+        other.stop()
+        self.assertEqual(other_sensor.reads, 0)  # Sampled less than an interval ago by the first one
+
+        os.remove(self.readings_path)
+        self.assertFalse(sampler.sample())  # A failed read keeps the previous samples
+        stale = SensorSampler(sensor, self.cache_path, max_age=0)
+        self.assertEqual(stale.average('humidity'), (None, None))
+
+    def test_0211_humid_skips_program(self):
+        """ A due program is skipped when the humidity is above the threshold, and it is not run later that day
+        """
+        self._write_readings(95)
+        self.waterflow.sensors = SensorSampler(FileSensor(self.readings_path), self.cache_path)
+        events = self._loop_at_program_time()
+        self.assertIn('HumiditySkip', events)
+        self.assertNotIn('ExecProg', events)
+
+        self.waterflow.loop(Waterflow.str_to_time('2023-05-27 09:55:00'))
+        self.assertNotIn('ExecProg', [event[1] for event in self.waterflow._read_events()]) # pylint: disable=protected-access
+
+    def test_0212_hung_sensor_never_delays_valves(self):
+        """ With a hung sensor the program runs anyway, after waiting the sensor timeout at most
+        """
+        sensor = _HungSensor()
+        self.waterflow.sensors = SensorSampler(sensor, self.cache_path)
+        self.waterflow._sensor_timeout = 0.2 # pylint: disable=protected-access
+        start = time.monotonic()
+        events = self._loop_at_program_time()
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertIn('ExecProg', events)
+        self.assertNotIn('HumiditySkip', events)
+        sensor.release.set()
+
+    def test_0213_sensor_closed_with_the_waterflow(self):
+        """ Closing the waterflow releases the sensor (i.e. ends the DHT22 reader process)
+        """
+        sensor = _ClosingSensor(self.readings_path)
+        self.waterflow.sensors = SensorSampler(sensor, self.cache_path)
+        self.waterflow.sensors.start()
+        self.waterflow.close()
+        self.assertTrue(sensor.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+""" Unittesting """
+import csv
+import unittest
+from unittest import mock
+from datetime import date, timedelta
+from pathlib import Path
+import gc
+
+from piwaterflow import Waterflow
+from piwaterflow import water_budget
+from piwaterflow.water_budget import WaterBudget, hargreaves_et0, soil_balance
+
+
+class Testing(unittest.TestCase):
+    """ Unittesting class
+    """
+    def setUp(self):
+        template_config_path = f'{Path(__file__).parent}/data/config-template.yml'
+        self.waterflow = Waterflow(template_config_path=template_config_path, dry_run=True)
+        self.weather_path = self.waterflow._get_homevar_path('weather.csv') # pylint: disable=protected-access
+        self.budget = WaterBudget(self.weather_path,
+                                  self.waterflow._get_homevar_path('water_budget.json'), # pylint: disable=protected-access
+                                  latitude=40.4)
+
+    def tearDown(self):
+        self.waterflow.close()
+        del self.waterflow
+        gc.collect()
+
+    def _write_weather(self, last_day: date, days: int, tmin: float, tmax: float, rain: float):
+        with open(self.weather_path, 'w', encoding="utf-8", newline='') as weather_file:
+            writer = csv.writer(weather_file)
+            writer.writerow(['date', 'tmin', 'tmax', 'rain'])
+            for index in range(days):
+                writer.writerow([(last_day - timedelta(days=days - 1 - index)).isoformat(), tmin, tmax, rain])
+
+    def test_0220_et0_and_soil_balance(self):
+        """ Summer ET0 is higher than winter ET0, and rain is stored in the soil (up to its capacity) for the next days
+        """
+        et0 = [float(value) for value in hargreaves_et0([15, 196], [2, 18], [12, 32], 40.4)]
+        self.assertTrue(0.5 < et0[0] < 2 < 5 < et0[1] < 8)
+
+        requirement, storage = soil_balance([5, 5, 5], [12, 0, 0], capacity=25)
+        self.assertEqual([float(value) for value in requirement], [0, 0, 3])
+        self.assertEqual([float(value) for value in storage], [7, 2, 0])
+        _, storage = soil_balance([5], [40], capacity=25)
+        self.assertEqual(float(storage[0]), 25)
+
+        rain = [0, 30, 0, 0, 12, 40, 0, 0, 0, 3]
+        requirement, storage = soil_balance([5] * 10, rain, capacity=25)
+        if water_budget.np is not None:  # Same results without NumPy
+            with mock.patch.object(water_budget, 'np', None):
+                self.assertEqual([round(value, 9) for value in hargreaves_et0([15, 196], [2, 18], [12, 32], 40.4)],
+                                 [round(value, 9) for value in et0])
+                self.assertEqual(soil_balance([5] * 10, rain, capacity=25),
+                                 ([float(value) for value in requirement], [float(value) for value in storage]))
+        self.assertEqual([float(value) for value in storage], [0, 25, 20, 15, 22, 25, 20, 15, 10, 8])
+        self.assertEqual([float(value) for value in requirement], [5, 0, 0, 0, 0, 0, 0, 0, 0, 0])
+
+    def test_0221_computed_once_per_day(self):
+        """ The scale is computed once per day, and again when the weather file changes
+        """
+        self._write_weather(date(2023, 5, 26), 3 * 365, tmin=18, tmax=32, rain=0)
+        with mock.patch.object(WaterBudget, 'compute', wraps=self.budget.compute) as compute:
+            budget = self.budget.scale(date(2023, 5, 27))
+            self.assertEqual(self.budget.scale(date(2023, 5, 27)), budget)
+            self.assertEqual(compute.call_count, 1)
+            self.assertGreater(budget['scale'], 1)  # Hot and dry
+            self.assertEqual(budget['date'], '2023-05-26')
+
+            self.assertEqual(self.budget.scale(date(2023, 6, 30))['scale'], 1)  # Outdated weather
+            self.assertEqual(compute.call_count, 2)
+
+            self._write_weather(date(2023, 5, 26), 10, tmin=10, tmax=20, rain=30)
+            self.assertEqual(self.budget.scale(date(2023, 5, 27))['scale'], 0)  # Soaked soil
+            self.assertEqual(compute.call_count, 3)
+
+    def test_0222_program_times_scaled(self):
+        """ Valve times of the program are scaled by the budget before it executes. Without weather, they are not
+        """
+        self.waterflow.water_budget = self.budget
+        self.waterflow.curr_time = Waterflow.str_to_time('2023-05-27 09:52:00')
+        self.assertEqual(self.waterflow._budgeted_program({'valves': [{'name': 'main', 'time': 10}]}), # pylint: disable=protected-access
+                         {'valves': [{'name': 'main', 'time': 10}]})
+        with open(self.weather_path, 'w', encoding="utf-8") as weather_file:
+            weather_file.write('date,tmin,tmax,rain\n2023-05-26,10\n')  # Malformed row
+        self.assertEqual(self.waterflow._budgeted_program({'valves': [{'name': 'main', 'time': 10}]}), # pylint: disable=protected-access
+                         {'valves': [{'name': 'main', 'time': 10}]})
+
+        self._write_weather(date(2023, 5, 26), 10, tmin=10, tmax=20, rain=30)
+        self.waterflow._write_last_program_time(Waterflow.str_to_time('2023-05-26 23:59:00')) # pylint: disable=protected-access
+        self.waterflow.loop(Waterflow.str_to_time('2023-05-27 09:52:00'))
+        events = [tuple(event[1:]) for event in self.waterflow._read_events()] # pylint: disable=protected-access
+        self.assertIn(('Budget', 0), events)
+        self.assertNotIn('ValveON', [event[0] for event in events])
+        self.assertIn('Water budget: valve times at 0%.', self.waterflow.get_log())
+
+
+if __name__ == '__main__':
+    unittest.main()
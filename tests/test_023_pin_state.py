@@ -0,0 +1,77 @@
+""" Unittesting """
+import unittest
+from unittest import mock
+from pathlib import Path
+import gc
+
+from fake_rpigpio.RPi import GPIO
+
+from piwaterflow import Waterflow
+from piwaterflow.pin_state import PinState
+from piwaterflow.relay_drivers import GPIODriver
+
+
+class Testing(unittest.TestCase):
+    """ Unittesting class
+    """
+    def setUp(self):
+        template_config_path = f'{Path(__file__).parent}/data/config-template.yml'
+        self.waterflow = Waterflow(template_config_path=template_config_path, dry_run=True)
+        self.gpio = mock.Mock(wraps=self.waterflow.gpio)
+        self.waterflow.gpio = self.gpio
+        self.waterflow.pins = PinState(GPIODriver(self.gpio))
+
+    def tearDown(self):
+        self.waterflow.close()
+        del self.waterflow
+        gc.collect()
+
+    def test_0230_idle_tick_never_touches_gpio(self):
+        """ A loop that executes nothing neither sets up nor cleans up the GPIO
+        """
+        self.waterflow.loop(Waterflow.str_to_time('2023-05-27 08:30:00'))
+        self.waterflow.loop(Waterflow.str_to_time('2023-05-27 08:31:00'))
+        self.assertEqual(self.gpio.mock_calls, [])
+        self.assertEqual(self.waterflow.get_status()['relays'], {'inverter': None, 'main': None, 'grass': None})
+
+    def test_0231_program_applies_only_diffs(self):
+        """ Pins are set up once per execution, only changes are output, and they are cleaned up at the end
+        """
+        self.waterflow._write_last_program_time(Waterflow.str_to_time('2023-05-26 23:59:00')) # pylint: disable=protected-access
+        self.waterflow.loop(Waterflow.str_to_time('2023-05-27 09:52:00'))
+
+        self.assertEqual(self.gpio.setmode.call_count, 1)
+        self.assertEqual(sorted(call.args[0] for call in self.gpio.setup.call_args_list), [10, 31, 33, 35])
+        self.assertEqual([call.args for call in self.gpio.output.call_args_list],
+                         [(31, GPIO.HIGH), (33, GPIO.HIGH), (33, GPIO.LOW), (35, GPIO.HIGH), (35, GPIO.LOW),
+                          (31, GPIO.LOW)])
+        self.assertEqual(self.gpio.cleanup.call_count, 1)
+        self.assertEqual(self.waterflow.get_relays(), {'inverter': None, 'main': None, 'grass': None})
+
+    def test_0232_batch_and_state(self):
+        """ Changes of a batch are output in a single call, and the applied state is read without the hardware
+        """
+        pins = PinState(GPIODriver(self.gpio))
+        pins.declare([31, 33], inputs=[10])
+        self.assertFalse(pins.ready)
+        pins.prepare()
+        self.assertEqual(self.gpio.setup.call_count, 3)
+        self.gpio.output.assert_not_called()  # Set up LOW
+        with pins.batch():
+            pins.set(31, GPIO.HIGH)
+            pins.set(33, GPIO.HIGH)
+        self.gpio.output.assert_called_once_with([31, 33], [GPIO.HIGH, GPIO.HIGH])
+
+        pins.set(31, GPIO.HIGH)  # Already applied
+        self.assertEqual(self.gpio.output.call_count, 1)
+        self.assertEqual(pins.state(33), GPIO.HIGH)
+
+        self.gpio.reset_mock()
+        pins.release()
+        self.gpio.output.assert_called_once_with([31, 33], [GPIO.LOW, GPIO.LOW])
+        self.gpio.cleanup.assert_called_once_with()
+        self.assertIsNone(pins.state(33))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+""" Unittesting """
+import sys
+import types
+import unittest
+from unittest import mock
+from pathlib import Path
+import gc
+
+from fake_rpigpio.RPi import GPIO
+
+from piwaterflow import Waterflow
+from piwaterflow.pin_state import PinState
+from piwaterflow.relay_drivers import MCP23017Driver, ShiftRegisterDriver, SimulatedRelayDriver, \
+    RelayDriverError, relay_driver_factory
+
+
+class _FakeSMBus():
+    """ I2C bus that records the block writes
+    """
+    writes = []
+
+    def __init__(self, bus: int):
+        self.bus = bus
+
+    def write_i2c_block_data(self, address: int, register: int, data: list):
+        """ Records the transaction
+        """
+        self.writes.append((address, register, list(data)))
+
+    def close(self):
+        """ Nothing to close
+        """
+
+
+class Testing(unittest.TestCase):
+    """ Unittesting class
+    """
+    def setUp(self):
+        template_config_path = f'{Path(__file__).parent}/data/config-template.yml'
+        self.waterflow = Waterflow(template_config_path=template_config_path, dry_run=True)
+
+    def tearDown(self):
+        self.waterflow.close()
+        del self.waterflow
+        gc.collect()
+
+    def test_0240_zones_through_the_driver(self):
+        """ Programs and forced valves drive the relays through the configured driver, opening inverter and valve of
+            a forced valve in a single transaction
+        """
+        driver = relay_driver_factory({'driver': 'simulated'}, self.waterflow.gpio)
+        self.assertIsInstance(driver, SimulatedRelayDriver)
+        self.waterflow.pins = PinState(driver)
+
+        self.waterflow.force('valve', 'grass')
+        self.waterflow.loop(Waterflow.str_to_time('2023-05-27 08:30:00'))
+        self.assertEqual(driver.transactions, [{31: GPIO.LOW, 33: GPIO.LOW, 35: GPIO.LOW},
+                                               {31: GPIO.HIGH, 35: GPIO.HIGH},
+                                               {31: GPIO.LOW, 35: GPIO.LOW}])
+        self.assertTrue(driver.released)
+
+        with self.assertRaises(RelayDriverError):
+            relay_driver_factory({'driver': 'relays.io'}, self.waterflow.gpio)
+
+    def test_0241_mcp23017_bank_per_transaction(self):
+        """ Every expander changed is written in a single transaction with its 16 relays
+        """
+        _FakeSMBus.writes = []
+        with mock.patch.dict(sys.modules, {'smbus2': types.SimpleNamespace(SMBus=_FakeSMBus)}):
+            pins = PinState(MCP23017Driver(addresses=[0x20, 0x21]))
+        pins.declare([0, 9, 17])
+        pins.prepare()
+        self.assertEqual(_FakeSMBus.writes, [(0x20, 0x14, [0, 0]), (0x20, 0x00, [0xFE, 0xFD]),
+                                             (0x21, 0x14, [0, 0]), (0x21, 0x00, [0xFD, 0xFF])])
+        _FakeSMBus.writes = []
+        with pins.batch():
+            pins.set(0, GPIO.HIGH)
+            pins.set(9, GPIO.HIGH)
+        self.assertEqual(_FakeSMBus.writes, [(0x20, 0x14, [0x01, 0x02])])
+
+        with self.assertRaises(RelayDriverError):
+            pins.set(32, GPIO.HIGH)  # Only 2 expanders
+
+    def test_0242_shift_register_latched_once(self):
+        """ The whole chain is shifted out (last channel first) and latched once per change
+        """
+        gpio = mock.Mock(wraps=self.waterflow.gpio)
+        pins = PinState(ShiftRegisterDriver(gpio, data_pin=11, clock_pin=13, latch_pin=15, chips=2))
+        pins.declare([0, 3, 12])
+        pins.prepare()
+        gpio.reset_mock()
+        with pins.batch():
+            pins.set(3, GPIO.HIGH)
+            pins.set(12, GPIO.HIGH)
+
+        outputs = [call.args for call in gpio.output.call_args_list]
+        self.assertEqual(outputs.count((15, GPIO.HIGH)), 1)
+        bits = [level for pin, level in outputs if pin == 11]
+        self.assertEqual(bits, [1 if channel in (3, 12) else 0 for channel in reversed(range(16))])
+
+        with self.assertRaises(RelayDriverError):
+            ShiftRegisterDriver(gpio, 11, 13, 15).setup([0], {0: GPIO.LOW}, inputs=[10])
+
+
+if __name__ == '__main__':
+    unittest.main()